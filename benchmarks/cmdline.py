@@ -0,0 +1,66 @@
+"""
+Times command line rendering for many SingularityTask instances.
+Example:
+$ python -m benchmarks.cmdline -n 10000
+"""
+
+import os
+import time
+import argparse
+import tempfile
+
+from pipeline.interfaces import ukftractography as ukf
+from pipeline.interfaces import whitematteranalysis as wma
+
+
+def bench_cmdline(count, tmpdir):
+    """Creates count UKF and wma tasks and renders each command line.
+    Returns a dictionary of timings in seconds."""
+    container = os.path.join(tmpdir, 'container.img')
+    dwi = os.path.join(tmpdir, 'dwi.nrrd')
+    for path in (container, dwi):
+        open(path, 'w').close()
+    maps = ['%s:/input' % tmpdir]
+
+    results = {}
+    for name, make in [('ukf', lambda: ukf.UKFTractographyTask(
+                            container=container,
+                            map_dirs_list=maps,
+                            dwiFile=dwi,
+                            maskFile=dwi,
+                            numTensor=2,
+                            seedsPerVoxel=5)),
+                       ('register', lambda: wma.WmRegisterToAtlasNewTask(
+                            container=container,
+                            map_dirs_list=maps,
+                            inputSubject=dwi,
+                            inputAtlas='/opt/atlases/atlas.vtp'))]:
+        start = time.time()
+        tasks = [make() for _ in range(count)]
+        created = time.time()
+        for task in tasks:
+            task.cmdline
+        rendered = time.time()
+        results[name] = {'instances': count,
+                         'create_s': created - start,
+                         'cmdline_s': rendered - created}
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('-n', '--count', type=int, default=10000,
+                        help='Number of task instances per interface.')
+    args = parser.parse_args()
+    tmpdir = tempfile.mkdtemp()
+    for name, result in sorted(bench_cmdline(args.count, tmpdir).items()):
+        print('%-10s %d instances: create %.2fs, cmdline %.2fs '
+              '(%.1f us per cmdline)' % (name, result['instances'],
+                                         result['create_s'],
+                                         result['cmdline_s'],
+                                         1e6 * result['cmdline_s'] /
+                                         result['instances']))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,60 @@
+"""
+Times host to container path translation with many mounts.
+Example:
+$ python -m benchmarks.mounts --mounts 500 --paths 10000
+"""
+
+import os
+import time
+import argparse
+
+from pipeline.utils.mounts import compile_mounts
+
+
+def _linear_scan(path, mounts):
+    """The original prefix scan, kept for comparison"""
+    for mount in mounts:
+        h_path, c_path = mount.split(':')
+        if path.startswith(h_path):
+            rel_path = os.path.relpath(path, h_path)
+            path = os.path.join(c_path, rel_path)
+    return path
+
+
+def bench_mounts(mount_count, path_count):
+    """Translates path_count paths through mount_count nested mounts.
+    Returns a dictionary of timings in seconds."""
+    mounts = ['/data/study%03d/site%02d:/input/%03d/%02d' % (i, i % 7, i, i % 7)
+              for i in range(mount_count)]
+    paths = ['/data/study%03d/site%02d/sub-%05d/dwi.nrrd'
+             % (i % mount_count, (i % mount_count) % 7, i)
+             for i in range(path_count)]
+
+    start = time.time()
+    table = compile_mounts(mounts)
+    compiled = time.time()
+    for path in paths:
+        table.to_container(path)
+    translated = time.time()
+    for path in paths:
+        _linear_scan(path, mounts)
+    scanned = time.time()
+    return {'mounts': mount_count,
+            'paths': path_count,
+            'compile_s': compiled - start,
+            'trie_s': translated - compiled,
+            'linear_scan_s': scanned - translated}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--mounts', type=int, default=500)
+    parser.add_argument('--paths', type=int, default=10000)
+    args = parser.parse_args()
+    result = bench_mounts(args.mounts, args.paths)
+    print('%(paths)d paths, %(mounts)d mounts: compile %(compile_s).4fs, '
+          'trie %(trie_s).3fs, linear scan %(linear_scan_s).3fs' % result)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,74 @@
+"""
+Runs the benchmark suite and writes the results as JSON.
+Example:
+$ python -m benchmarks.run -o bench.json --subjects 8
+"""
+
+import sys
+import json
+import time
+import shutil
+import argparse
+import platform
+import tempfile
+
+import nipype
+
+from .cmdline import bench_cmdline
+from .mounts import bench_mounts
+from .startup import bench_startup
+from .workflow import bench_workflow
+
+
+def run_all(args):
+    """Runs each benchmark in its own scratch directory"""
+    suite = [('cmdline', lambda tmpdir: bench_cmdline(args.count, tmpdir)),
+             ('mounts', lambda tmpdir: bench_mounts(args.mounts,
+                                                    args.paths)),
+             ('startup', lambda tmpdir: bench_startup(args.runs, tmpdir,
+                                                      args.image)),
+             ('workflow', lambda tmpdir: bench_workflow(args.subjects, tmpdir,
+                                                        args.plugin,
+                                                        args.n_procs))]
+    results = {}
+    for name, bench in suite:
+        if args.only and name not in args.only:
+            continue
+        tmpdir = tempfile.mkdtemp()
+        try:
+            results[name] = bench(tmpdir)
+        finally:
+            shutil.rmtree(tmpdir)
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('-o', '--output', help='JSON file, default stdout.')
+    parser.add_argument('--only', nargs='+',
+                        choices=['cmdline', 'mounts', 'startup', 'workflow'])
+    parser.add_argument('-n', '--count', type=int, default=1000)
+    parser.add_argument('--mounts', type=int, default=500)
+    parser.add_argument('--paths', type=int, default=10000)
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--image')
+    parser.add_argument('--subjects', type=int, default=4)
+    parser.add_argument('--plugin', default='Linear')
+    parser.add_argument('--n-procs', type=int)
+    args = parser.parse_args()
+
+    report = {'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+              'host': platform.node(),
+              'python': platform.python_version(),
+              'nipype': nipype.__version__,
+              'results': run_all(args)}
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+    else:
+        json.dump(report, sys.stdout, indent=2, sort_keys=True)
+        sys.stdout.write('\n')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,121 @@
+"""
+Times cold and warm container starts through SingularityTask.
+Uses the test container when singularity can build it, otherwise the stub
+runtime from benchmarks.stub.
+Example:
+$ python -m benchmarks.startup --runs 10
+"""
+
+import os
+import time
+import shutil
+import argparse
+import tempfile
+import subprocess
+
+from pipeline.interfaces.singularity import SingularityTask
+from pipeline.utils import instances
+
+from .stub import make_stub
+
+DEFINITION = os.path.join(os.path.dirname(os.path.dirname(
+    os.path.abspath(__file__))), 'test_container', 'singularity.def')
+
+
+class TrueTask(SingularityTask):
+    """Runs a command that exits straight away"""
+    container_cmd = 'true'
+
+
+def _which(name):
+    for path in os.environ.get('PATH', '').split(os.pathsep):
+        candidate = os.path.join(path, name)
+        if os.path.isfile(candidate) and os.access(candidate, os.X_OK):
+            return candidate
+    return None
+
+
+def setup_runtime(tmpdir, image=None):
+    """Finds an image and a singularity executable to run it with.
+    Returns (image, runtime) where runtime is 'singularity' or 'stub'."""
+    if image is not None:
+        return image, 'singularity'
+    if _which('singularity'):
+        image = os.path.join(tmpdir, 'test_container.sif')
+        with open(os.devnull, 'w') as null:
+            status = subprocess.call(['singularity', 'build', '--fakeroot',
+                                      image, DEFINITION],
+                                     stdout=null, stderr=null)
+        if status == 0:
+            return image, 'singularity'
+    bin_dir = os.path.join(tmpdir, 'bin')
+    make_stub(bin_dir)
+    os.environ['PATH'] = bin_dir + os.pathsep + os.environ.get('PATH', '')
+    os.environ['SINGULARITY_STUB_STATE'] = tmpdir
+    image = os.path.join(tmpdir, 'test_container.img')
+    open(image, 'w').close()
+    return image, 'stub'
+
+
+def _evict_page_cache(path):
+    """Asks the kernel to drop path from the page cache"""
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+        os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+    finally:
+        os.close(fd)
+
+
+def _time_run(task):
+    start = time.time()
+    task.run()
+    return time.time() - start
+
+
+def bench_startup(runs, tmpdir, image=None):
+    """Runs the test container runs times in each mode.
+    Returns a dictionary of timings in seconds."""
+    image, runtime = setup_runtime(tmpdir, image)
+    workdir = os.path.join(tmpdir, 'startup')
+    os.makedirs(workdir)
+    cwd = os.getcwd()
+    os.chdir(workdir)
+    results = {'runtime': runtime, 'runs': runs}
+    try:
+        for mode, use_instance in (('run', False), ('instance', True)):
+            def make():
+                return TrueTask(container=image,
+                                map_dirs_list=['%s:%s' % (workdir, workdir)],
+                                use_instance=use_instance)
+            _evict_page_cache(image)
+            cold = _time_run(make())
+            warm = [_time_run(make()) for _ in range(runs)]
+            results[mode] = {'cold_s': cold,
+                             'warm_mean_s': sum(warm) / len(warm),
+                             'warm_min_s': min(warm)}
+    finally:
+        instances.get_pool().shutdown()
+        os.chdir(cwd)
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--runs', type=int, default=10,
+                        help='Number of warm starts per mode.')
+    parser.add_argument('--image', help='Container image to start.')
+    args = parser.parse_args()
+    tmpdir = tempfile.mkdtemp()
+    try:
+        result = bench_startup(args.runs, tmpdir, args.image)
+    finally:
+        shutil.rmtree(tmpdir)
+    for mode in ('run', 'instance'):
+        print('%-8s (%s) cold %.3fs, warm mean %.3fs, warm min %.3fs'
+              % (mode, result['runtime'], result[mode]['cold_s'],
+                 result[mode]['warm_mean_s'], result[mode]['warm_min_s']))
+
+
+if __name__ == '__main__':
+    main()
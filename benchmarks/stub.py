@@ -0,0 +1,153 @@
+"""
+A stand in for the singularity executable and synthetic subject data, so
+the interface layer and workflows can be timed without a container
+runtime.
+
+The stub understands the command lines rendered by the interfaces in this
+package and writes the outputs each tool would produce. Mounts must map
+host directories to the same path in the container.
+"""
+
+import os
+import sys
+import stat
+import shutil
+from collections import OrderedDict
+
+import numpy as np
+
+from pipeline.utils import nrrd
+from pipeline.utils import tractio
+
+STUB = '''#!%(python)s
+import os
+import sys
+import shutil
+
+sys.path.insert(0, %(root)r)
+from benchmarks.stub import run_stub
+
+sys.exit(run_stub(sys.argv[1:]))
+'''
+
+DWI_TEMPLATE = '%s_01_DTI60-1000_20_Ax-DTI-60plus5_QCed.nrrd'
+MASK_TEMPLATE = ('%s_01_DTI60-1000_20_Ax-DTI-60plus5_QCed'
+                 '_B0_threshold_masked.nrrd')
+
+
+# affine transform applied by the registration stub
+REGISTRATION = np.array([[0.9, 0.1, 0.0, 2.0],
+                         [-0.1, 0.9, 0.0, -1.0],
+                         [0.0, 0.0, 1.1, 0.5],
+                         [0.0, 0.0, 0.0, 1.0]])
+
+
+def make_stub(bin_dir):
+    """Writes a stub singularity executable to bin_dir, returns its path"""
+    if not os.path.isdir(bin_dir):
+        os.makedirs(bin_dir)
+    path = os.path.join(bin_dir, 'singularity')
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    with open(path, 'w') as f:
+        f.write(STUB % {'python': sys.executable, 'root': root})
+    os.chmod(path, os.stat(path).st_mode | stat.S_IEXEC)
+    return path
+
+
+def _write_tracts(path, fibers=100, points=50):
+    """Writes a small synthetic tract file"""
+    rng = np.random.RandomState(0)
+    steps = rng.normal(size=(fibers, points, 3)).astype('f4')
+    pts = np.cumsum(steps, axis=1).reshape(-1, 3)
+    offsets = np.arange(0, fibers * points + 1, points)
+    pd = tractio.PolyData(pts, offsets, np.arange(len(pts)))
+    pd.point_data['FA'] = ('SCALARS', rng.uniform(size=len(pts)).astype('f4'))
+    tractio.write_vtk(path, pd)
+
+
+def _makedirs(path):
+    if not os.path.isdir(path):
+        os.makedirs(path)
+
+
+def run_stub(args):
+    """Emulates singularity for the argument list args"""
+    state = os.environ.get('SINGULARITY_STUB_STATE', '/tmp')
+    if args[:1] == ['instance']:
+        marker = os.path.join(state, 'instance_%s' % args[-1])
+        if args[1] == 'start':
+            open(marker, 'w').close()
+        elif args[1] == 'stop' and os.path.exists(marker):
+            os.remove(marker)
+        elif args[1] == 'list' and os.path.exists(marker):
+            print(args[-1])
+        return 0
+
+    # skip global options, the verb and its options up to the image
+    i = 0
+    while args[i].startswith('-'):
+        i += 1
+    i += 1
+    while args[i].startswith('-'):
+        i += 2 if args[i] in ('-B', '--bind', '--cpus', '--memory') else 1
+    command = args[i + 1:]
+    if not command:
+        return 0
+
+    tool = os.path.basename(command[0])
+    positional = [a for a in command[1:] if not a.startswith('-')]
+    if tool == 'wm_register_to_atlas_new.py':
+        subject, _, out_dir = positional[:3]
+        name = os.path.splitext(os.path.basename(subject))[0]
+        target = os.path.join(out_dir, name, 'output_tractography')
+        _makedirs(target)
+        # wma writes the input transformed, with its arrays
+        tracts = tractio.load_tracts(subject)
+        tractio.write_vtk(os.path.join(target, name + '_reg.vtk'),
+                          tractio.transform_tracts(tracts, REGISTRATION))
+    elif tool == 'wm_cluster_from_atlas.py':
+        subject, _, out_dir = positional[:3]
+        name = os.path.splitext(os.path.basename(subject))[0]
+        target = os.path.join(out_dir, name + '_reg')
+        _makedirs(target)
+        for cluster in range(1, 4):
+            _write_tracts(os.path.join(target, 'cluster_%05d.vtp' % cluster))
+    elif tool == 'wm_cluster_remove_outliers.py':
+        in_dir, _, out_dir = positional[:3]
+        target = os.path.join(out_dir, '_outlier_removed')
+        _makedirs(target)
+        for name in sorted(os.listdir(in_dir)):
+            if name.endswith('.vtp'):
+                shutil.copy(os.path.join(in_dir, name), target)
+    elif tool == 'wm_separate_clusters_by_hemisphere.py':
+        for part in ('commissural', 'left_hemisphere', 'right_hemisphere'):
+            _makedirs(os.path.join(positional[1], 'tracts_' + part))
+    else:
+        # ukftractography runscript
+        for flag, write in (('--tracts', _write_tracts),
+                            ('--returnparameterfile',
+                             lambda p: open(p, 'w').close())):
+            if flag in command:
+                write(command[command.index(flag) + 1])
+    return 0
+
+
+def make_subjects(base_dir, count, shape=(8, 8, 8), gradients=7):
+    """Writes count synthetic subjects in the dtiprep layout used by
+    the 2tensor workflow, returns their ids"""
+    subjects = []
+    for index in range(count):
+        subject = 'SYN01_BEN_%04d_01' % index
+        subject_dir = os.path.join(base_dir, 'dtiprep', subject)
+        _makedirs(subject_dir)
+        dwi = np.zeros((gradients,) + shape, dtype='i2')
+        keyvalue = OrderedDict([('DWMRI_b-value', '1000')])
+        for gradient in range(gradients):
+            keyvalue['DWMRI_gradient_%04d' % gradient] = '1 0 0'
+        nrrd.write(os.path.join(subject_dir, DWI_TEMPLATE % subject), dwi,
+                   {'kinds': 'list domain domain domain',
+                    'keyvalue': keyvalue})
+        mask = np.ones(shape, dtype='u1')
+        nrrd.write(os.path.join(subject_dir, MASK_TEMPLATE % subject), mask)
+        subjects.append(subject)
+    return subjects
@@ -0,0 +1,109 @@
+"""
+Times an end to end dry run of the 2tensor workflow over synthetic subjects
+with the stub singularity runtime.
+Example:
+$ python -m benchmarks.workflow --subjects 4 --plugin MultiProc
+$ python -m benchmarks.workflow --subjects 8 --plugin Pipelined
+"""
+
+import os
+import time
+import shutil
+import argparse
+import tempfile
+
+from nipype import config
+
+from pipeline.workflows.cohort import create_cohort_workflow, STAGES
+from pipeline.plugins import PipelinedPlugin
+
+from .stub import make_stub, make_subjects, DWI_TEMPLATE, MASK_TEMPLATE
+
+
+def build_2tensor(base_dir, subjects, container, maps, max_ukf=None,
+                  max_wma=None, index_file=None, sample_fibers=None):
+    """The cohort workflow of pipeline/workflows/2tensor.py over subjects"""
+    templates = {'dwi': os.path.join('dtiprep', '{subject_id}',
+                                     DWI_TEMPLATE % '{subject_id}'),
+                 'mask': os.path.join('dtiprep', '{subject_id}',
+                                      MASK_TEMPLATE % '{subject_id}')}
+    return create_cohort_workflow(subjects, base_dir, container, container,
+                                  maps, name="2tensor",
+                                  base_dir=os.path.join(base_dir,
+                                                        'working_dir'),
+                                  templates=templates, atlas_mrml=None,
+                                  max_ukf=max_ukf, max_wma=max_wma,
+                                  index_file=index_file,
+                                  sample_fibers=sample_fibers)
+
+
+def bench_workflow(subject_count, tmpdir, plugin='Linear', n_procs=None,
+                   max_ukf=None, max_wma=None, index=False,
+                   sample_fibers=None):
+    """Runs the 2tensor graph over subject_count synthetic subjects.
+    Returns a dictionary of timings in seconds."""
+    bin_dir = os.path.join(tmpdir, 'bin')
+    make_stub(bin_dir)
+    os.environ['PATH'] = bin_dir + os.pathsep + os.environ.get('PATH', '')
+    os.environ['SINGULARITY_STUB_STATE'] = tmpdir
+    container = os.path.join(tmpdir, 'container.img')
+    open(container, 'w').close()
+    config.set('execution', 'crashdump_dir', tmpdir)
+
+    start = time.time()
+    subjects = make_subjects(tmpdir, subject_count)
+    generated = time.time()
+    wf = build_2tensor(tmpdir, subjects, container,
+                       ['%s:%s' % (tmpdir, tmpdir)], max_ukf, max_wma,
+                       os.path.join(tmpdir, 'cohort.json') if index else None,
+                       sample_fibers)
+    built = time.time()
+    plugin_args = {'n_procs': n_procs} if n_procs else {}
+    runner = plugin
+    if plugin == 'Pipelined':
+        runner = PipelinedPlugin(plugin_args=dict(plugin_args,
+                                                  stages=STAGES))
+    wf.run(plugin=runner, plugin_args=plugin_args)
+    finished = time.time()
+    result = {'subjects': subject_count,
+              'plugin': plugin,
+              'generate_s': generated - start,
+              'build_s': built - generated,
+              'run_s': finished - built,
+              'per_subject_s': (finished - built) / subject_count}
+    if plugin == 'Pipelined':
+        result['stages'] = runner.stage_report['stages']
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--subjects', type=int, default=4)
+    parser.add_argument('--plugin', default='Linear')
+    parser.add_argument('--n-procs', type=int)
+    parser.add_argument('--max-ukf', type=int,
+                        help='UKF containers running at once')
+    parser.add_argument('--max-wma', type=int,
+                        help='whitematteranalysis containers running at once')
+    parser.add_argument('--index', action='store_true',
+                        help='Select files from a cohort index')
+    parser.add_argument('--sample-fibers', type=int,
+                        help='Register a sample of this many fibers')
+    args = parser.parse_args()
+    tmpdir = tempfile.mkdtemp()
+    try:
+        result = bench_workflow(args.subjects, tmpdir, args.plugin,
+                                args.n_procs, args.max_ukf, args.max_wma,
+                                args.index, args.sample_fibers)
+    finally:
+        shutil.rmtree(tmpdir)
+    print('%(subjects)d subjects (%(plugin)s): build %(build_s).2fs, '
+          'run %(run_s).2fs, %(per_subject_s).2fs per subject' % result)
+    for name, stage in sorted(result.get('stages', {}).items()):
+        print('  %s: %d jobs, %.2f running on average, mean queue %.2f, '
+              'blocked %.2fs' % (name, stage['jobs'], stage['mean_running'],
+                                 stage['mean_queue'], stage['blocked_s']))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,62 @@
+"""
+Nipype interface selecting subject files from a cohort index.
+"""
+
+from nipype.interfaces.io import SelectFiles, SelectFilesInputSpec
+from nipype.interfaces.base import File
+from nipype.utils.filemanip import list_to_filename
+from nipype.utils.misc import human_order_sorted
+from nipype import logging
+
+from ..utils.cohort import load_index
+
+iflogger = logging.getLogger('interface')
+
+
+class CohortFilesInputSpec(SelectFilesInputSpec):
+    index_file = File(exists=True, mandatory=True,
+                      desc=("Cohort index built with the same templates, "
+                            "see pipeline.utils.cohort."))
+
+
+class CohortFiles(SelectFiles):
+    """A drop in replacement of SelectFiles for templates naming a subject
+    directory. Files are looked up in a cohort index rather than globbed,
+    subject_id is the only template field.
+
+    >>> index = CohortIndex('cohort.json', base_directory, templates)
+    >>> index.update()
+    >>> sf = Node(CohortFiles(templates, index_file='cohort.json'),
+    ...           name='selectFiles')
+    """
+    input_spec = CohortFilesInputSpec
+
+    def _list_outputs(self):
+        index = load_index(self.inputs.index_file)
+        if index['templates'] != self._templates:
+            raise ValueError('%s indexes other templates than %s' % (
+                self.inputs.index_file, self._templates))
+        subject = self.inputs.subject_id
+        entry = index['subjects'].get(subject)
+
+        force_lists = self.inputs.force_lists
+        if isinstance(force_lists, bool):
+            force_lists = self._outfields if force_lists else []
+
+        outputs = {}
+        for field in self._outfields:
+            filelist = []
+            if entry is not None:
+                filelist = [path for path, _, _ in entry['files'][field]]
+            if self.inputs.sort_filelist:
+                filelist = human_order_sorted(filelist)
+            if not filelist:
+                msg = 'No files of %s were indexed for subject %s in %s' % (
+                    field, subject, self.inputs.index_file)
+                if self.inputs.raise_on_empty:
+                    raise IOError(msg)
+                iflogger.warning(msg)
+            if field not in force_lists:
+                filelist = list_to_filename(filelist)
+            outputs[field] = filelist
+        return outputs
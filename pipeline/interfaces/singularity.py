@@ -8,6 +8,11 @@ singularity run test_container/test.img abc > test_singularity_log 2>&1
 """
 
 import os
+import math
+import time
+import shlex
+from hashlib import md5
+from nipype import logging
 from nipype.interfaces.base import (traits,
                                     TraitedSpec,
                                     CommandLine,
@@ -21,6 +26,20 @@ from traits.trait_errors import TraitError
 from traits.trait_base import class_of
 from traits.api import Instance
 
+from ..utils import images
+from ..utils import history
+from ..utils import instances
+from ..utils.asyncrun import current_runner
+from ..utils import manifest
+from ..utils import staging
+from ..utils.slots import Slots
+from ..utils.logs import LogStreamer
+from ..utils.profiling import Profile, ProcessSampler
+from ..utils.mounts import compile_mounts
+from ..utils.cache import ResultCache, path_digest, tree_size, flatten_outputs
+
+iflogger = logging.getLogger('interface')
+
 
 class SingularityDir(BaseDirectory):
     """Creates a Directory object that can be checked for existance on the
@@ -90,12 +109,197 @@ class SingularityInputSpec(CommandLineInputSpec):
                                 position=1,
                                 argstr='-B %s...')
 
+    use_instance = traits.Bool(False, usedefault=True, nohash=True,
+                               desc=("Run the command in a persistent "
+                                     "singularity instance shared by all "
+                                     "tasks using the same container, "
+                                     "mounts and scratch_dir."))
+    instance_idle_timeout = traits.Int(instances.DEFAULT_IDLE_TIMEOUT,
+                                       usedefault=True, nohash=True,
+                                       desc=("Seconds an unused instance is "
+                                             "kept alive before it is "
+                                             "stopped."))
+
+    cache_dir = Directory(nohash=True,
+                          desc=("Directory used to cache outputs, keyed on "
+                                "the container image digest, the command "
+                                "line and the contents of the input files. "
+                                "Caching is disabled when not set."))
+    cache_max_size_gb = traits.Float(50.0, usedefault=True, nohash=True,
+                                     desc=("Least recently used cache "
+                                           "entries are removed when the "
+                                           "cache grows beyond this size."))
+
+    scratch_dir = Directory(nohash=True,
+                            desc=("Node local directory. When set, "
+                                  "SingularityFile and SingularityDir inputs "
+                                  "are copied here and bound over their "
+                                  "container paths, the task runs in a "
+                                  "scratch working directory and its outputs "
+                                  "are copied back afterwards."))
+    stage_workers = traits.Int(4, usedefault=True, nohash=True,
+                               desc="Number of files copied in parallel.")
+    scratch_max_gb = traits.Float(50.0, usedefault=True, nohash=True,
+                                  desc=("Least recently used staged inputs "
+                                        "are removed from scratch_dir when "
+                                        "they grow beyond this size."))
+
+    stream_log = traits.Bool(False, usedefault=True, nohash=True,
+                             desc=("Stream the container output to "
+                                   "container.log in the working directory "
+                                   "instead of holding it in memory. "
+                                   "Progress events are written to "
+                                   "container_progress.jsonl."))
+    log_max_mb = traits.Int(100, usedefault=True, nohash=True,
+                            desc="Size at which container.log is rotated.")
+    log_tail_lines = traits.Int(200, usedefault=True, nohash=True,
+                                desc=("Number of output lines kept in memory "
+                                      "and reported in the runtime."))
+
+    apply_limits = traits.Bool(False, usedefault=True, nohash=True,
+                               desc=("Pass the estimated thread count and "
+                                     "memory to singularity as --cpus and "
+                                     "--memory cgroup limits. Needs a "
+                                     "singularity with cgroups support."))
+    slots_dir = Directory(nohash=True,
+                          desc=("Directory of the slot groups limiting how "
+                                "many containers run at once, see "
+                                "pipeline.utils.slots. Unlimited when not "
+                                "set."))
+    slot_group = traits.Str(nohash=True,
+                            desc=("Group of tasks sharing max_running "
+                                  "slots, by default the task class."))
+    max_running = traits.Int(1, usedefault=True, nohash=True,
+                             desc=("Number of containers of slot_group "
+                                   "running at once."))
+
+    image_cache_dir = Directory(nohash=True,
+                                desc=("Node local directory the container "
+                                      "image is copied to once per host. "
+                                      "Containers are started from the "
+                                      "local copy."))
+    image_cache_max_gb = traits.Float(20.0, usedefault=True, nohash=True,
+                                      desc=("Least recently used images are "
+                                            "removed when the image cache "
+                                            "grows beyond this size."))
+    image_sandbox = traits.Bool(False, usedefault=True, nohash=True,
+                                desc=("Unpack the cached image into a "
+                                      "sandbox directory and run that."))
+
+    profile = traits.Bool(False, usedefault=True, nohash=True,
+                          desc=("Record the time spent in each phase of "
+                                "the run and the peak memory and CPU time "
+                                "of the container in runtime.profile. "
+                                "Implies stream_log."))
+    profile_interval = traits.Float(0.5, usedefault=True, nohash=True,
+                                    desc=("Seconds between samples of the "
+                                          "container processes."))
+    history_db = File(nohash=True,
+                      desc=("SQLite database every container run is "
+                            "recorded in, see pipeline.utils.history. "
+                            "Runs are recorded with their wall time, exit "
+                            "status and input size, with their CPU time, "
+                            "memory and output size when profiled."))
+    hash_dirs = traits.Bool(True, usedefault=True, nohash=True,
+                            desc=("Hash directory inputs by the files they "
+                                  "contain rather than by their path, see "
+                                  "pipeline.utils.manifest."))
+
+    def _dir_inputs(self):
+        """Returns the names and host paths of the hashed directory
+        inputs that exist"""
+        dirs = []
+        for name, spec in sorted(self.traits().items()):
+            if spec.nohash or spec.name_source or spec.genfile:
+                continue
+            handler = spec.handler
+            if hasattr(handler, 'inner_traits') and handler.inner_traits():
+                handler = handler.inner_traits()[0].handler
+            if not isinstance(handler, BaseDirectory):
+                continue
+            value = getattr(self, name)
+            if not isdefined(value):
+                continue
+            if isinstance(value, str):
+                value = [value]
+            dirs.extend((name, path) for path in value
+                        if isinstance(path, str) and os.path.isdir(path))
+        return dirs
+
+    def get_hashval(self, hash_method=None):
+        hashed, hashvalue = super(SingularityInputSpec, self).get_hashval(
+            hash_method=hash_method)
+        if not self.hash_dirs:
+            return hashed, hashvalue
+        # contents are hashed whatever the hash_method, the manifest
+        # written by the upstream task makes that as cheap as timestamps.
+        # The path stays in hashvalue, moving a directory reruns the node.
+        digest = md5(hashvalue.encode())
+        for name, path in self._dir_inputs():
+            value = manifest.fingerprint(path)
+            hashed.append(('%s_fingerprint' % name, (path, value)))
+            digest.update(('%s=%s\n' % (name, value)).encode())
+        return hashed, digest.hexdigest()
+
+
+# effective argument positions of each input spec class
+_positions = {}
+
+
+def _arg_positions(spec_class):
+    """
+    Returns the command line position of every positional input of an
+    input spec class. Inputs added by subclasses are moved past the
+    SingularityInputSpec arguments so the mounts, container and container
+    command always come first. Trait metadata is never modified, the
+    positions are computed once per class.
+    """
+    positions = _positions.get(spec_class)
+    if positions is None:
+        base_traits = SingularityInputSpec.class_traits()
+        max_position = max([t.position for t in base_traits.values()
+                            if t.position] + [0])
+        positions = {}
+        for name, trait in spec_class.class_traits().items():
+            position = trait.position
+            if position is None:
+                continue
+            if name not in base_traits and position > 0:
+                position += max_position
+            positions[name] = position
+        _positions[spec_class] = positions
+    return positions
+
+
+def _known_size(path):
+    """Returns the size of a file or directory, of a directory from its
+    manifest when it has one rather than by walking it"""
+    if os.path.isdir(path):
+        stored = manifest.load_manifest(path)
+        if stored is not None:
+            return sum(entry[0] for entry in stored['files'].values())
+    return tree_size(path)
+
 
 class SingularityTask(CommandLine):
     input_spec = SingularityInputSpec
 
     _cmd = 'singularity run'
     _container_cmd = None
+    # (name, regex) pairs matching progress lines in the tool output
+    progress_markers = []
+    # called with every progress event when stream_log is set
+    progress_callback = None
+    # resources reported to the scheduler when the inputs say nothing more
+    default_num_threads = 1
+    default_memory_gb = 1.0
+    # core seconds and bytes written per unit of work, used to plan runs
+    # when no earlier run was profiled, see _estimate_work
+    default_work_seconds = 1.0
+    default_work_output_bytes = float(1 << 20)
+    # inputs recorded with each run in history_db, runs are predicted from
+    # earlier ones with the same values
+    history_params = []
 
     def __init__(self, **inputs):
         if self._container_cmd or self.container_cmd:
@@ -104,44 +308,222 @@ class SingularityTask(CommandLine):
         # to hosts paths, for File, Directory exists checks.
 
         super(SingularityTask, self).__init__(**inputs)
+        # host paths of staged inputs mapped to their scratch copies
+        self._staged = {}
+        # node local copy of the container image while running
+        self._image = None
+        # resources are estimated from the inputs unless set explicitly
+        self._num_threads = None
+        self._estimated_memory_gb = None
+        # phase timings of the current run
+        self._profile = Profile()
+
+    @property
+    def num_threads(self):
+        """Threads used by the task, read by the MultiProc plugin"""
+        if self._num_threads is not None:
+            return self._num_threads
+        return self.estimated_num_threads
+
+    @num_threads.setter
+    def num_threads(self, value):
+        self._num_threads = value
+
+    @property
+    def estimated_num_threads(self):
+        """Threads the inputs of the task select, used unless num_threads
+        is set (see pipeline.workflows.nodes)"""
+        return self._estimate_num_threads()
+
+    @property
+    def estimated_memory_gb(self):
+        """Peak memory of the task, read by the MultiProc plugin"""
+        if self._estimated_memory_gb is not None:
+            return self._estimated_memory_gb
+        return self._estimate_memory_gb()
+
+    @estimated_memory_gb.setter
+    def estimated_memory_gb(self, value):
+        self._estimated_memory_gb = value
+
+    def _estimate_num_threads(self):
+        return self.default_num_threads
+
+    def _estimate_memory_gb(self):
+        return self.default_memory_gb
+
+    def _input_paths(self):
+        """Returns the host paths of the files and directories read by the
+        task, inputs naming outputs and the container are left out"""
+        paths = []
+        for name, spec in self.inputs.traits().items():
+            if name == 'container' or spec.name_source or spec.genfile:
+                continue
+            handler = spec.handler
+            if hasattr(handler, 'inner_traits') and handler.inner_traits():
+                handler = handler.inner_traits()[0].handler
+            if not isinstance(handler, (BaseFile, BaseDirectory)):
+                continue
+            value = getattr(self.inputs, name)
+            if not isdefined(value):
+                continue
+            if isinstance(value, str):
+                value = [value]
+            paths.extend(v for v in value if isinstance(v, str))
+        return paths
+
+    def _history_params(self):
+        """Returns the defined history_params inputs"""
+        params = {}
+        for name in self.history_params:
+            value = getattr(self.inputs, name)
+            if isdefined(value):
+                params[name] = value
+        return params
+
+    def _measured(self):
+        """True when the container process is sampled"""
+        return self.inputs.profile
+
+    def _recorded(self):
+        """True when the amount of work and wall time are recorded"""
+        return self.inputs.profile or isdefined(self.inputs.history_db)
+
+    def _estimate_work(self, sizes=None):
+        """Returns the amount of work of a run, in units the runtime and
+        output size are proportional to. The default is the size of the
+        inputs in MB. sizes maps paths not written yet to their expected
+        size in bytes."""
+        sizes = sizes or {}
+        total = 0.0
+        for path in self._input_paths():
+            if path in sizes:
+                total += sizes[path]
+            elif os.path.exists(path):
+                total += _known_size(path)
+        return max(total / (1 << 20), 1.0)
+
+    def slurm_args(self):
+        """Returns sbatch arguments requesting the estimated resources,
+        for use as node.plugin_args = {'sbatch_args': task.slurm_args()}"""
+        return '--cpus-per-task=%d --mem=%dM' % (
+            self.num_threads, int(math.ceil(self.estimated_memory_gb * 1024)))
+
+    def run(self, **inputs):
+        self._profile = Profile()
+        return super(SingularityTask, self).run(**inputs)
+
+    def _check_mandatory_inputs(self):
+        with self._profile.phase('validate'):
+            super(SingularityTask, self)._check_mandatory_inputs()
+
+    @property
+    def cmdline(self):
+        with self._profile.phase('render'):
+            return super(SingularityTask, self).cmdline
+
+    def aggregate_outputs(self, runtime=None, needed_outputs=None):
+        with self._profile.phase('outputs'):
+            outputs = super(SingularityTask, self).aggregate_outputs(
+                runtime, needed_outputs)
+            if runtime is not None:
+                self._write_manifests(outputs, runtime.cwd)
+        if runtime is None or not self._recorded():
+            return outputs
+        profile = self._profile
+        # only runs of the container say something about its cost
+        if profile.exited is not None:
+            if self._measured():
+                profile.output_bytes = sum(
+                    tree_size(path)
+                    for paths in flatten_outputs(outputs.get()).values()
+                    for path in paths if path and os.path.exists(path))
+            if isdefined(self.inputs.history_db):
+                self._record_history(profile)
+        if self.inputs.profile:
+            runtime.profile = profile.as_dict()
+        return outputs
+
+    def _write_manifests(self, outputs, cwd):
+        """Writes the manifest of every directory output the task made in
+        cwd, downstream tasks fingerprint their directory inputs from them.
+        Outputs elsewhere (inputs passed through) are left alone."""
+        cwd = os.path.join(os.path.realpath(cwd), '')
+        for name, spec in outputs.traits().items():
+            handler = spec.handler
+            if hasattr(handler, 'inner_traits') and handler.inner_traits():
+                handler = handler.inner_traits()[0].handler
+            if not isinstance(handler, BaseDirectory):
+                continue
+            value = getattr(outputs, name)
+            if not isdefined(value):
+                continue
+            if isinstance(value, str):
+                value = [value]
+            for path in value:
+                if isinstance(path, str) and os.path.isdir(path) \
+                and os.path.realpath(path).startswith(cwd):
+                    manifest.write_manifest(path)
+
+    def _record_history(self, profile, returncode=0):
+        tool = self.inputs.container_command
+        if not isdefined(tool):
+            tool = type(self).__name__
+        history.get_history(self.inputs.history_db).record(
+            image=os.path.abspath(self._image or self.inputs.container),
+            interface=type(self).__name__,
+            tool=tool,
+            params=self._history_params(),
+            input_bytes=sum(_known_size(path)
+                            for path in self._input_paths()
+                            if os.path.exists(path)),
+            returncode=returncode,
+            work=profile.work,
+            num_threads=profile.num_threads,
+            wall_s=profile.wall_s,
+            cpu_s=profile.cpu_s,
+            peak_rss_mb=profile.peak_rss_mb,
+            output_bytes=profile.output_bytes)
 
     def _parse_inputs(self, skip=None):
-        # modify the run command if debug is specified
+        # modify the run command if debug is specified, commands are
+        # executed directly in an instance, otherwise the runscript is used
+        verb = 'run'
+        if self.inputs.use_instance \
+        and isdefined(self.inputs.container_command):
+            verb = 'exec'
         if self.inputs.debug:
-            self._cmd = 'singularity --debug run'
-
-        # increment the position argument for all child trait objects
-        # ensure that container arguments and commands come first
-        trait_names = self.inputs.editable_traits()
-        local_trait_names = SingularityInputSpec().editable_traits()
-        # find the current maximum position
-        max_position = 0
-        for name in local_trait_names:
-            t = SingularityInputSpec().trait(name)
-            if t.position and t.position > max_position:
-                max_position = t.position
-        # update the passed parameter positions
-        new_names = set(trait_names) - set(local_trait_names)
-        for name in new_names:
-            t = self.inputs.trait(name)
-            if t.position and t.position >= 0:
-                t.position = t.position + max_position
+            self._cmd = 'singularity --debug %s' % verb
+        else:
+            self._cmd = 'singularity %s' % verb
+        # cgroup limits are set when an instance starts, not per command
+        if self.inputs.apply_limits and not self.inputs.use_instance:
+            self._cmd += ' --cpus %d --memory %dM' % (
+                self.num_threads,
+                int(math.ceil(self.estimated_memory_gb * 1024)))
+
+        # container arguments and commands come first, see _arg_positions
+        positions = _arg_positions(self.inputs.__class__)
         # parse any map_dirs_tuples directives, covert them to list strings
         if isdefined(self.inputs.map_dirs_tuples):
             map_strs = [":".join(str) for str in self.inputs.map_dirs_tuples]
             if not isdefined(self.inputs.map_dirs_list):
                 self.inputs.map_dirs_list = []
-            [self.inputs.map_dirs_list.append(str) for str in map_strs]
+            [self.inputs.map_dirs_list.append(str) for str in map_strs
+             if str not in self.inputs.map_dirs_list]
 
         # original parse code here
         all_args = []
         initial_args = {}
         final_args = {}
         metadata = dict(argstr=lambda t: t is not None)
+        mount_table = self._mount_table()
         for name, spec in sorted(self.inputs.traits(**metadata).items()):
             if skip and name in skip:
                 continue
             value = getattr(self.inputs, name)
+            if name == 'map_dirs_list':
+                value = self._get_binds() or value
             if spec.name_source:
                 value = self._filename_from_source(name)
             elif spec.genfile:
@@ -150,17 +532,30 @@ class SingularityTask(CommandLine):
 
             if not isdefined(value):
                 continue
+            if name == 'container' and self._image is not None:
+                value = self._image
+
+            # instances already have the mounts, refer to them by name
+            if self.inputs.use_instance:
+                if name == 'map_dirs_list':
+                    continue
+                if name == 'container':
+                    value = 'instance://%s' % instances.instance_name(
+                        value, self._get_binds())
 
             # modify SingularityFile paths
             if spec.is_trait_type(SingularityFile) \
             or spec.is_trait_type(SingularityDir):
-                value = self.get_container_path(value,
-                                                self.inputs.map_dirs_list)
+                if self.inputs.use_instance and value in self._staged:
+                    # scratch_dir is bound at its own path, see _get_binds
+                    value = self._staged[value]
+                else:
+                    value = mount_table.to_container(value)
 
             arg = self._format_arg(name, spec, value)
             if arg is None:
                 continue
-            pos = spec.position
+            pos = positions.get(name)
             if pos is not None:
                 if int(pos) >= 0:
                     initial_args[pos] = arg
@@ -172,19 +567,289 @@ class SingularityTask(CommandLine):
         last_args = [arg for pos, arg in sorted(final_args.items())]
         return first_args + all_args + last_args
 
+    def _get_binds(self):
+        binds = []
+        if isdefined(self.inputs.map_dirs_list):
+            binds.extend(self.inputs.map_dirs_list)
+        if self.inputs.use_instance:
+            # the binds key the instance, so they must not change with the
+            # staged copies of each run: the instance gets the whole scratch
+            # directory and the arguments name the copies in it
+            if isdefined(self.inputs.scratch_dir):
+                scratch = os.path.abspath(self.inputs.scratch_dir)
+                binds.append('%s:%s' % (scratch, scratch))
+            return binds
+        # bind staged copies over the container path of the original
+        for host_path, scratch_path in sorted(self._staged.items()):
+            container_path = self._mount_table().to_container(host_path)
+            binds.append('%s:%s' % (scratch_path, container_path))
+        return binds
+
+    def _staged_inputs(self):
+        """Returns the host paths of SingularityFile and SingularityDir
+        inputs that exist on the host"""
+        paths = []
+        for name, spec in sorted(self.inputs.traits().items()):
+            if spec.name_source:
+                continue
+            if not (spec.is_trait_type(SingularityFile)
+                    or spec.is_trait_type(SingularityDir)):
+                continue
+            value = getattr(self.inputs, name)
+            if isdefined(value) and os.path.exists(value):
+                paths.append(value)
+        return paths
+
+    def prefetch(self):
+        """Starts copying the inputs to scratch_dir in the background,
+        so stage in overlaps with other work in this process"""
+        stager = staging.get_stager(self.inputs.scratch_dir,
+                                    self.inputs.stage_workers,
+                                    self.inputs.scratch_max_gb)
+        for path in self._staged_inputs():
+            stager.prefetch(path)
+
+    def _run_interface(self, runtime):
+        profile = self._profile
+        start = time.time()
+        # rendering is counted separately, it happens before the start
+        rendered = profile.phases.get('render', 0.0)
+        if self._recorded():
+            profile.work = self._estimate_work()
+            profile.num_threads = self.num_threads
+        try:
+            return self._run_cached(runtime)
+        finally:
+            end = time.time()
+            render = profile.phases.get('render', 0.0) - rendered
+            if profile.exited is None:
+                profile.add('setup', end - start - render)
+            else:
+                profile.add('setup', profile.spawned - start - render)
+                profile.add('teardown', end - profile.exited)
+
+    def _run_cached(self, runtime):
+        if not isdefined(self.inputs.cache_dir):
+            return self._run_staged(runtime)
+        cache = ResultCache(self.inputs.cache_dir,
+                            self.inputs.cache_max_size_gb)
+        key = self._cache_key(cache)
+        if cache.restore(key, self._list_outputs()):
+            runtime.cmdline = self.cmdline
+            runtime.returncode = 0
+            runtime.stdout = ''
+            runtime.stderr = ''
+            runtime.merged = ''
+            return runtime
+        runtime = self._run_staged(runtime)
+        cache.store(key, self._list_outputs())
+        return runtime
+
+    def _cache_key(self, cache):
+        """
+        Builds a cache key from the container image digest, the command
+        line without host specific arguments and the contents of all
+        input files and directories that exist on the host.
+        """
+        parts = [cache.image_digest(self.inputs.container),
+                 ' '.join(self._parse_inputs(skip=['container',
+                                                   'map_dirs_list']))]
+        for name, spec in sorted(self.inputs.traits().items()):
+            if name == 'container' or spec.name_source or spec.nohash:
+                continue
+            value = getattr(self.inputs, name)
+            if isinstance(value, list):
+                # lists of files, e.g. the subjects of batch tasks
+                paths = value
+            elif spec.is_trait_type(BaseFile) \
+            or spec.is_trait_type(BaseDirectory):
+                paths = [value]
+            else:
+                continue
+            for path in paths:
+                if isinstance(path, str) and os.path.exists(path):
+                    parts.append('%s=%s' % (name, path_digest(path)))
+        return cache.make_key(*parts)
+
+    def _run_staged(self, runtime):
+        if not isdefined(self.inputs.scratch_dir):
+            return self._run_limited(runtime)
+        stager = staging.get_stager(self.inputs.scratch_dir,
+                                    self.inputs.stage_workers,
+                                    self.inputs.scratch_max_gb)
+        self._staged = stager.stage_in(self._staged_inputs())
+        workdir = stager.make_workdir()
+        cwd = runtime.cwd
+        runtime.cwd = workdir
+        try:
+            return self._run_limited(runtime)
+        finally:
+            runtime.cwd = cwd
+            staged, self._staged = self._staged, {}
+            try:
+                stager.stage_out(workdir, cwd)
+            finally:
+                stager.release(staged)
+
+    def _run_limited(self, runtime):
+        if not isdefined(self.inputs.slots_dir):
+            return self._run_container(runtime)
+        group = self.inputs.slot_group
+        if not isdefined(group):
+            group = type(self).__name__
+        slots = Slots(os.path.join(self.inputs.slots_dir, group),
+                      self.inputs.max_running)
+        lock = slots.try_acquire()
+        if lock is None:
+            iflogger.info('Waiting for one of %d %s slots',
+                          slots.limit, group)
+            runner = current_runner()
+            if runner is None:
+                lock = slots.acquire()
+            else:
+                # other nodes go on while this one waits
+                with runner.unlocked():
+                    lock = slots.acquire()
+        try:
+            return self._run_container(runtime)
+        finally:
+            slots.release(lock)
+
+    def _run_container(self, runtime):
+        if not isdefined(self.inputs.image_cache_dir):
+            return self._run_image(runtime)
+        cache = images.ImageCache(self.inputs.image_cache_dir,
+                                  self.inputs.image_cache_max_gb)
+        self._image = cache.get(self.inputs.container,
+                                sandbox=self.inputs.image_sandbox)
+        try:
+            return self._run_image(runtime)
+        finally:
+            cache.release(self._image)
+            self._image = None
+
+    def _run_image(self, runtime):
+        if not self.inputs.use_instance:
+            return self._run_command(runtime)
+        # parse the inputs first so map_dirs_tuples are merged into the
+        # mounts the instance is started with
+        self._parse_inputs()
+        pool = instances.get_pool()
+        pool.idle_timeout = self.inputs.instance_idle_timeout
+        name = pool.acquire(self._image or self.inputs.container,
+                            self._get_binds())
+        try:
+            return self._run_command(runtime)
+        finally:
+            pool.release(name)
+
+    def _run_command(self, runtime):
+        # under the asyncio plugin the container is run by its event loop
+        runner = current_runner()
+        if not (self.inputs.stream_log or self._measured() or runner):
+            return self._run_plain(runtime)
+        runtime.cmdline = self.cmdline
+        runtime.environ.update(self._get_environ())
+        sampler = None
+        if self._measured():
+            sampler = ProcessSampler(self.inputs.profile_interval)
+        streamer = LogStreamer(
+            os.path.join(runtime.cwd, 'container.log'),
+            max_bytes=self.inputs.log_max_mb << 20,
+            tail_lines=self.inputs.log_tail_lines,
+            markers=self.progress_markers,
+            callback=self.progress_callback,
+            progress_file=os.path.join(runtime.cwd,
+                                       'container_progress.jsonl'),
+            sampler=sampler)
+        if runner is not None:
+            runtime.returncode = runner.run(shlex.split(runtime.cmdline),
+                                            cwd=runtime.cwd,
+                                            env=runtime.environ,
+                                            streamer=streamer)
+        else:
+            runtime.returncode = streamer.run(runtime.cmdline,
+                                              cwd=runtime.cwd,
+                                              env=runtime.environ)
+        self._record_process(streamer, sampler)
+        runtime.stdout = '\n'.join(streamer.tail('stdout'))
+        runtime.stderr = '\n'.join(streamer.tail('stderr'))
+        runtime.merged = '\n'.join(streamer.tail())
+        if runtime.returncode != 0:
+            self._record_failure(runtime)
+            self.raise_exception(runtime)
+        return runtime
+
+    def _run_plain(self, runtime):
+        """Runs the container through nipype, timed as a whole"""
+        profile = self._profile
+        profile.spawned = time.time()
+        try:
+            return super(SingularityTask, self)._run_interface(runtime)
+        finally:
+            profile.exited = time.time()
+            profile.add('tool', profile.exited - profile.spawned)
+            if runtime.returncode:
+                self._record_failure(runtime)
+
+    def _record_failure(self, runtime):
+        """Records a run that failed, successful ones are recorded with
+        their outputs"""
+        if isdefined(self.inputs.history_db):
+            self._record_history(self._profile, runtime.returncode)
+
+    def _record_process(self, streamer, sampler):
+        """Splits the container run into startup, until the first line
+        of output, and tool runtime"""
+        profile = self._profile
+        profile.spawned = streamer.started
+        profile.first_output = streamer.first_output
+        profile.exited = streamer.exited
+        first = streamer.first_output or streamer.exited
+        profile.add('startup', first - streamer.started)
+        profile.add('tool', streamer.exited - first)
+        if sampler is not None:
+            profile.peak_rss_mb = round(sampler.peak_rss_mb, 1)
+            profile.cpu_s = round(sampler.cpu_s, 3)
+
+    def _mount_table(self):
+        """Returns the compiled mount table for map_dirs_list"""
+        mounts = self.inputs.map_dirs_list
+        if not isdefined(mounts):
+            mounts = []
+        return compile_mounts(mounts)
+
+    def _host_path(self, path):
+        """Maps a path inside the container back to the host"""
+        return self._mount_table().to_host(path)
+
+    def _output_path(self, name):
+        """Returns the absolute host path of a (possibly generated) input
+        naming an output file or directory"""
+        return os.path.abspath(
+            self._host_path(self._filename_from_source(name)))
+
     def get_container_path(self, path, mounts):
         """
         Takes a file path that is valid in the host
         and a list of mounts ['host:container']
         changes the file path to the path in the container.
+        Mounts are matched on whole path components and the most deeply
+        nested mount wins.
+        """
+        if not isdefined(mounts):
+            return path
+        return compile_mounts(mounts).to_container(path)
+
+    def get_host_path(self, path, mounts):
+        """
+        Takes a file path that is valid in the container
+        and a list of mounts ['host:container']
+        changes the file path to the path on the host.
         """
-        if isdefined(mounts):
-            for mount in mounts:
-                h_path, c_path = mount.split(':')
-                if path.startswith(h_path):
-                    rel_path = os.path.relpath(path, h_path)
-                    path = os.path.join(c_path, rel_path)
-        return(path)
+        if not isdefined(mounts):
+            return path
+        return compile_mounts(mounts).to_host(path)
 
 if __name__ == '__main__':
     container = SingularityTask(container="test_container/test.img",
@@ -0,0 +1,54 @@
+import multiprocessing
+
+from ..ukftractography import UKFTractographyTask
+from ..whitematteranalysis import WmClusterRemoveOutliersShardedTask
+from ..tracts import TractStatsTask
+from ...workflows.nodes import Node, MapNode
+
+
+def test_node_keeps_estimated_threads():
+    node = Node(UKFTractographyTask(), name='tractography')
+    assert node.interface.num_threads == multiprocessing.cpu_count()
+
+
+def test_node_follows_thread_inputs():
+    node = Node(UKFTractographyTask(numThreads=3), name='tractography')
+    assert node.interface.num_threads == 3
+    node = Node(WmClusterRemoveOutliersShardedTask(numWorkers=6),
+                name='RemoveOutliers')
+    assert node.interface.num_threads == 6
+    node = Node(TractStatsTask(num_workers=5), name='stats')
+    assert node.interface.num_threads == 5
+
+
+def test_node_n_procs_overrides_estimate():
+    node = Node(UKFTractographyTask(numThreads=3), name='tractography',
+                n_procs=8, mem_gb=12)
+    assert node.interface.num_threads == 8
+    assert node.interface.estimated_memory_gb == 12
+
+
+def test_single_thread_from_inputs():
+    node = Node(UKFTractographyTask(numThreads=1), name='tractography')
+    assert node.interface.num_threads == 1
+
+
+def test_node_n_procs_one_is_kept():
+    node = Node(UKFTractographyTask(numThreads=3), name='tractography',
+                n_procs=1)
+    assert node.interface.num_threads == 1
+    node = Node(TractStatsTask(num_workers=5), name='stats', n_procs=1)
+    assert node.interface.num_threads == 1
+
+
+def test_map_node_subnodes_keep_threads(tmpdir):
+    task = UKFTractographyTask(numThreads=3)
+    node = MapNode(task, iterfield=['seedsFile'], name='tractography')
+    node.inputs.seedsFile = ['a.nrrd', 'b.nrrd']
+    assert [sub.interface.num_threads
+            for _, sub in node._make_nodes(str(tmpdir))] == [3, 3]
+    node = MapNode(task, iterfield=['seedsFile'], name='tractography',
+                   n_procs=2)
+    node.inputs.seedsFile = ['a.nrrd', 'b.nrrd']
+    assert [sub.interface.num_threads
+            for _, sub in node._make_nodes(str(tmpdir))] == [2, 2]
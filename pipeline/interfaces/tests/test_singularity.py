@@ -0,0 +1,34 @@
+import os
+
+from ...utils import instances
+from ..whitematteranalysis import WmClusterFromAtlasTask
+
+
+def _task(tmpdir, staged):
+    tracts = tmpdir.join('data', 'tracts.vtk')
+    tracts.ensure()
+    tmpdir.join('atlas').ensure(dir=True)
+    tmpdir.join('container.img').ensure()
+    task = WmClusterFromAtlasTask(
+        container=str(tmpdir.join('container.img')),
+        map_dirs_list=['%s:/data' % tmpdir.join('data')],
+        inputFile=str(tracts), atlasDirectory=str(tmpdir.join('atlas')),
+        outputDirectory='clusters', use_instance=True,
+        scratch_dir=str(tmpdir.join('scratch')))
+    task._staged = {str(tracts): str(tmpdir.join('scratch', 'inputs',
+                                                 staged, 'tracts.vtk'))}
+    return task
+
+
+def test_instance_is_shared_between_staged_runs(tmpdir):
+    first, second = _task(tmpdir, 'a'), _task(tmpdir, 'b')
+    image = str(tmpdir.join('container.img'))
+    assert instances.instance_name(image, first._get_binds()) == \
+        instances.instance_name(image, second._get_binds())
+    scratch = str(tmpdir.join('scratch'))
+    assert first._get_binds() == ['%s:/data' % tmpdir.join('data'),
+                                  '%s:%s' % (scratch, scratch)]
+    # the command names the staged copy, reachable in the instance
+    assert os.path.join(scratch, 'inputs', 'b', 'tracts.vtk') in \
+        second.cmdline.split()
+    assert '/data/tracts.vtk' not in second.cmdline.split()
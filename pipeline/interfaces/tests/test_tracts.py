@@ -0,0 +1,67 @@
+import os
+
+import numpy as np
+
+from ...utils import tractio
+from ..tracts import SampleFibersTask, ApplyRegistrationTask
+
+AFFINE = np.array([[0.9, 0.1, 0.0, 2.0],
+                   [-0.1, 0.9, 0.0, -1.0],
+                   [0.0, 0.0, 1.1, 0.5],
+                   [0.0, 0.0, 0.0, 1.0]])
+
+
+def _tracts(fibers=200, points=30):
+    rng = np.random.RandomState(0)
+    steps = rng.normal(size=(fibers, points, 3)).astype('f4')
+    pts = np.cumsum(steps, axis=1).reshape(-1, 3)
+    pd = tractio.PolyData(pts, np.arange(0, fibers * points + 1, points),
+                          np.arange(len(pts)))
+    pd.point_data['FA'] = ('SCALARS',
+                           rng.uniform(size=len(pts)).astype('f4'))
+    return pd
+
+
+def test_fit_affine():
+    points = _tracts().points
+    moved = tractio.transform_tracts(_tracts(), AFFINE).points
+    matrix, residual = tractio.fit_affine(points, moved)
+    assert np.allclose(matrix, AFFINE, atol=1e-5)
+    assert residual < 1e-3
+
+
+def test_apply_registration(tmpdir):
+    os.chdir(str(tmpdir))
+    tractio.write_vtk('tracts.vtk', _tracts())
+    sample = SampleFibersTask(in_file='tracts.vtk', number_of_fibers=20,
+                              random_seed=1).run().outputs.out_file
+    # as wma writes the registered sample
+    tractio.write_vtk('sample_reg.vtk', tractio.transform_tracts(
+        tractio.load_tracts(sample), AFFINE))
+    outputs = ApplyRegistrationTask(in_file='tracts.vtk', sample_file=sample,
+                                    registered_file='sample_reg.vtk').run(
+                                        ).outputs
+    registered = tractio.load_tracts(outputs.out_file)
+    expected = tractio.transform_tracts(_tracts(), AFFINE)
+    assert registered.n_lines == 200
+    assert np.allclose(registered.points, expected.points, atol=1e-4)
+    assert np.allclose(registered.point_data['FA'][1],
+                       expected.point_data['FA'][1])
+    assert outputs.residual < 0.01
+
+
+def test_apply_registration_rejects_nonrigid(tmpdir):
+    os.chdir(str(tmpdir))
+    tractio.write_vtk('tracts.vtk', _tracts())
+    bent = _tracts()
+    bent.points = bent.points + np.sin(bent.points)
+    tractio.write_vtk('tracts_reg.vtk', bent)
+    task = ApplyRegistrationTask(in_file='tracts.vtk',
+                                 sample_file='tracts.vtk',
+                                 registered_file='tracts_reg.vtk')
+    try:
+        task.run()
+    except ValueError as e:
+        assert 'not an affine registration' in str(e)
+    else:
+        assert False, 'a nonrigid registration was applied'
@@ -0,0 +1,414 @@
+"""
+Nipype interfaces for working with tractography on the host.
+These run in python and do not need a container.
+"""
+
+import os
+import csv
+import glob
+import time
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from ..utils import tractio
+from nipype import logging
+from nipype.interfaces.base import (traits,
+                                    TraitedSpec,
+                                    BaseInterface,
+                                    BaseInterfaceInputSpec,
+                                    InputMultiPath,
+                                    File,
+                                    Directory,
+                                    isdefined)
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+iflogger = logging.getLogger('interface')
+
+
+class MergeTractsInputSpec(BaseInterfaceInputSpec):
+    in_files = InputMultiPath(File(exists=True),
+                              mandatory=True,
+                              desc="Legacy vtk tract files to merge.")
+    tracts = File('merged_tracts.vtk', usedefault=True,
+                  desc="Merged output fiber tracts.")
+
+
+class MergeTractsOutputSpec(TraitedSpec):
+    tracts = File(desc="Output fiber tracts", exists=True)
+
+
+class MergeTractsTask(BaseInterface):
+    """Concatenates the fibers of several tract files, for example the
+    shards written by a seed sharded UKFTractography run.
+    Point and cell arrays present in every input are kept."""
+    input_spec = MergeTractsInputSpec
+    output_spec = MergeTractsOutputSpec
+
+    def _run_interface(self, runtime):
+        tractio.merge_files(self.inputs.in_files,
+                            os.path.abspath(self.inputs.tracts))
+        return runtime
+
+    def _list_outputs(self):
+        outputs = self.output_spec().get()
+        outputs['tracts'] = os.path.abspath(self.inputs.tracts)
+        return outputs
+
+
+def cluster_stats(path, scalars=None):
+    """Returns the fiber count, length and scalar statistics of one tract
+    file as a dictionary. Scalars are all one component point arrays
+    unless given."""
+    tracts = tractio.load_tracts(path)
+    counts = np.diff(tracts.offsets)
+    lengths = tractio.fiber_lengths(tracts)
+    row = {'cluster': os.path.splitext(os.path.basename(path))[0],
+           'n_fibers': len(counts),
+           'n_points': int(counts.sum())}
+    for stat, func in (('mean', np.mean), ('sd', np.std),
+                       ('min', np.min), ('max', np.max)):
+        row['length_%s' % stat] = float(func(lengths)) if len(lengths) \
+            else float('nan')
+    if scalars is None:
+        scalars = [name for name, (_, values) in tracts.point_data.items()
+                   if values.ndim == 1]
+    for name in scalars:
+        if name not in tracts.point_data:
+            continue
+        sums = tractio.fiber_sums(tracts, name)
+        nonempty = counts > 0
+        # mean over all points, spread of the per fiber means
+        row['%s_mean' % name] = (float(sums.sum() / counts.sum())
+                                 if nonempty.any() else float('nan'))
+        row['%s_fiber_sd' % name] = (float(np.std(sums[nonempty] /
+                                                  counts[nonempty]))
+                                     if nonempty.any() else float('nan'))
+    return row
+
+
+class TractStatsInputSpec(BaseInterfaceInputSpec):
+    in_directories = InputMultiPath(Directory(exists=True),
+                                    mandatory=True,
+                                    desc=("Directories of cluster tract "
+                                          "files, for example the three "
+                                          "outputs of "
+                                          "WmClusterByHemisphereTask."))
+    pattern = traits.Str('*.vt[kp]', usedefault=True,
+                         desc="Glob matching the tract files.")
+    scalars = traits.List(traits.Str,
+                          desc=("Point arrays to summarise, for example "
+                                "FA1, FreeWater or trace1. Defaults to "
+                                "every scalar point array."))
+    subject_id = traits.Str(desc="Written to the subject column.")
+    out_format = traits.Enum('csv', 'parquet', usedefault=True,
+                             desc="Table format, parquet needs pyarrow.")
+    out_file = File(desc="Output table, tract_stats.<format> by default.")
+    num_workers = traits.Int(nohash=True,
+                             desc=("Processes reading tract files, one "
+                                   "per cpu by default."))
+
+
+class TractStatsOutputSpec(TraitedSpec):
+    out_file = File(desc="Table with one row per cluster", exists=True)
+
+
+class TractStatsTask(BaseInterface):
+    """Computes fiber counts, fiber lengths and the mean of scalar point
+    arrays (as recorded by UKF with recordFA, recordFreeWater and
+    recordTrace) for every cluster file in a set of directories.
+    Files are processed in parallel, one row per cluster is written."""
+    input_spec = TractStatsInputSpec
+    output_spec = TractStatsOutputSpec
+
+    def __init__(self, **inputs):
+        super(TractStatsTask, self).__init__(**inputs)
+        # follow num_workers unless set explicitly
+        self._num_threads = None
+
+    @property
+    def num_threads(self):
+        """Processes used, read by the MultiProc plugin"""
+        if self._num_threads is not None:
+            return self._num_threads
+        return self.estimated_num_threads
+
+    @num_threads.setter
+    def num_threads(self, value):
+        self._num_threads = value
+
+    @property
+    def estimated_num_threads(self):
+        """Processes num_workers selects, all cores unless given"""
+        if isdefined(self.inputs.num_workers):
+            return self.inputs.num_workers
+        return multiprocessing.cpu_count()
+
+    def _out_file(self):
+        if isdefined(self.inputs.out_file):
+            return os.path.abspath(self.inputs.out_file)
+        return os.path.abspath('tract_stats.%s' % self.inputs.out_format)
+
+    def _run_interface(self, runtime):
+        if self.inputs.out_format == 'parquet' and pyarrow is None:
+            raise ImportError('pyarrow is needed to write parquet tables')
+        jobs = []
+        for directory in self.inputs.in_directories:
+            for path in sorted(glob.glob(os.path.join(directory,
+                                                      self.inputs.pattern))):
+                jobs.append((os.path.basename(os.path.normpath(directory)),
+                             path))
+        scalars = self.inputs.scalars if isdefined(self.inputs.scalars) \
+            else None
+        with ProcessPoolExecutor(max_workers=self.num_threads) as pool:
+            rows = list(pool.map(cluster_stats,
+                                 [path for _, path in jobs],
+                                 [scalars] * len(jobs)))
+
+        subject = self.inputs.subject_id \
+            if isdefined(self.inputs.subject_id) else ''
+        columns = ['subject', 'group', 'cluster', 'n_fibers', 'n_points',
+                   'length_mean', 'length_sd', 'length_min', 'length_max']
+        for (group, _), row in zip(jobs, rows):
+            row['subject'] = subject
+            row['group'] = group
+            columns.extend(sorted(name for name in row
+                                  if name not in columns))
+        if self.inputs.out_format == 'parquet':
+            table = pyarrow.Table.from_arrays(
+                [pyarrow.array([row.get(c) for row in rows])
+                 for c in columns], names=columns)
+            pyarrow.parquet.write_table(table, self._out_file())
+        else:
+            with open(self._out_file(), 'w') as f:
+                writer = csv.DictWriter(f, columns, restval='')
+                writer.writeheader()
+                writer.writerows(rows)
+        return runtime
+
+    def _list_outputs(self):
+        outputs = self.output_spec().get()
+        outputs['out_file'] = self._out_file()
+        return outputs
+
+
+class ConvertTractsInputSpec(BaseInterfaceInputSpec):
+    in_file = File(exists=True, mandatory=True,
+                   desc="Tract file, legacy vtk, vtp or npz.")
+    out_format = traits.Enum('vtp', 'npz', usedefault=True,
+                             desc=("vtk xml polydata with appended binary "
+                                   "data, readable by whitematteranalysis, "
+                                   "or a compressed numpy archive."))
+    compressor = traits.Enum('zlib', 'lz4', 'none', usedefault=True,
+                             desc=("Compression of vtp output, lz4 needs "
+                                   "the lz4 package and vtk 8.2 or newer "
+                                   "to read."))
+    compression_level = traits.Range(low=1, high=9, value=6, usedefault=True,
+                                     desc="zlib compression level.")
+    out_file = File(desc="Output file, the input name with the new "
+                         "extension by default.")
+
+
+class ConvertTractsOutputSpec(TraitedSpec):
+    out_file = File(desc="Converted tracts", exists=True)
+    seconds = traits.Float(desc="Time taken by the conversion")
+    in_bytes = traits.Int(desc="Size of the input file")
+    out_bytes = traits.Int(desc="Size of the output file")
+    size_ratio = traits.Float(desc="Output size over input size")
+
+
+class ConvertTractsTask(BaseInterface):
+    """Converts tractography to compressed binary vtp or npz, so later
+    steps read less from shared storage and skip parsing ASCII vtk.
+    For example between UKFTractographyTask.tracts and
+    WmRegisterToAtlasNewTask.inputSubject."""
+    input_spec = ConvertTractsInputSpec
+    output_spec = ConvertTractsOutputSpec
+
+    def _out_file(self):
+        if isdefined(self.inputs.out_file):
+            return os.path.abspath(self.inputs.out_file)
+        name = os.path.splitext(os.path.basename(self.inputs.in_file))[0]
+        return os.path.abspath('%s.%s' % (name, self.inputs.out_format))
+
+    def _run_interface(self, runtime):
+        start = time.time()
+        tracts = tractio.load_tracts(self.inputs.in_file)
+        out_file = self._out_file()
+        if self.inputs.out_format == 'npz':
+            tractio.write_npz(out_file, tracts)
+        else:
+            compressor = self.inputs.compressor
+            tractio.write_vtp(out_file, tracts,
+                              compressor=None if compressor == 'none'
+                              else compressor,
+                              level=self.inputs.compression_level)
+        self._seconds = time.time() - start
+        iflogger.info('Converted %s in %.1fs, %d to %d bytes',
+                      self.inputs.in_file, self._seconds,
+                      os.path.getsize(self.inputs.in_file),
+                      os.path.getsize(out_file))
+        return runtime
+
+    def _list_outputs(self):
+        outputs = self.output_spec().get()
+        outputs['out_file'] = self._out_file()
+        outputs['seconds'] = getattr(self, '_seconds', 0.0)
+        outputs['in_bytes'] = os.path.getsize(self.inputs.in_file)
+        if os.path.exists(outputs['out_file']):
+            outputs['out_bytes'] = os.path.getsize(outputs['out_file'])
+            outputs['size_ratio'] = (float(outputs['out_bytes']) /
+                                     max(outputs['in_bytes'], 1))
+        return outputs
+
+
+class SampleFibersInputSpec(BaseInterfaceInputSpec):
+    in_file = File(exists=True, mandatory=True,
+                   desc="Whole brain tractography, vtk, vtp or npz.")
+    number_of_fibers = traits.Int(20000, usedefault=True,
+                                  desc=("Number of fibers drawn, as "
+                                        "numberOfFibers of "
+                                        "WmRegisterToAtlasNewTask."))
+    fiber_length = traits.Float(desc=("Minimum length (in mm) of the "
+                                      "fibers drawn, as fiberLength."))
+    fiber_length_max = traits.Float(desc=("Maximum length (in mm) of the "
+                                          "fibers drawn, as "
+                                          "fiberLengthMax."))
+    random_seed = traits.Int(desc="Seed of the random sample.")
+    out_format = traits.Enum('vtp', 'vtk', usedefault=True,
+                             desc=("zlib compressed vtp or binary legacy "
+                                   "vtk."))
+    out_file = File(desc="Output file, <input>_sampled.<format> by "
+                         "default.")
+
+
+class SampleFibersOutputSpec(TraitedSpec):
+    out_file = File(desc="Sampled tracts", exists=True)
+    n_fibers_in = traits.Int(desc="Number of fibers in the input")
+    n_fibers_passed = traits.Int(desc="Fibers within the length bounds")
+    n_fibers_out = traits.Int(desc="Number of fibers written")
+
+
+class SampleFibersTask(BaseInterface):
+    """Draws a random sample of the fibers within a length range in a
+    single pass over a memory mapped tract file and writes it to a
+    smaller file, so WmRegisterToAtlasNewTask loads the sample rather
+    than the whole tractography. Use the same number_of_fibers and length
+    bounds as the registration. The registration then only outputs the
+    sample, ApplyRegistrationTask registers the whole tractography for
+    clustering (see create_cohort_workflow with sample_fibers)."""
+    input_spec = SampleFibersInputSpec
+    output_spec = SampleFibersOutputSpec
+
+    def _out_file(self):
+        if isdefined(self.inputs.out_file):
+            return os.path.abspath(self.inputs.out_file)
+        name = os.path.splitext(os.path.basename(self.inputs.in_file))[0]
+        return os.path.abspath('%s_sampled.%s' % (name,
+                                                  self.inputs.out_format))
+
+    def _run_interface(self, runtime):
+        def optional(value):
+            return value if isdefined(value) else None
+
+        tracts = tractio.load_tracts(self.inputs.in_file)
+        lines, passed = tractio.sample_fibers(
+            tracts, self.inputs.number_of_fibers,
+            min_length=optional(self.inputs.fiber_length),
+            max_length=optional(self.inputs.fiber_length_max),
+            seed=optional(self.inputs.random_seed))
+        sample = tractio.select_lines(tracts, lines)
+        if self.inputs.out_format == 'vtk':
+            tractio.write_vtk(self._out_file(), sample)
+        else:
+            tractio.write_vtp(self._out_file(), sample)
+        self._counts = (tracts.n_lines, passed, sample.n_lines)
+        iflogger.info('Sampled %d of %d fibers (%d within length bounds)',
+                      sample.n_lines, tracts.n_lines, passed)
+        return runtime
+
+    def _list_outputs(self):
+        outputs = self.output_spec().get()
+        outputs['out_file'] = self._out_file()
+        if hasattr(self, '_counts'):
+            (outputs['n_fibers_in'], outputs['n_fibers_passed'],
+             outputs['n_fibers_out']) = self._counts
+        return outputs
+
+
+class ApplyRegistrationInputSpec(BaseInterfaceInputSpec):
+    in_file = File(exists=True, mandatory=True,
+                   desc="Whole brain tractography the sample was drawn from.")
+    sample_file = File(exists=True, mandatory=True,
+                       desc="The sample, out_file of SampleFibersTask.")
+    registered_file = File(exists=True, mandatory=True,
+                           desc=("The sample registered to the atlas, "
+                                 "outputFile of WmRegisterToAtlasNewTask."))
+    tolerance = traits.Float(0.01, usedefault=True,
+                             desc=("Largest distance (in mm) allowed between "
+                                   "a registered point and the affine fit, "
+                                   "larger ones mean the registration was "
+                                   "not affine."))
+    out_format = traits.Enum('vtp', 'vtk', usedefault=True,
+                             desc=("zlib compressed vtp or binary legacy "
+                                   "vtk."))
+    out_file = File(desc="Output file, <input>_reg.<format> by default.")
+
+
+class ApplyRegistrationOutputSpec(TraitedSpec):
+    out_file = File(desc="Registered whole brain tractography", exists=True)
+    transform = traits.List(traits.List(traits.Float()),
+                            desc="The 4x4 affine matrix applied")
+    residual = traits.Float(desc="Largest distance left by the fit, in mm")
+
+
+class ApplyRegistrationTask(BaseInterface):
+    """Registers the whole brain tractography a SampleFibersTask sample was
+    drawn from, with the transform found for the sample. The affine
+    transform is recovered from the sample points before and after
+    registration, whose order wma keeps, so nothing depends on the
+    conventions of the transform files it writes. Only the affine mode of
+    WmRegisterToAtlasNewTask can be applied, a nonrigid registration
+    leaves a residual above tolerance and fails the task."""
+    input_spec = ApplyRegistrationInputSpec
+    output_spec = ApplyRegistrationOutputSpec
+
+    def _out_file(self):
+        if isdefined(self.inputs.out_file):
+            return os.path.abspath(self.inputs.out_file)
+        name = os.path.splitext(os.path.basename(self.inputs.in_file))[0]
+        return os.path.abspath('%s_reg.%s' % (name, self.inputs.out_format))
+
+    def _run_interface(self, runtime):
+        sample = tractio.load_tracts(self.inputs.sample_file)
+        registered = tractio.load_tracts(self.inputs.registered_file)
+        matrix, residual = tractio.fit_affine(sample.points,
+                                              registered.points)
+        if residual > self.inputs.tolerance:
+            raise ValueError('%s is not an affine registration of %s, '
+                             'points are up to %.3g mm off the fit' % (
+                                 self.inputs.registered_file,
+                                 self.inputs.sample_file, residual))
+        tracts = tractio.transform_tracts(
+            tractio.load_tracts(self.inputs.in_file), matrix)
+        if self.inputs.out_format == 'vtk':
+            tractio.write_vtk(self._out_file(), tracts)
+        else:
+            tractio.write_vtp(self._out_file(), tracts)
+        self._fit = (matrix.tolist(), residual)
+        iflogger.info('Registered %d fibers, fit residual %.3g mm',
+                      tracts.n_lines, residual)
+        return runtime
+
+    def _list_outputs(self):
+        outputs = self.output_spec().get()
+        outputs['out_file'] = self._out_file()
+        if hasattr(self, '_fit'):
+            outputs['transform'], outputs['residual'] = self._fit
+        return outputs
@@ -2,15 +2,99 @@
 Nipype interface for Unscented Kalman Tractography (ukftractography)
 """
 
+import os
+import multiprocessing
+
+import numpy as np
+
 from .singularity import (SingularityInputSpec,
                           SingularityTask,
                           SingularityFile)
+from ..utils import nrrd
 from nipype.interfaces.base import (traits,
                                     TraitedSpec,
-                                    File)
+                                    BaseInterface,
+                                    BaseInterfaceInputSpec,
+                                    OutputMultiPath,
+                                    File,
+                                    isdefined)
+from nipype.utils.filemanip import split_filename
 
 from nipype.external.due import BibTeX
 
+# rough model of UKF memory use, used for scheduling:
+# fraction of the image grid inside the brain mask (seed voxels)
+BRAIN_FRACTION = 0.3
+# bytes held per seed for both half fibers and their recorded values
+BYTES_PER_SEED = 2400
+# rough model of UKF runtime and output size, used for planning: core
+# seconds and bytes written per seed and tensor
+SECONDS_PER_SEED = 0.02
+OUTPUT_BYTES_PER_SEED = 1200
+# gradients of the DTI-60plus5 protocol the rates above are for, the filter
+# predicts the signal of every gradient at each step
+REFERENCE_GRADIENTS = 65
+# relative difference of voxel sizes tolerated between DWI and mask
+SPACING_TOLERANCE = 1e-3
+
+
+def _shape_str(shape):
+    return 'x'.join(str(size) for size in shape)
+
+
+def _data_problem(info, path):
+    """Returns what is wrong with the data of a NRRD file as seen from its
+    size, or None. Only raw data is checked, compressed data would have to
+    be read."""
+    data_file = info['data_file']
+    offset = info['offset']
+    if data_file is not None:
+        if not os.path.exists(data_file):
+            return 'data file %s is missing' % data_file
+        path = data_file
+        offset = 0
+    header = info['header']
+    if header.get('encoding', 'raw').lower() != 'raw' \
+    or 'byte skip' in header or 'line skip' in header:
+        return None
+    try:
+        expected = (int(np.prod(info['shape'])) *
+                    nrrd.header_dtype(header).itemsize)
+    except (KeyError, ValueError):
+        return 'has an unsupported type'
+    if os.path.getsize(path) < offset + expected:
+        return 'is truncated, %d bytes of data expected' % expected
+    return None
+
+
+def _grid_problems(path, dwi_info):
+    """Returns how the image in path does not match the grid of the DWI"""
+    try:
+        info = nrrd.header_info(path)
+    except (IOError, OSError, ValueError, KeyError) as e:
+        return ['%s is not readable: %s' % (path, e)]
+    problems = []
+    extra = [info['shape'][axis] for axis in info['list_axes']]
+    if len(info['spatial_shape']) != 3 or any(size != 1 for size in extra):
+        problems.append('%s is not a 3D image' % path)
+    elif info['spatial_shape'] != dwi_info['spatial_shape']:
+        problems.append('grid %s differs from the DWI grid %s' % (
+            _shape_str(info['spatial_shape']),
+            _shape_str(dwi_info['spatial_shape'])))
+    spacing = info['spacing']
+    dwi_spacing = dwi_info['spacing']
+    if spacing is not None and dwi_spacing is not None \
+    and (len(spacing) != len(dwi_spacing) or
+         not np.allclose(spacing, dwi_spacing, rtol=SPACING_TOLERANCE,
+                         atol=0)):
+        problems.append('spacing %s differs from the DWI spacing %s' % (
+            _shape_str('%g' % v for v in spacing),
+            _shape_str('%g' % v for v in dwi_spacing)))
+    problem = _data_problem(info, path)
+    if problem:
+        problems.append(problem)
+    return problems
+
 
 class UKFTractographyInputSpec(SingularityInputSpec):
     returnParameterFile = SingularityFile(argstr='--returnparameterfile %s',
@@ -223,6 +307,10 @@ class UKFTractographyInputSpec(SingularityInputSpec):
                               exists=True)
     version = traits.Bool(argstr='--version',
                           desc="""Displays version and exits""")
+    preflight = traits.Bool(True, usedefault=True, nohash=True,
+                            desc=("Check dwiFile, maskFile and seedsFile "
+                                  "from their headers before starting the "
+                                  "container."))
 
 
 class UKFTractographyOutputSpec(TraitedSpec):
@@ -234,14 +322,176 @@ class UKFTractographyTask(SingularityTask):
     input_spec = UKFTractographyInputSpec
     output_spec = UKFTractographyOutputSpec
     container_cmd = None
+    progress_markers = [('seeds', r'(?P<seeds>\d+)\s+seeds'),
+                        ('percent', r'(?P<percent>\d+(\.\d+)?)\s*%')]
+    default_memory_gb = 2.0
+    default_work_seconds = SECONDS_PER_SEED
+    default_work_output_bytes = OUTPUT_BYTES_PER_SEED
+    history_params = ['numTensor', 'seedsPerVoxel', 'freeWater',
+                      'recordFreeWater', 'recordTensors']
+
+    def _estimate_num_threads(self):
+        # UKF uses every core it can find unless told otherwise
+        if isdefined(self.inputs.numThreads) and self.inputs.numThreads > 0:
+            return self.inputs.numThreads
+        return multiprocessing.cpu_count()
+
+    def _dwi_info(self):
+        """Returns the header summary of dwiFile, or None when it is not
+        there or not readable"""
+        dwi = self.inputs.dwiFile
+        if not isdefined(dwi) or not os.path.exists(dwi):
+            return None
+        try:
+            return nrrd.header_info(dwi)
+        except (IOError, OSError, ValueError, KeyError):
+            # reported by the preflight when the task runs
+            return None
+
+    def _seed_count(self, info):
+        """Estimates the number of seeds from the DWI dimensions"""
+        voxels = np.prod(info['spatial_shape'])
+        seeds_per_voxel = 1
+        if isdefined(self.inputs.seedsPerVoxel):
+            seeds_per_voxel = self.inputs.seedsPerVoxel
+        return float(voxels * BRAIN_FRACTION * seeds_per_voxel)
+
+    def _estimate_memory_gb(self):
+        """Estimates memory from the DWI dimensions and the number of
+        seeds, the DWI is held as floats and all fibers are kept in memory
+        until they are written."""
+        info = self._dwi_info()
+        if info is None:
+            return self.default_memory_gb
+        seeds = self._seed_count(info)
+        per_seed = BYTES_PER_SEED
+        if self.inputs.recordTensors:
+            per_seed *= 2
+        memory = (4.0 * np.prod(info['shape']) +
+                  seeds * per_seed) / (1 << 30)
+        return 0.5 + float(memory)
+
+    def _estimate_work(self, sizes=None):
+        """Seeds times tensors, every seed is tracked for each tensor,
+        scaled by the number of gradients"""
+        info = self._dwi_info()
+        if info is None:
+            return super(UKFTractographyTask, self)._estimate_work(sizes)
+        # UKF fits two tensors unless told otherwise
+        tensors = 2
+        if isdefined(self.inputs.numTensor):
+            tensors = self.inputs.numTensor
+        gradients = info['gradients'] or REFERENCE_GRADIENTS
+        return (self._seed_count(info) * tensors * gradients /
+                float(REFERENCE_GRADIENTS))
+
+    def _preflight(self):
+        """Checks from the NRRD headers alone that dwiFile is a DWI with
+        gradients and that maskFile and seedsFile are on its grid.
+        Returns the list of problems found."""
+        dwi = self.inputs.dwiFile
+        if not isdefined(dwi):
+            return []
+        try:
+            info = nrrd.header_info(dwi)
+        except (IOError, OSError, ValueError, KeyError) as e:
+            return ['dwiFile %s is not readable: %s' % (dwi, e)]
+        problems = []
+        if len(info['spatial_shape']) != 3:
+            problems.append('dwiFile has %d image axes, 3 expected' %
+                            len(info['spatial_shape']))
+        if len(info['list_axes']) != 1:
+            problems.append('dwiFile has %d gradient axes, 1 expected' %
+                            len(info['list_axes']))
+        elif not info['gradients']:
+            problems.append('dwiFile has no DWMRI_gradient entries')
+        elif info['shape'][info['list_axes'][0]] != info['gradients']:
+            problems.append('dwiFile has %d volumes for %d gradients' % (
+                info['shape'][info['list_axes'][0]], info['gradients']))
+        if info['b_value'] is None:
+            problems.append('dwiFile has no DWMRI_b-value')
+        problem = _data_problem(info, dwi)
+        if problem:
+            problems.append('dwiFile %s' % problem)
+        for name in ('maskFile', 'seedsFile'):
+            path = getattr(self.inputs, name)
+            if isdefined(path):
+                problems.extend('%s %s' % (name, problem) for problem in
+                                _grid_problems(path, info))
+        return problems
+
+    def _run_interface(self, runtime):
+        if self.inputs.preflight:
+            with self._profile.phase('validate'):
+                problems = self._preflight()
+            if problems:
+                raise ValueError('Bad inputs for UKF tractography of %s: %s'
+                                 % (self.inputs.dwiFile,
+                                    '; '.join(problems)))
+        return super(UKFTractographyTask, self)._run_interface(runtime)
 
     def __init__(self, **inputs):
         super(UKFTractographyTask, self).__init__(**inputs)
 
     def _list_outputs(self):
-        super(UKFTractographyTask, self)._list_outputs()
+        # tracts and returnParameterFile are generated from dwiFile
+        return super(UKFTractographyTask, self)._list_outputs()
+
+
+class SplitSeedsInputSpec(BaseInterfaceInputSpec):
+    seedsFile = File(exists=True,
+                     desc=("Seed label map to split. If not specified the "
+                           "brain mask is split instead."))
+    maskFile = File(exists=True,
+                    desc="Brain mask, used as the seed region by default.")
+    numShards = traits.Int(mandatory=True,
+                           desc="Number of disjoint seed sets to create.")
+
+
+class SplitSeedsOutputSpec(TraitedSpec):
+    seedFiles = OutputMultiPath(File(exists=True),
+                                desc=("Seed label maps, one per shard, "
+                                      "suitable for the seedsFile input of "
+                                      "UKFTractographyTask."))
+
+
+class SplitSeedsTask(BaseInterface):
+    """Splits the seed region of a tractography run into disjoint shards.
+    Seed voxels are dealt out round robin so each shard covers the whole
+    brain and the shards take about the same time to track.
+    Voxels keep their label value so UKF's labels selection still applies.
+    """
+    input_spec = SplitSeedsInputSpec
+    output_spec = SplitSeedsOutputSpec
+
+    def _seed_source(self):
+        if isdefined(self.inputs.seedsFile):
+            return self.inputs.seedsFile
+        if isdefined(self.inputs.maskFile):
+            return self.inputs.maskFile
+        raise ValueError('One of seedsFile or maskFile must be set')
+
+    def _shard_name(self, index):
+        _, base, _ = split_filename(self._seed_source())
+        return os.path.abspath('%s_seeds%03d.nrrd' % (base, index))
+
+    def _run_interface(self, runtime):
+        data, header = nrrd.read(self._seed_source())
+        flat = data.reshape(-1, order='F')
+        seeds = np.flatnonzero(flat)
+        shards = max(1, min(self.inputs.numShards, len(seeds)))
+        self._num_written = shards
+        for index in range(shards):
+            ids = seeds[index::shards]
+            shard = np.zeros_like(flat)
+            shard[ids] = flat[ids]
+            nrrd.write(self._shard_name(index),
+                       shard.reshape(data.shape, order='F'),
+                       header)
+        return runtime
+
+    def _list_outputs(self):
         outputs = self.output_spec().get()
-        outputs['returnParameterFile'] = self.inputs.returnParameterFile
-        outputs['tracts'] = self.inputs.tracts
-        import pdb; pdb.set_trace()
+        count = getattr(self, '_num_written', self.inputs.numShards)
+        outputs['seedFiles'] = [self._shard_name(i) for i in range(count)]
         return outputs
@@ -6,15 +6,34 @@ from .singularity import (SingularityInputSpec,
                           SingularityTask,
                           SingularityFile,
                           SingularityDir)
+from ..utils.asyncrun import current_runner, set_runner
+from ..utils.cache import link_file
 
 from nipype.interfaces.base import (traits,
                                     TraitedSpec,
                                     File,
-                                    Directory)
+                                    Directory,
+                                    InputMultiPath,
+                                    OutputMultiPath,
+                                    Bunch,
+                                    isdefined)
 
 from nipype.external.due import BibTeX
 
 import os
+import heapq
+import shutil
+from shlex import quote
+from concurrent.futures import ThreadPoolExecutor, wait
+
+# driver run inside the container by the batch tasks
+BATCH_SCRIPT = os.path.abspath(os.path.join(os.path.dirname(__file__),
+                                            '..', 'scripts', 'wma_batch.py'))
+
+# progress lines printed by the wma scripts and the batch driver
+ITERATION_MARKERS = [('iteration', r'[Ii]teration:?\s*(?P<iteration>\d+)'),
+                     ('subject', (r'Subject (?P<subject>\d+) '
+                                  r'(?P<status>done|failed)'))]
 
 
 class WmRegisterToAtlasNewInputSpec(SingularityInputSpec):
@@ -72,6 +91,9 @@ class WmRegisterToAtlasNewTask(SingularityTask):
     container_cmd = 'wm_register_to_atlas_new.py'
     input_spec = WmRegisterToAtlasNewInputSpec
     output_spec = WmRegisterToAtlasNewOutputSpec
+    progress_markers = ITERATION_MARKERS
+    default_memory_gb = 4.0
+    history_params = ['mode', 'numberOfFibers']
 
     references_ = [{'entry': BibTeX("@article{ODonnell2012,"
                                     "author = {O'Donnell, Lauren J and Wells, William M and Golby, Alexandra J and Westin, Carl-Fredrik},"
@@ -89,12 +111,13 @@ class WmRegisterToAtlasNewTask(SingularityTask):
         outputs = self.output_spec().get()
         input_file, _ = os.path.splitext(
             os.path.basename(self.inputs.inputSubject))
-        outfile = os.path.join(self.inputs.outputDirectory,
+        output_dir = self._output_path('outputDirectory')
+        outfile = os.path.join(output_dir,
                                input_file,
                                'output_tractography',
                                input_file + '_reg.vtk')
-        outputs['outputFile'] = os.path.abspath(outfile)
-        outputs['outputDirectory'] = self.inputs.outputDirectory
+        outputs['outputFile'] = outfile
+        outputs['outputDirectory'] = output_dir
         return(outputs)
 
 
@@ -164,6 +187,8 @@ class WmClusterFromAtlasTask(SingularityTask):
     container_cmd = 'wm_cluster_from_atlas.py'
     input_spec = WmClusterFromAtlasInputSpec
     output_spec = WmClusterFromAtlasOutputSpec
+    default_memory_gb = 8.0
+    history_params = ['numberOfFibers', 'fiberLength']
 
     references_ = [{'entry': BibTeX("@article{ODonnell2007,"
                                     "author = {O'Donnell, Lauren J and Westin, Carl-Fredrik},"
@@ -180,13 +205,18 @@ class WmClusterFromAtlasTask(SingularityTask):
                                     "year = {2007}",
                                     "}")}]
 
+    def _estimate_num_threads(self):
+        if isdefined(self.inputs.jobNumber):
+            return self.inputs.jobNumber
+        return self.default_num_threads
+
     def _list_outputs(self):
         outputs = self.output_spec().get()
         input_file, _ = os.path.splitext(
-            os.path.basename(self.inputs.inputSubject))
-        outfile = os.path.join(self.inputs.outputDirectory,
+            os.path.basename(self.inputs.inputFile))
+        outfile = os.path.join(self._output_path('outputDirectory'),
                                input_file + '_reg')
-        outputs['outputDirectory'] = os.path.abspath(outfile)
+        outputs['outputDirectory'] = outfile
         return(outputs)
 
 
@@ -265,24 +295,223 @@ class WmClusterRemoveOutliersTask(SingularityTask):
     container_cmd = 'wm_cluster_remove_outliers.py'
     input_spec = WmClusterRemoveOutliersInputSpec
     output_spec = WmClusterRemoveOutliersOutputSpec
+    default_memory_gb = 4.0
+    history_params = ['clusterOutlierStd']
 
     def _list_outputs(self):
         outputs = self.output_spec().get()
-        outfile = os.path.join(self.inputs.outputDirectory,
+        outfile = os.path.join(self._output_path('outputDirectory'),
                                '_outlier_removed')
-        outputs['outputDirectory'] = os.path.abspath(outfile)
+        outputs['outputDirectory'] = outfile
         return(outputs)
 
+
+class WmClusterRemoveOutliersShardedInputSpec(
+        WmClusterRemoveOutliersInputSpec):
+    numWorkers = traits.Int(4, usedefault=True, nohash=True,
+                            desc=("Number of shards processed at once, "
+                                  "each in its own container."))
+    numShards = traits.Int(nohash=True,
+                           desc=("Number of shards the clusters are split "
+                                 "into, numWorkers by default."))
+
+
+class WmClusterRemoveOutliersShardedTask(WmClusterRemoveOutliersTask):
+    """
+    Removes cluster outliers with the clusters of inputDirectory split
+    into shards, numWorkers of which run concurrently in their own
+    container.
+
+    Each cluster is compared with its atlas cluster only, so the cluster
+    files are spread over numShards directories, balanced by size, and
+    wm_cluster_remove_outliers.py runs once per shard. The outlier removed
+    clusters of all shards are gathered into the _outlier_removed
+    directory of the serial task. Files every shard writes (logs, scenes)
+    are kept from the first shard.
+
+    The shards are written to the working directory of the node, which
+    must be visible inside the container.
+    """
+    input_spec = WmClusterRemoveOutliersShardedInputSpec
+    output_spec = WmClusterRemoveOutliersOutputSpec
+
+    def _estimate_num_threads(self):
+        return self.inputs.numWorkers
+
+    def _estimate_memory_gb(self):
+        # every container loads the atlas
+        return self.default_memory_gb * self.inputs.numWorkers
+
+    def _num_shards(self):
+        if isdefined(self.inputs.numShards):
+            return self.inputs.numShards
+        return self.inputs.numWorkers
+
+    def _shard_task(self, in_dir, out_dir):
+        """Returns the serial task for one shard, running in the image,
+        staged inputs and instance of this task"""
+        names = WmClusterRemoveOutliersInputSpec.class_trait_names()
+        inputs = dict((name, value) for name, value
+                      in self.inputs.get_traitsfree().items()
+                      if name in names and name not in ('container_command',
+                                                        'history_db'))
+        # the shards are recorded as one run of this task
+        inputs['profile'] = self._measured()
+        inputs['inputDirectory'] = in_dir
+        inputs['outputDirectory'] = out_dir
+        task = WmClusterRemoveOutliersTask(**inputs)
+        task._image = self._image
+        task._staged = self._staged
+        return task
+
+    def _make_shards(self, shard_dir):
+        """Links the clusters of inputDirectory into the shards, largest
+        first into the least loaded one. Returns the input and output
+        directory of every shard with clusters."""
+        source = self.inputs.inputDirectory
+        source = self._staged.get(source, source)
+        names = sorted(os.listdir(source))
+        clusters = [name for name in names if name.endswith('.vtp')]
+        others = [name for name in names if name not in clusters
+                  and os.path.isfile(os.path.join(source, name))]
+        sizes = sorted(((os.path.getsize(os.path.join(source, name)), name)
+                        for name in clusters), reverse=True)
+        loads = [(0, index, []) for index in range(self._num_shards())]
+        for size, name in sizes:
+            load, index, members = heapq.heappop(loads)
+            members.append(name)
+            heapq.heappush(loads, (load + size, index, members))
+
+        # the subject id of the outputs is the name of inputDirectory
+        base = os.path.basename(self.inputs.inputDirectory.rstrip(os.sep))
+        if os.path.isdir(shard_dir):
+            shutil.rmtree(shard_dir)
+        shards = []
+        for _, index, members in sorted(loads, key=lambda load: load[1]):
+            if not members:
+                continue
+            root = os.path.join(shard_dir, 'shard%03d' % index)
+            in_dir = os.path.join(root, base)
+            os.makedirs(in_dir)
+            for name in members + others:
+                link_file(os.path.join(source, name),
+                          os.path.join(in_dir, name))
+            if self.inputs.inputDirectory.endswith(os.sep):
+                in_dir += os.sep
+            shards.append((in_dir, os.path.join(root, 'out')))
+        return shards
+
+    def _run_shard(self, task, runtime, runner):
+        if runner is None:
+            return task._run_command(runtime)
+        set_runner(runner)
+        with runner.lock:
+            return task._run_command(runtime)
+
+    def _gather(self, runtime, out_dirs):
+        """Moves the shard outputs into outputDirectory, the outlier
+        removed clusters into its _outlier_removed directory"""
+        target = self._list_outputs()['outputDirectory']
+        # outputs are written below the scratch working directory when
+        # staging, they are moved to the node directory afterwards
+        cwd = os.getcwd()
+        if runtime.cwd != cwd and target.startswith(cwd + os.sep):
+            target = os.path.join(runtime.cwd, os.path.relpath(target, cwd))
+        top = os.path.dirname(target)
+        for out_dir in out_dirs:
+            for root, _, files in os.walk(out_dir):
+                rel = os.path.relpath(root, out_dir)
+                first = rel.split(os.sep)[0]
+                if first.endswith('_outlier_removed'):
+                    dst_dir = os.path.normpath(
+                        os.path.join(target, os.path.relpath(
+                            root, os.path.join(out_dir, first))))
+                else:
+                    dst_dir = os.path.normpath(os.path.join(top, rel))
+                if not os.path.isdir(dst_dir):
+                    os.makedirs(dst_dir)
+                for name in files:
+                    dst = os.path.join(dst_dir, name)
+                    if not os.path.exists(dst):
+                        shutil.move(os.path.join(root, name), dst)
+        if not os.path.isdir(target):
+            os.makedirs(target)
+
+    def _run_command(self, runtime):
+        shard_dir = os.path.join(runtime.cwd, 'outlier_shards')
+        shards = self._make_shards(shard_dir)
+        tasks = []
+        runtimes = []
+        for in_dir, out_dir in shards:
+            tasks.append(self._shard_task(in_dir, out_dir))
+            shard_runtime = Bunch(**runtime.dictcopy())
+            shard_runtime.cwd = os.path.dirname(out_dir)
+            shard_runtime.environ = dict(runtime.environ)
+            runtimes.append(shard_runtime)
+
+        # under the asyncio plugin the shards run on its event loop, the
+        # node releases the runner lock while it waits for them
+        runner = current_runner()
+        with ThreadPoolExecutor(max(self.inputs.numWorkers, 1)) as pool:
+            futures = [pool.submit(self._run_shard, task, shard_runtime,
+                                   runner)
+                       for task, shard_runtime in zip(tasks, runtimes)]
+            if runner is None:
+                wait(futures)
+            else:
+                with runner.unlocked():
+                    wait(futures)
+        for future in futures:
+            future.result()
+
+        self._gather(runtime, [out_dir for _, out_dir in shards])
+        for index, shard_runtime in enumerate(runtimes):
+            log = os.path.join(shard_runtime.cwd, 'container.log')
+            if os.path.exists(log):
+                shutil.move(log, os.path.join(
+                    runtime.cwd, 'container.shard%03d.log' % index))
+        shutil.rmtree(shard_dir)
+        self._record_shards([task._profile for task in tasks])
+        runtime.cmdline = '\n'.join(r.cmdline for r in runtimes)
+        runtime.returncode = 0
+        for name in ('stdout', 'stderr', 'merged'):
+            setattr(runtime, name, '\n'.join(
+                r.get(name) or '' for r in runtimes))
+        return runtime
+
+    def _record_shards(self, profiles):
+        """Records the shards in the profile of this task, as one
+        container run from the first start to the last exit"""
+        profiles = [p for p in profiles if p.exited is not None]
+        if not profiles:
+            return
+        profile = self._profile
+        profile.spawned = min(p.spawned for p in profiles)
+        profile.exited = max(p.exited for p in profiles)
+        firsts = [p.first_output for p in profiles if p.first_output]
+        profile.first_output = min(firsts) if firsts else None
+        first = profile.first_output or profile.exited
+        profile.add('startup', first - profile.spawned)
+        profile.add('tool', profile.exited - first)
+        if self._measured():
+            # the shards run at once, their peaks add up at worst
+            profile.peak_rss_mb = round(sum(p.peak_rss_mb or 0.0
+                                            for p in profiles), 1)
+            profile.cpu_s = round(sum(p.cpu_s or 0.0 for p in profiles), 3)
+
+
 class WmClusterByHemisphereInputSpec(SingularityInputSpec):
     """Inputs for wm_separate_clusters_by_hemisphere.py"""
     inputDirectory = SingularityDir(desc=("A directory of clustered"
                                     "whole-brain tractography as vtkPolyData"
                                     "(.vpk or .vtp)."),
                                     exists=True,
-                                    position=1)
+                                    position=1,
+                                    argstr='%s')
     outputDirectory = SingularityDir(desc=("The output directory will be "
                                            "created if it doesnt exist."),
-                                     postion=2,
+                                     position=2,
+                                     argstr='%s',
                                      name_source=['inputDirectory'],
                                      name_template='%s_ClusterByHemi/')
     version = traits.Bool(desc="Show programs version and exit",
@@ -297,7 +526,7 @@ class WmClusterByHemisphereInputSpec(SingularityInputSpec):
                                  "hemisphere or the other), while a lower "
                                  "number will be stricter about what is "
                                  "classified as commissural."),
-                           argstr="-pthresh %d")
+                           argstr="-pthresh %f")
     atlasMRML = File(desc=("A MRML file defining the atlas clusters, "
                            "to be copied into all directories."),
                      argstr="-atlasMRML %s")
@@ -330,17 +559,182 @@ class WmClusterByHemisphereTask(SingularityTask):
 
     def _list_outputs(self):
         outputs = self.output_spec().get()
+        output_dir = self._output_path('outputDirectory')
 
-        outfile = os.path.join(self.inputs.outputDirectory,
-                               'tracts_commissural')
-        outputs['commissural_tracts'] = os.path.abspath(outfile)
+        outfile = os.path.join(output_dir, 'tracts_commissural')
+        outputs['commissural_tracts'] = outfile
 
-        outfile = os.path.join(self.inputs.outputDirectory,
-                               'tracts_left_hemisphere')
-        outputs['left_hemi_tracts'] = os.path.abspath(outfile)
+        outfile = os.path.join(output_dir, 'tracts_left_hemisphere')
+        outputs['left_hemi_tracts'] = outfile
 
-        outfile = os.path.join(self.inputs.outputDirectory,
-                               'tracts_right_hemisphere')
-        outputs['right_hemi_tracts'] = os.path.abspath(outfile)
+        outfile = os.path.join(output_dir, 'tracts_right_hemisphere')
+        outputs['right_hemi_tracts'] = outfile
 
         return(outputs)
+
+
+class WmBatchTask(SingularityTask):
+    """
+    Runs a whitematteranalysis task over a list of subjects in one
+    container session. The atlas is loaded once and shared by a pool of
+    batchJobs workers inside the container (see scripts/wma_batch.py).
+    Outputs are lists, in the same order as the subjects.
+
+    Subclasses set:
+    task_class: the single subject task
+    subject_input: the single subject input, filled from subjects_input
+    preload_polydata: inputs naming atlas polydata (files or directories)
+    preload_atlas: inputs naming atlas directories
+    """
+    container_cmd = 'python %s' % BATCH_SCRIPT
+    progress_markers = ITERATION_MARKERS
+    task_class = None
+    subject_input = None
+    subjects_input = None
+    preload_polydata = []
+    preload_atlas = []
+
+    def _common_inputs(self):
+        """Returns the inputs shared by every single subject task"""
+        names = self.task_class.input_spec.class_trait_names()
+        return dict((name, value) for name, value
+                    in self.inputs.get_traitsfree().items()
+                    if name in names and name != 'container_command')
+
+    def _subject_task(self, subject):
+        """Returns the single subject task for one subject"""
+        inputs = self._common_inputs()
+        inputs[self.subject_input] = subject
+        return self.task_class(**inputs)
+
+    def _estimate_num_threads(self):
+        task = self.task_class(**self._common_inputs())
+        return task.num_threads * self.inputs.batchJobs
+
+    def _estimate_memory_gb(self):
+        task = self.task_class(**self._common_inputs())
+        return task.estimated_memory_gb * self.inputs.batchJobs
+
+    def _get_binds(self):
+        binds = super(WmBatchTask, self)._get_binds()
+        binds.append(os.path.dirname(BATCH_SCRIPT))
+        return binds
+
+    def _preload_args(self, flag, names):
+        args = []
+        for name in names:
+            value = getattr(self.inputs, name)
+            if not isdefined(value):
+                continue
+            spec = self.inputs.trait(name)
+            if spec.is_trait_type(SingularityFile) \
+            or spec.is_trait_type(SingularityDir):
+                value = self._mount_table().to_container(value)
+            args.append('%s %s' % (flag, value))
+        return args
+
+    def _parse_inputs(self, skip=None):
+        # only the mounts, container and driver are rendered here, the
+        # subject arguments are rendered by the single subject tasks
+        base_names = SingularityInputSpec.class_trait_names()
+        skip = list(skip or []) + [name for name in self.inputs.trait_names()
+                                   if name not in base_names]
+        args = super(WmBatchTask, self)._parse_inputs(skip=skip)
+        args.append('--jobs %d' % self.inputs.batchJobs)
+        args.extend(self._preload_args('--polydata', self.preload_polydata))
+        args.extend(self._preload_args('--atlas', self.preload_atlas))
+        args.append('--')
+        for subject in getattr(self.inputs, self.subjects_input):
+            task = self._subject_task(subject)
+            subject_args = task._parse_inputs(skip=['container',
+                                                    'map_dirs_list',
+                                                    'container_command'])
+            args.append(quote(' '.join([task.container_cmd] + subject_args)))
+        return args
+
+    def _list_outputs(self):
+        outputs = self.output_spec().get()
+        for name in outputs:
+            outputs[name] = []
+        for subject in getattr(self.inputs, self.subjects_input):
+            subject_outputs = self._subject_task(subject)._list_outputs()
+            for name in outputs:
+                outputs[name].append(subject_outputs[name])
+        return outputs
+
+
+class WmRegisterToAtlasNewBatchInputSpec(WmRegisterToAtlasNewInputSpec):
+    inputSubjects = InputMultiPath(SingularityFile(exists=True),
+                                   mandatory=True,
+                                   desc=("Whole-brain tractography of each "
+                                         "subject (.vtk or .vtp)"))
+    batchJobs = traits.Int(1, usedefault=True,
+                           desc=("Number of subjects processed in parallel "
+                                 "inside the container."))
+
+
+class WmRegisterToAtlasNewBatchOutputSpec(TraitedSpec):
+    outputFile = OutputMultiPath(File(), desc="Registered tracts")
+    outputDirectory = OutputMultiPath(Directory(), desc="Output directories")
+
+
+class WmRegisterToAtlasNewBatchTask(WmBatchTask):
+    """Registers several subjects to the atlas in one container session"""
+    input_spec = WmRegisterToAtlasNewBatchInputSpec
+    output_spec = WmRegisterToAtlasNewBatchOutputSpec
+    task_class = WmRegisterToAtlasNewTask
+    subject_input = 'inputSubject'
+    subjects_input = 'inputSubjects'
+    preload_polydata = ['inputAtlas']
+    references_ = WmRegisterToAtlasNewTask.references_
+
+
+class WmClusterFromAtlasBatchInputSpec(WmClusterFromAtlasInputSpec):
+    inputFiles = InputMultiPath(SingularityFile(exists=True),
+                                mandatory=True,
+                                desc=("Whole-brain tractography of each "
+                                      "subject (.vtk or .vtp)"))
+    batchJobs = traits.Int(1, usedefault=True,
+                           desc=("Number of subjects processed in parallel "
+                                 "inside the container."))
+
+
+class WmClusterFromAtlasBatchOutputSpec(TraitedSpec):
+    outputDirectory = OutputMultiPath(Directory(), desc="Clustered tracts.")
+
+
+class WmClusterFromAtlasBatchTask(WmBatchTask):
+    """Clusters several subjects from the atlas in one container session"""
+    input_spec = WmClusterFromAtlasBatchInputSpec
+    output_spec = WmClusterFromAtlasBatchOutputSpec
+    task_class = WmClusterFromAtlasTask
+    subject_input = 'inputFile'
+    subjects_input = 'inputFiles'
+    preload_atlas = ['atlasDirectory']
+    references_ = WmClusterFromAtlasTask.references_
+
+
+class WmClusterRemoveOutliersBatchInputSpec(WmClusterRemoveOutliersInputSpec):
+    inputDirectories = InputMultiPath(SingularityDir(exists=True),
+                                      mandatory=True,
+                                      desc=("Directory of subject clusters "
+                                            "(.vtp) for each subject"))
+    batchJobs = traits.Int(1, usedefault=True,
+                           desc=("Number of subjects processed in parallel "
+                                 "inside the container."))
+
+
+class WmClusterRemoveOutliersBatchOutputSpec(TraitedSpec):
+    outputDirectory = OutputMultiPath(Directory(), desc="Clustered tracts.")
+
+
+class WmClusterRemoveOutliersBatchTask(WmBatchTask):
+    """Removes cluster outliers for several subjects in one container
+    session, the atlas and its cluster files are loaded once"""
+    input_spec = WmClusterRemoveOutliersBatchInputSpec
+    output_spec = WmClusterRemoveOutliersBatchOutputSpec
+    task_class = WmClusterRemoveOutliersTask
+    subject_input = 'inputDirectory'
+    subjects_input = 'inputDirectories'
+    preload_polydata = ['atlasDirectory']
+    preload_atlas = ['atlasDirectory']
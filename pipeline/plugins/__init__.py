@@ -0,0 +1,2 @@
+from .aio import AsyncioPlugin
+from .pipelined import PipelinedPlugin
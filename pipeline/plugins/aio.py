@@ -0,0 +1,92 @@
+"""
+Nipype plugin driving many container nodes from one process.
+
+Each node runs in a thread of the workflow process and its container
+commands are run on an asyncio event loop, so waiting on hundreds of
+containers does not cost a python worker process each.
+Example:
+>>> wf.run(plugin=AsyncioPlugin(plugin_args={'max_procs': 200}))
+"""
+
+import threading
+
+from nipype import logging
+from nipype.pipeline.plugins.base import (DistributedPluginBase,
+                                          report_crash)
+from nipype.pipeline.plugins.multiproc import run_node
+
+from ..utils.asyncrun import AsyncRunner, set_runner
+
+logger = logging.getLogger('workflow')
+
+
+class AsyncioPlugin(DistributedPluginBase):
+    """Runs nodes in threads and their containers on an event loop.
+
+    Only one node at a time executes python code (input hashing, output
+    collection, ...), the others are waiting on their container. Host
+    side nodes that compute a lot are better run with MultiProc.
+
+    Currently supported options are:
+
+    - max_procs: maximum number of containers running at once (64)
+    - max_jobs: maximum number of nodes in flight at once
+    """
+
+    def __init__(self, plugin_args=None):
+        super(AsyncioPlugin, self).__init__(plugin_args=plugin_args)
+        self.max_procs = 64
+        if plugin_args and 'max_procs' in plugin_args:
+            self.max_procs = plugin_args['max_procs']
+        self._runner = None
+        self._taskresult = {}
+        self._threads = {}
+        self._taskid = 0
+        self._timeout = 2.0
+
+    def run(self, graph, config, updatehash=False):
+        self._runner = AsyncRunner(self.max_procs)
+        self._runner.lock.acquire()
+        try:
+            return super(AsyncioPlugin, self).run(graph, config,
+                                                  updatehash=updatehash)
+        finally:
+            # containers still running after an error are terminated
+            self._runner.close()
+            self._runner.lock.release()
+
+    def _run_node(self, node, updatehash, taskid):
+        set_runner(self._runner)
+        with self._runner.lock:
+            result = run_node(node, updatehash, taskid)
+        self._taskresult[taskid] = result
+        self._runner.wake()
+
+    def _submit_job(self, node, updatehash=False):
+        self._taskid += 1
+        thread = threading.Thread(target=self._run_node,
+                                  args=(node, updatehash, self._taskid))
+        thread.daemon = True
+        self._threads[self._taskid] = thread
+        thread.start()
+        return self._taskid
+
+    def _wait(self):
+        if self._config['execution']['poll_sleep_duration']:
+            self._timeout = float(
+                self._config['execution']['poll_sleep_duration'])
+        self._runner.wait(self._timeout)
+
+    def _get_result(self, taskid):
+        return self._taskresult.get(taskid)
+
+    def _clear_task(self, taskid):
+        del self._taskresult[taskid]
+        self._threads.pop(taskid).join()
+
+    def _report_crash(self, node, result=None):
+        if result and result['traceback']:
+            node._result = result['result']
+            node._traceback = result['traceback']
+            return report_crash(node, traceback=result['traceback'])
+        return report_crash(node)
@@ -0,0 +1,284 @@
+"""
+Nipype plugin running the stages of a workflow as a pipeline over subjects.
+
+The nodes of a workflow iterating over subjects are grouped into stages
+(UKF, registration, clustering, ...). Each stage has its own pool of
+workers and a bounded input queue. A node is only started when every
+later stage it feeds has room in its queue for its outputs, so UKF runs
+for subject N+1 while subject N is registered and clustered, but tract
+files do not pile up on scratch waiting for registration. The cores of
+the host are shared by all stages and ready nodes of later stages are
+started first, so cores move to whichever stage has work as the pipeline
+fills and drains. Nodes run in threads as with AsyncioPlugin.
+
+The utilization of every stage is logged when the workflow ends, and
+written to report_file when given.
+Example:
+>>> wf.run(plugin=PipelinedPlugin(plugin_args={'stages': STAGES,
+...                                            'n_procs': 32}))
+"""
+
+import json
+import time
+from multiprocessing import cpu_count
+
+import numpy as np
+from nipype import logging
+
+from .aio import AsyncioPlugin
+
+logger = logging.getLogger('workflow')
+
+
+class Stage(object):
+    """Nodes sharing a pool of workers and an input queue.
+
+    Parameters
+    ----------
+    name : string
+        Name of the stage in the report.
+    nodes : list of strings
+        Names of the nodes of the stage, as given to Node.
+    workers : int
+        Nodes of the stage running at once, unlimited when None.
+    queue : int
+        Nodes of the stage waiting for a worker, counting those whose
+        inputs are being produced by earlier stages, unlimited when None.
+    """
+
+    def __init__(self, name, nodes=None, workers=None, queue=None):
+        self.name = name
+        self.nodes = list(nodes or [])
+        self.workers = None if workers is None else max(workers, 1)
+        self.queue = None if queue is None else max(queue, 1)
+        # later stages are started first, nodes of no stage before any
+        self.rank = float('inf')
+        self.running = set()
+        self.jobs = 0
+        self.busy_s = 0.0
+        self.core_s = 0.0
+        self.queued_s = 0.0
+        self.max_queue = 0
+        self.blocked_s = 0.0
+
+    def report(self, wall, n_procs):
+        wall = max(wall, 1e-9)
+        mean_running = self.busy_s / wall
+        utilization = None
+        if self.workers is not None:
+            utilization = mean_running / self.workers
+        return {'nodes': self.nodes,
+                'workers': self.workers,
+                'queue': self.queue,
+                'jobs': self.jobs,
+                'busy_s': self.busy_s,
+                'mean_running': mean_running,
+                'utilization': utilization,
+                'core_share': self.core_s / (wall * n_procs),
+                'mean_queue': self.queued_s / wall,
+                'max_queue': self.max_queue,
+                'blocked_s': self.blocked_s}
+
+
+class PipelinedPlugin(AsyncioPlugin):
+    """Runs nodes in threads, started stage by stage as a pipeline.
+
+    Currently supported options are:
+
+    - stages: list of dictionaries of Stage arguments, in pipeline order.
+      Nodes of no stage get an unlimited stage of their own.
+    - n_procs: cores shared by all stages (all cores of the host). A node
+      takes as many as its interface num_threads, and runs alone when it
+      wants more than are free.
+    - report_file: JSON file the stage utilization is written to
+    - max_procs, max_jobs: as for AsyncioPlugin
+    """
+
+    def __init__(self, plugin_args=None):
+        super(PipelinedPlugin, self).__init__(plugin_args=plugin_args)
+        plugin_args = plugin_args or {}
+        self.n_procs = plugin_args.get('n_procs') or cpu_count()
+        self.report_file = plugin_args.get('report_file')
+        self._stage_specs = plugin_args.get('stages') or []
+        self.stages = None
+        self.stage_report = None
+
+    def run(self, graph, config, updatehash=False):
+        self.stages = [Stage(**spec) for spec in self._stage_specs]
+        self._by_node = {}
+        for rank, stage in enumerate(self.stages):
+            stage.rank = rank
+            for name in stage.nodes:
+                self._by_node[name] = stage
+        # running jobs, mapped to their stage, cores and start time
+        self._started = {}
+        self._held = None
+        self._waiting = {}
+        self._blocked = set()
+        self._begin = self._tick = time.time()
+        try:
+            return super(PipelinedPlugin, self).run(graph, config,
+                                                    updatehash=updatehash)
+        finally:
+            self._report()
+
+    def _stage(self, jobid):
+        jobid = self.mapnodesubids.get(jobid, jobid)
+        name = self.procs[jobid].name
+        stage = self._by_node.get(name)
+        if stage is None:
+            stage = Stage(name, [name])
+            self.stages.append(stage)
+            self._by_node[name] = stage
+        return stage
+
+    def _cores(self, jobid):
+        threads = getattr(self.procs[jobid]._interface, 'num_threads', 1)
+        return min(max(threads or 1, 1), self.n_procs)
+
+    def _fed_stages(self, jobid):
+        """Returns the other stages the outputs of jobid go to"""
+        stage = self._stage(jobid)
+        fed = set(self._stage(child)
+                  for child in self.depidx[jobid].nonzero()[1])
+        fed.discard(stage)
+        return fed
+
+    def _ready_jobs(self):
+        return np.flatnonzero((self.proc_done == False) &
+                              (self.depidx.sum(axis=0) == 0).__array__())
+
+    def _account(self, now, waiting):
+        """Adds the queue lengths of the last interval to the totals"""
+        elapsed = now - self._tick
+        for stage, count in self._waiting.items():
+            stage.queued_s += count * elapsed
+        for stage in self._blocked:
+            stage.blocked_s += elapsed
+        for stage, count in waiting.items():
+            stage.max_queue = max(stage.max_queue, count)
+        self._waiting = waiting
+        self._tick = now
+
+    def _send_procs_to_workers(self, updatehash=False, graph=None):
+        now = time.time()
+        ready = self._ready_jobs()
+        waiting = {}
+        for jobid in ready:
+            stage = self._stage(jobid)
+            waiting[stage] = waiting.get(stage, 0) + 1
+        self._account(now, dict(waiting))
+
+        free = self.n_procs
+        feeding = {}
+        for jobid, (_, cores, _) in self._started.items():
+            free -= cores
+            for fed in self._fed_stages(jobid):
+                feeding[fed] = feeding.get(fed, 0) + 1
+
+        held = []
+        blocked = set()
+        for jobid in sorted(ready, key=lambda jobid: (-self._stage(jobid).rank,
+                                                      jobid)):
+            stage = self._stage(jobid)
+            cores = self._cores(jobid)
+            fed = self._fed_stages(jobid)
+            if stage.workers is not None \
+            and len(stage.running) >= stage.workers:
+                held.append(jobid)
+                continue
+            if cores > free and self._started:
+                held.append(jobid)
+                continue
+            if any(other.queue is not None and
+                   waiting.get(other, 0) + feeding.get(other, 0) >=
+                   other.queue for other in fed):
+                held.append(jobid)
+                blocked.add(stage)
+                continue
+            stage.running.add(jobid)
+            waiting[stage] -= 1
+            free -= cores
+            for other in fed:
+                feeding[other] = feeding.get(other, 0) + 1
+            self._started[jobid] = (stage, cores, now)
+        self._blocked = blocked
+
+        # held jobs look submitted to the base class, and so do the jobs
+        # that become ready when a node is found cached and finishes on
+        # the spot, see _task_finished_cb
+        self._held = held
+        self.proc_done[held] = True
+        try:
+            super(PipelinedPlugin, self)._send_procs_to_workers(
+                updatehash=updatehash, graph=graph)
+        finally:
+            self.proc_done[self._held] = False
+            self._held = None
+        self._reconcile(now)
+
+    def _reconcile(self, now):
+        """Tracks the jobs submitted without going through the stages,
+        the nodes of expanded MapNodes, and forgets admitted MapNodes
+        that were expanded rather than submitted"""
+        for jobid in list(self._started):
+            if not self.proc_pending[jobid]:
+                stage, _, _ = self._started.pop(jobid)
+                stage.running.discard(jobid)
+        for jobid in np.flatnonzero(self.proc_pending):
+            if jobid not in self._started:
+                stage = self._stage(jobid)
+                stage.running.add(jobid)
+                self._started[jobid] = (stage, self._cores(jobid), now)
+
+    def _finished(self, jobid):
+        started = self._started.pop(jobid, None)
+        if started is None:
+            return
+        stage, cores, start = started
+        elapsed = time.time() - start
+        stage.running.discard(jobid)
+        stage.jobs += 1
+        stage.busy_s += elapsed
+        stage.core_s += elapsed * cores
+
+    def _task_finished_cb(self, jobid):
+        children = self.depidx[jobid].nonzero()[1]
+        super(PipelinedPlugin, self)._task_finished_cb(jobid)
+        self._finished(jobid)
+        if self._held is None:
+            return
+        # the base class would start them right away
+        for child in children:
+            if not self.proc_done[child] \
+            and self.depidx[:, child].sum() == 0:
+                self.proc_done[child] = True
+                self._held.append(child)
+
+    def _clean_queue(self, jobid, graph, result=None):
+        self._finished(jobid)
+        return super(PipelinedPlugin, self)._clean_queue(jobid, graph,
+                                                         result=result)
+
+    def _report(self):
+        if self.stages is None:
+            return
+        self._account(time.time(), {})
+        wall = self._tick - self._begin
+        report = dict((stage.name, stage.report(wall, self.n_procs))
+                      for stage in self.stages)
+        self.stage_report = {'wall_s': wall, 'n_procs': self.n_procs,
+                             'stages': report}
+        for stage in self.stages:
+            entry = report[stage.name]
+            busy = entry['utilization']
+            logger.info('Stage %s: %d jobs, %s busy, %.0f%% of the cores, '
+                        'queue %.1f (max %d), blocked %.0fs' % (
+                            stage.name, entry['jobs'],
+                            'n/a' if busy is None else '%.0f%%' % (
+                                100 * busy),
+                            100 * entry['core_share'], entry['mean_queue'],
+                            entry['max_queue'], entry['blocked_s']))
+        if self.report_file:
+            with open(self.report_file, 'w') as f:
+                json.dump(self.stage_report, f, indent=2, sort_keys=True)
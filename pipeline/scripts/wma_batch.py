@@ -0,0 +1,123 @@
+#!/usr/bin/env python
+"""
+Runs a whitematteranalysis script over several subjects in one container
+session. This script is executed inside the whitematteranalysis container.
+
+Atlas polydata is read once, before any subject is processed, and the
+whitematteranalysis readers are patched to return the loaded copy.
+Every subject runs in a freshly forked process so the atlas is shared
+copy on write and subjects cannot affect each other.
+Example:
+$ python wma_batch.py --jobs 4 --polydata /opt/atlases/atlas.vtp -- \\
+      'wm_register_to_atlas_new.py /input/s1.vtk /opt/atlases/atlas.vtp s1/' \\
+      'wm_register_to_atlas_new.py /input/s2.vtk /opt/atlases/atlas.vtp s2/'
+"""
+
+import os
+import sys
+import glob
+import time
+import runpy
+import shlex
+import shutil
+import argparse
+import multiprocessing
+from multiprocessing.connection import wait
+
+import whitematteranalysis as wma
+
+_polydata = {}
+_atlases = {}
+
+
+def preload(polydata_paths, atlas_paths):
+    """Loads the atlas files and replaces the wma readers with versions
+    returning the preloaded objects"""
+    read_polydata = wma.io.read_polydata
+    load_atlas = wma.cluster.load_atlas
+
+    def cached_read_polydata(filename, *args, **kwargs):
+        key = os.path.abspath(filename)
+        if key in _polydata:
+            return _polydata[key]
+        return read_polydata(filename, *args, **kwargs)
+
+    def cached_load_atlas(path, atlas_name, *args, **kwargs):
+        key = (os.path.abspath(path), atlas_name)
+        if key in _atlases:
+            return _atlases[key]
+        return load_atlas(path, atlas_name, *args, **kwargs)
+
+    for path in polydata_paths:
+        if os.path.isdir(path):
+            files = sorted(glob.glob(os.path.join(path, '*.vtp')))
+        else:
+            files = [path]
+        for filename in files:
+            _polydata[os.path.abspath(filename)] = read_polydata(filename)
+    for path in atlas_paths:
+        _atlases[(os.path.abspath(path), 'atlas')] = load_atlas(path, 'atlas')
+
+    wma.io.read_polydata = cached_read_polydata
+    wma.cluster.load_atlas = cached_load_atlas
+
+
+def run_subject(command):
+    """Runs a wma script in this process, as if from the command line"""
+    argv = shlex.split(command)
+    script = shutil.which(argv[0]) or argv[0]
+    sys.argv = [script] + argv[1:]
+    try:
+        runpy.run_path(script, run_name='__main__')
+    except SystemExit as e:
+        sys.exit(e.code)
+    sys.exit(0)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--jobs', type=int, default=1,
+                        help='Number of subjects processed in parallel.')
+    parser.add_argument('--polydata', action='append', default=[],
+                        help=('Polydata file, or directory of .vtp files, '
+                              'to load once.'))
+    parser.add_argument('--atlas', action='append', default=[],
+                        help='Atlas directory to load once.')
+    parser.add_argument('commands', nargs='+',
+                        help='One quoted command line per subject.')
+    args = parser.parse_args()
+
+    start = time.time()
+    preload(args.polydata, args.atlas)
+    print('Preloaded atlas in %.1fs' % (time.time() - start))
+    sys.stdout.flush()
+
+    # processes are not daemonic so the wma scripts can use their own pools
+    pending = list(enumerate(args.commands))
+    running = []
+    failed = []
+    while pending or running:
+        while pending and len(running) < max(1, args.jobs):
+            index, command = pending.pop(0)
+            proc = multiprocessing.Process(target=run_subject,
+                                           args=(command,))
+            proc.start()
+            running.append((index, command, proc))
+        # whichever subject ends first frees its slot
+        ended = wait([proc.sentinel for _, _, proc in running])
+        for index, command, proc in [job for job in running
+                                     if job[2].sentinel in ended]:
+            running.remove((index, command, proc))
+            proc.join()
+            if proc.exitcode:
+                failed.append(index)
+                print('Subject %d failed (%d): %s' % (index, proc.exitcode,
+                                                      command))
+            else:
+                print('Subject %d done: %s' % (index, command))
+        sys.stdout.flush()
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
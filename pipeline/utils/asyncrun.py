@@ -0,0 +1,152 @@
+"""
+Running container commands on an asyncio event loop.
+
+An AsyncRunner owns every container process started by the tasks of a
+workflow. Processes are created with asyncio.create_subprocess_exec, at
+most max_procs at a time, and their output is streamed line by line to
+the LogStreamer of the task. Tasks run their nipype bookkeeping in
+lightweight threads that share the runner lock, released only while they
+wait for their container, so the working directory changes made by
+nipype never race. The event loop itself is driven by the thread calling
+AsyncRunner.wait, see pipeline.plugins.aio.
+"""
+
+import os
+import asyncio
+import threading
+from contextlib import contextmanager
+
+_local = threading.local()
+
+# seconds a cancelled container is given to exit before it is killed
+TERMINATE_TIMEOUT = 10
+
+
+def current_runner():
+    """Returns the runner of the calling thread, or None"""
+    return getattr(_local, 'runner', None)
+
+
+def set_runner(runner):
+    _local.runner = runner
+
+
+def _current_task():
+    if hasattr(asyncio, 'current_task'):
+        return asyncio.current_task()
+    return asyncio.Task.current_task()
+
+
+class AsyncRunner(object):
+    """Runs commands on an event loop shared by many threads.
+
+    Parameters
+    ----------
+    max_procs : int
+        Maximum number of commands running at once.
+
+    Must be created by the thread that will drive the loop with wait,
+    usually the main thread, which child processes are reported to.
+    """
+
+    def __init__(self, max_procs=64):
+        self.max_procs = max_procs
+        self.lock = threading.Lock()
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        self._semaphore = asyncio.Semaphore(max_procs)
+        self._wake = asyncio.Event()
+        self._tasks = set()
+
+    @contextmanager
+    def unlocked(self):
+        """Releases the lock, restoring the working directory after"""
+        cwd = os.getcwd()
+        self.lock.release()
+        try:
+            yield
+        finally:
+            self.lock.acquire()
+            os.chdir(cwd)
+
+    def wake(self):
+        """Ends the current wait early, can be called from any thread"""
+        self.loop.call_soon_threadsafe(self._wake.set)
+
+    def wait(self, timeout):
+        """Runs the event loop until woken or timeout seconds pass.
+        Must be called by the thread owning the loop, holding the lock."""
+        with self.unlocked():
+            try:
+                self.loop.run_until_complete(
+                    asyncio.wait_for(self._wake.wait(), timeout))
+            except asyncio.TimeoutError:
+                pass
+        self._wake.clear()
+
+    def run(self, args, cwd, env, streamer):
+        """Runs args in cwd, streaming output to streamer. Blocks the
+        calling thread, with the lock released, until the command exits.
+        Returns its exit code."""
+        future = asyncio.run_coroutine_threadsafe(
+            self._run(args, cwd, env, streamer), self.loop)
+        with self.unlocked():
+            return future.result()
+
+    async def _read(self, name, stream, streamer):
+        while True:
+            raw = await stream.readline()
+            if not raw:
+                break
+            streamer.feed(name, raw)
+
+    async def _run(self, args, cwd, env, streamer):
+        task = _current_task()
+        self._tasks.add(task)
+        try:
+            async with self._semaphore:
+                streamer.begin(' '.join(args))
+                proc = await asyncio.create_subprocess_exec(
+                    *args, cwd=cwd, env=env,
+                    stdout=asyncio.subprocess.PIPE,
+                    stderr=asyncio.subprocess.PIPE)
+                streamer.attach(proc.pid)
+                try:
+                    await asyncio.gather(
+                        self._read('stdout', proc.stdout, streamer),
+                        self._read('stderr', proc.stderr, streamer))
+                    returncode = await proc.wait()
+                except asyncio.CancelledError:
+                    await self._terminate(proc)
+                    raise
+                streamer.exit(returncode)
+                streamer.finish(returncode)
+                return returncode
+        finally:
+            self._tasks.discard(task)
+            streamer.close()
+
+    async def _terminate(self, proc):
+        if proc.returncode is not None:
+            return
+        proc.terminate()
+        try:
+            await asyncio.wait_for(proc.wait(), TERMINATE_TIMEOUT)
+        except asyncio.TimeoutError:
+            proc.kill()
+            await proc.wait()
+
+    def cancel(self):
+        """Cancels all running commands and waits for them to exit.
+        Must be called by the thread owning the loop."""
+        tasks = list(self._tasks)
+        for task in tasks:
+            task.cancel()
+        if tasks:
+            self.loop.run_until_complete(
+                asyncio.gather(*tasks, return_exceptions=True))
+
+    def close(self):
+        self.cancel()
+        self.loop.close()
+        asyncio.set_event_loop(None)
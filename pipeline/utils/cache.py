@@ -0,0 +1,316 @@
+"""
+A content addressed cache for container task outputs.
+
+Entries are keyed on the digest of the container image, the command line
+and the contents of the input files, so a rebuilt container or a changed
+input is never served stale results while unrelated changes to a workflow
+do not cause expensive tasks to be rerun.
+
+Outputs are cloned (reflinked where the file system supports it, copied
+otherwise) into and out of the cache, so tools rewriting their inputs in
+place never change a cache entry. Restoring holds a shared lock on the
+entry, which eviction skips.
+"""
+
+import os
+import json
+import time
+import errno
+import fcntl
+import shutil
+import hashlib
+import tempfile
+
+from nipype import logging
+
+iflogger = logging.getLogger('interface')
+
+# linux ioctl for copy on write clones (btrfs, xfs)
+_FICLONE = 0x40049409
+_BLOCK_SIZE = 1 << 20
+
+# digests of files already hashed by this process, keyed on (path, stat)
+_digests = {}
+
+
+def stat_key(path):
+    """Returns the real path, size and mtime of path, which change when
+    the file is replaced"""
+    st = os.stat(path)
+    return (os.path.realpath(path), st.st_size, st.st_mtime)
+
+
+def file_digest(path):
+    """Returns the sha1 digest of a file's contents, memoised on the
+    file's size and modification time"""
+    key = stat_key(path)
+    if key not in _digests:
+        sha = hashlib.sha1()
+        with open(path, 'rb') as f:
+            for block in iter(lambda: f.read(_BLOCK_SIZE), b''):
+                sha.update(block)
+        _digests[key] = sha.hexdigest()
+    return _digests[key]
+
+
+def dir_digest(path):
+    """Returns a digest of every file name and content below path"""
+    sha = hashlib.sha1()
+    for root, dirs, files in os.walk(path):
+        dirs.sort()
+        for name in sorted(files):
+            full = os.path.join(root, name)
+            sha.update(os.path.relpath(full, path).encode('utf-8'))
+            sha.update(file_digest(full).encode('ascii'))
+    return sha.hexdigest()
+
+
+def path_digest(path):
+    """Returns a digest for a file or directory"""
+    if os.path.isdir(path):
+        return dir_digest(path)
+    return file_digest(path)
+
+
+def link_file(src, dst):
+    """Makes dst a hardlink of src, falling back to a reflink and then a
+    copy when src is on a different device"""
+    try:
+        os.link(src, dst)
+        return
+    except OSError as e:
+        if e.errno not in (errno.EXDEV, errno.EPERM, errno.EMLINK):
+            raise
+    try:
+        with open(src, 'rb') as s, open(dst, 'wb') as d:
+            fcntl.ioctl(d.fileno(), _FICLONE, s.fileno())
+        return
+    except (IOError, OSError):
+        pass
+    shutil.copy2(src, dst)
+
+
+def clone_file(src, dst):
+    """Makes dst a reflink of src, falling back to a copy, so dst never
+    shares its data with src"""
+    try:
+        with open(src, 'rb') as s, open(dst, 'wb') as d:
+            fcntl.ioctl(d.fileno(), _FICLONE, s.fileno())
+        shutil.copystat(src, dst)
+        return
+    except (IOError, OSError):
+        pass
+    shutil.copy2(src, dst)
+
+
+def clone_tree(src, dst):
+    """Clones a file, or every file in a directory tree, from src to dst"""
+    if not os.path.isdir(src):
+        clone_file(src, dst)
+        return
+    for root, dirs, files in os.walk(src):
+        target = os.path.join(dst, os.path.relpath(root, src))
+        if not os.path.isdir(target):
+            os.makedirs(target)
+        for name in files:
+            clone_file(os.path.join(root, name), os.path.join(target, name))
+
+
+def tree_size(path):
+    """Returns the size of a file, or of all files below a directory"""
+    if not os.path.isdir(path):
+        return os.path.getsize(path)
+    return sum(os.path.getsize(os.path.join(root, name))
+               for root, _, files in os.walk(path) for name in files)
+
+
+class ResultCache(object):
+    """Stores task outputs in cache_dir.
+
+    Each entry is a directory named after its key holding the cloned
+    outputs, a manifest.json and a .lock file. The manifest modification
+    time is used as the last access time for least recently used
+    eviction. Restores hold a shared lock on .lock, eviction skips the
+    entries it cannot lock exclusively.
+
+    Parameters
+    ----------
+    cache_dir : string
+        Directory holding the cache, can be shared between hosts.
+    max_size_gb : float
+        Least recently used entries are evicted once the cache grows
+        beyond this size.
+    """
+
+    def __init__(self, cache_dir, max_size_gb=50.0):
+        self.cache_dir = os.path.abspath(cache_dir)
+        self.max_size = int(max_size_gb * (1 << 30))
+        if not os.path.isdir(self.cache_dir):
+            os.makedirs(self.cache_dir)
+
+    def image_digest(self, image):
+        """Returns the sha1 digest of a container image. Images are large,
+        so digests are remembered in the cache directory and only
+        recomputed when the image is modified."""
+        path = os.path.join(self.cache_dir, 'image_digests.json')
+        key = '%s:%d:%f' % stat_key(image)
+        with open(path + '.lock', 'w') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            known = {}
+            if os.path.exists(path):
+                with open(path) as f:
+                    known = json.load(f)
+            if key not in known:
+                known[key] = file_digest(image)
+                with open(path, 'w') as f:
+                    json.dump(known, f)
+            fcntl.flock(lock, fcntl.LOCK_UN)
+        return known[key]
+
+    @staticmethod
+    def make_key(*parts):
+        """Returns a cache key from a sequence of strings"""
+        sha = hashlib.sha1()
+        for part in parts:
+            sha.update(part.encode('utf-8'))
+            sha.update(b'\0')
+        return sha.hexdigest()
+
+    def _entry(self, key):
+        return os.path.join(self.cache_dir, key[:2], key)
+
+    @staticmethod
+    def _lock(entry):
+        """Returns the lock file of entry locked shared, None when there
+        is no such entry or it was evicted while waiting for the lock"""
+        path = os.path.join(entry, '.lock')
+        try:
+            lock = open(path)
+        except (IOError, OSError):
+            return None
+        fcntl.flock(lock, fcntl.LOCK_SH)
+        try:
+            if os.path.samestat(os.fstat(lock.fileno()), os.stat(path)):
+                return lock
+        except OSError:
+            pass
+        lock.close()
+        return None
+
+    def restore(self, key, outputs):
+        """Clones the cached outputs for key to the paths in outputs,
+        a dictionary of output name to path or list of paths.
+        Returns True if the key was found."""
+        entry = self._entry(key)
+        lock = self._lock(entry)
+        if lock is None:
+            return False
+        with lock:
+            return self._restore(key, entry, outputs)
+
+    def _restore(self, key, entry, outputs):
+        manifest_file = os.path.join(entry, 'manifest.json')
+        try:
+            with open(manifest_file) as f:
+                manifest = json.load(f)
+        except (IOError, OSError, ValueError):
+            return False
+        targets = flatten_outputs(outputs)
+        if sorted(targets) != sorted(manifest['outputs']):
+            return False
+        for name, paths in targets.items():
+            stored = manifest['outputs'][name]
+            if len(stored) != len(paths):
+                return False
+            for src, dst in zip(stored, paths):
+                if src is None:
+                    continue
+                if os.path.lexists(dst):
+                    if os.path.isdir(dst):
+                        shutil.rmtree(dst)
+                    else:
+                        os.remove(dst)
+                parent = os.path.dirname(dst)
+                if parent and not os.path.isdir(parent):
+                    os.makedirs(parent)
+                clone_tree(os.path.join(entry, src), dst)
+        os.utime(manifest_file, None)
+        iflogger.info('Restored cached outputs %s', key)
+        return True
+
+    def store(self, key, outputs):
+        """Adds the existing paths in outputs to the cache under key"""
+        if os.path.exists(self._entry(key)):
+            return
+        parent = os.path.dirname(self._entry(key))
+        if not os.path.isdir(parent):
+            os.makedirs(parent)
+        tmp = tempfile.mkdtemp(dir=parent, prefix='.tmp')
+        manifest = {'outputs': {}, 'size': 0, 'created': time.time()}
+        for name, paths in flatten_outputs(outputs).items():
+            stored = []
+            for index, path in enumerate(paths):
+                if path is None or not os.path.exists(path):
+                    stored.append(None)
+                    continue
+                rel = os.path.join(name, str(index),
+                                   os.path.basename(path.rstrip('/')))
+                os.makedirs(os.path.dirname(os.path.join(tmp, rel)))
+                clone_tree(path, os.path.join(tmp, rel))
+                manifest['size'] += tree_size(path)
+                stored.append(rel)
+            manifest['outputs'][name] = stored
+        with open(os.path.join(tmp, 'manifest.json'), 'w') as f:
+            json.dump(manifest, f)
+        open(os.path.join(tmp, '.lock'), 'w').close()
+        try:
+            os.rename(tmp, self._entry(key))
+        except OSError:
+            # another process stored the same result first
+            shutil.rmtree(tmp, ignore_errors=True)
+        self.evict()
+
+    def evict(self):
+        """Removes least recently used entries until the cache fits,
+        skipping those being restored"""
+        entries = []
+        total = 0
+        for prefix in os.listdir(self.cache_dir):
+            prefix_dir = os.path.join(self.cache_dir, prefix)
+            if not os.path.isdir(prefix_dir):
+                continue
+            for key in os.listdir(prefix_dir):
+                manifest_file = os.path.join(prefix_dir, key, 'manifest.json')
+                try:
+                    with open(manifest_file) as f:
+                        size = json.load(f)['size']
+                    used = os.path.getmtime(manifest_file)
+                except (IOError, OSError, ValueError, KeyError):
+                    continue
+                entries.append((used, size, os.path.join(prefix_dir, key)))
+                total += size
+        for used, size, entry in sorted(entries):
+            if total <= self.max_size:
+                break
+            try:
+                lock = open(os.path.join(entry, '.lock'))
+            except (IOError, OSError):
+                continue
+            with lock:
+                try:
+                    fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except (IOError, OSError):
+                    continue
+                shutil.rmtree(entry, ignore_errors=True)
+            total -= size
+
+
+def flatten_outputs(outputs):
+    """Returns outputs as name -> list of paths, dropping undefined ones"""
+    flat = {}
+    for name, value in outputs.items():
+        if isinstance(value, (list, tuple)):
+            flat[name] = [v if isinstance(v, str) else None for v in value]
+        elif isinstance(value, str):
+            flat[name] = [value]
+    return flat
@@ -0,0 +1,260 @@
+"""
+A persisted index of the input files of every subject of a cohort.
+
+Globbing the SelectFiles templates of every subject on a network file
+system costs a directory scan per subject and node. The index is built by
+one parallel scan of the subject directories and kept in a JSON file with
+the size and mtime of each file. Later updates stat the subject
+directories, in parallel, and only rescan those whose directories changed,
+so new, changed and removed subjects are found in one stat per subject and
+one scan per change. CohortFiles (pipeline.interfaces.cohort) then looks
+files up in the index instead of globbing.
+
+The subject id must name a directory, the templates all below it:
+>>> index = CohortIndex('cohort.json', '/scratch/twright/data',
+...                     {'dwi': 'dtiprep/{subject_id}/{subject_id}_0[1,2]_'
+...                             'DTI60-1000_20_Ax-DTI-60plus5_QCed.nrrd'})
+>>> added, changed, removed = index.update()
+>>> index.subjects()
+['SPN01_CMH_0001_01', ...]
+
+$ python -m pipeline.utils.cohort cohort.json /scratch/twright/data \\
+      --template dwi='dtiprep/{subject_id}/...'
+"""
+
+import os
+import sys
+import json
+import argparse
+import tempfile
+import threading
+from fnmatch import fnmatchcase
+from concurrent.futures import ThreadPoolExecutor
+
+VERSION = 1
+
+# indexes read by this process, keyed on their path
+_loaded = {}
+_loaded_lock = threading.Lock()
+
+
+def _split_template(template):
+    """Splits a template into the directory holding the subject
+    directories, the name of a subject directory and the pattern of the
+    files below it"""
+    parts = template.split('/')
+    for index, part in enumerate(parts):
+        if '{subject_id}' in part:
+            return ('/'.join(parts[:index]), part,
+                    '/'.join(parts[index + 1:]))
+    raise ValueError('Template %s has no {subject_id} directory' % template)
+
+
+def _write_json(path, data):
+    """Replaces path atomically, readers never see a partial index"""
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)),
+                               prefix='.cohort')
+    try:
+        with os.fdopen(fd, 'w') as f:
+            json.dump(data, f)
+        os.rename(tmp, path)
+    except Exception:
+        os.remove(tmp)
+        raise
+
+
+def load_index(path):
+    """Returns the index in path, parsed once per process and version of
+    the file"""
+    stat = os.stat(path)
+    key = (stat.st_size, stat.st_mtime)
+    with _loaded_lock:
+        cached = _loaded.get(path)
+        if cached is not None and cached[0] == key:
+            return cached[1]
+    with open(path) as f:
+        data = json.load(f)
+    with _loaded_lock:
+        _loaded[path] = (key, data)
+    return data
+
+
+class CohortIndex(object):
+    """Subject id to input files index.
+
+    Parameters
+    ----------
+    path : string
+        JSON file the index is kept in.
+    base_directory : string
+        Directory the templates are relative to.
+    templates : dict
+        SelectFiles templates, keyed on output name.
+    workers : int
+        Number of directories stat'ed and scanned in parallel.
+    """
+
+    def __init__(self, path, base_directory, templates, workers=16):
+        self.path = os.path.abspath(path)
+        self.base_directory = os.path.abspath(base_directory)
+        self.templates = dict(templates)
+        self.workers = workers
+        splits = set(_split_template(t)[:2]
+                     for t in self.templates.values())
+        if len(splits) != 1:
+            raise ValueError('Templates must share the subject directory: '
+                             '%s' % ', '.join(sorted(templates.values())))
+        parent, name = splits.pop()
+        self._parent = os.path.join(self.base_directory, parent)
+        self._prefix, _, self._suffix = name.partition('{subject_id}')
+        if '{subject_id}' in self._suffix:
+            raise ValueError('Subject directory %s names the subject twice'
+                             % name)
+        self._patterns = dict((key, _split_template(template)[2])
+                              for key, template in self.templates.items())
+        self._data = None
+
+    def _load(self):
+        if self._data is None:
+            data = None
+            if os.path.exists(self.path):
+                # the parsed index is shared, subjects are replaced whole
+                data = dict(load_index(self.path))
+            # an index of other templates is rebuilt
+            if data is None or data.get('version') != VERSION \
+            or data.get('base_directory') != self.base_directory \
+            or data.get('templates') != self.templates:
+                data = {'version': VERSION,
+                        'base_directory': self.base_directory,
+                        'templates': self.templates,
+                        'subjects': {}}
+            self._data = data
+        return self._data
+
+    def _candidates(self):
+        """Returns the subject ids with a directory, from one listing"""
+        if not os.path.isdir(self._parent):
+            return {}
+        subjects = {}
+        end = len(self._suffix)
+        for name in os.listdir(self._parent):
+            if len(name) <= len(self._prefix) + end \
+            or not name.startswith(self._prefix) \
+            or not name.endswith(self._suffix):
+                continue
+            subject = name[len(self._prefix):len(name) - end]
+            subjects[subject] = os.path.join(self._parent, name)
+        return subjects
+
+    @staticmethod
+    def _unchanged(entry, subject_dir):
+        """Tells whether no directory of an indexed subject was modified"""
+        try:
+            return all(
+                os.stat(os.path.join(subject_dir, rel)).st_mtime == mtime
+                for rel, mtime in entry['dirs'].items())
+        except OSError:
+            return False
+
+    def _scan(self, subject, subject_dir):
+        """Returns the index entry of one subject"""
+        dirs = {}
+        files = dict((key, []) for key in self._patterns)
+        patterns = dict((key, pattern.format(subject_id=subject))
+                        for key, pattern in self._patterns.items())
+        for root, _, names in os.walk(subject_dir):
+            rel_root = os.path.relpath(root, subject_dir)
+            dirs[rel_root] = os.stat(root).st_mtime
+            for name in names:
+                rel = os.path.normpath(os.path.join(rel_root, name))
+                for key, pattern in patterns.items():
+                    if not fnmatchcase(rel, pattern):
+                        continue
+                    path = os.path.join(root, name)
+                    try:
+                        stat = os.stat(path)
+                    except OSError:
+                        continue
+                    files[key].append([path, stat.st_size, stat.st_mtime])
+        for matches in files.values():
+            matches.sort()
+        return {'dirs': dirs, 'files': files}
+
+    def _refresh(self, subject, subject_dir, entry, full):
+        if entry is not None and not full \
+        and self._unchanged(entry, subject_dir):
+            return subject, entry, False
+        return subject, self._scan(subject, subject_dir), True
+
+    def update(self, full=False):
+        """Brings the index up to date and saves it. Returns the lists of
+        added, changed and removed subjects.
+
+        Files rewritten in place do not change the mtime of their
+        directory, full rescans every subject to pick them up.
+        """
+        data = self._load()
+        indexed = data['subjects']
+        candidates = self._candidates()
+        with ThreadPoolExecutor(self.workers) as pool:
+            results = list(pool.map(
+                lambda item: self._refresh(item[0], item[1],
+                                           indexed.get(item[0]), full),
+                sorted(candidates.items())))
+        added = []
+        changed = []
+        subjects = {}
+        for subject, entry, scanned in results:
+            subjects[subject] = entry
+            if subject not in indexed:
+                added.append(subject)
+            elif scanned and entry['files'] != indexed[subject]['files']:
+                changed.append(subject)
+        removed = sorted(set(indexed) - set(subjects))
+        data['subjects'] = subjects
+        # rescanned subjects have new directory mtimes even when their
+        # files are the same
+        if removed or any(scanned for _, _, scanned in results) \
+        or not os.path.exists(self.path):
+            _write_json(self.path, data)
+        return added, changed, removed
+
+    def subjects(self, complete=True):
+        """Returns the indexed subject ids, only those with files for
+        every template unless complete is False"""
+        subjects = self._load()['subjects']
+        return sorted(subject for subject, entry in subjects.items()
+                      if not complete or all(entry['files'].values()))
+
+    def files(self, subject, key):
+        """Returns the files of subject matching the template key"""
+        return [path for path, _, _ in
+                self._load()['subjects'][subject]['files'][key]]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.
+                                     RawDescriptionHelpFormatter)
+    parser.add_argument('index')
+    parser.add_argument('base_directory')
+    parser.add_argument('--template', action='append', default=[],
+                        metavar='KEY=TEMPLATE',
+                        help=('SelectFiles template, those of the index '
+                              'when not given.'))
+    parser.add_argument('--workers', type=int, default=16)
+    parser.add_argument('--full', action='store_true',
+                        help='Rescan every subject.')
+    args = parser.parse_args()
+    templates = dict(t.split('=', 1) for t in args.template)
+    if not templates:
+        templates = load_index(args.index)['templates']
+    index = CohortIndex(args.index, args.base_directory, templates,
+                        workers=args.workers)
+    added, changed, removed = index.update(full=args.full)
+    sys.stdout.write('%d subjects, %d added, %d changed, %d removed\n' % (
+        len(index.subjects()), len(added), len(changed), len(removed)))
+
+
+if __name__ == '__main__':
+    main()
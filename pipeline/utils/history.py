@@ -0,0 +1,328 @@
+"""
+A database of container runs, used to predict the cost of new ones.
+
+With history_db set SingularityTask appends a record of every container
+run to an SQLite database: the image and its digest, the tool, key
+parameters, the size of the inputs and amount of work, the wall time and
+exit status, and for profiled runs the CPU time, peak memory and output
+size. Failed runs are recorded but not predicted from. Records are queued
+in memory and written in batches by a background thread, a run only pays
+for appending to a list. The database can then be asked for the expected
+cost of a task:
+
+>>> history = get_history('/archive/runs.db')
+>>> task = UKFTractographyTask(dwiFile=dwi, seedsPerVoxel=5, ...)
+>>> history.predict(task)
+{'runs': 12, 'exact': True, 'wall_s': 5130.2, 'cpu_s': 40211.0, ...}
+
+A summary of the recorded runs per tool:
+$ python -m pipeline.utils.history /archive/runs.db
+"""
+
+import os
+import sys
+import json
+import time
+import atexit
+import socket
+import sqlite3
+import argparse
+import threading
+from statistics import median
+from contextlib import closing
+import multiprocessing
+from multiprocessing import util
+
+from nipype import logging
+
+from .cache import stat_key, file_digest
+
+iflogger = logging.getLogger('interface')
+
+_SCHEMA = ["""
+CREATE TABLE IF NOT EXISTS runs (
+    id INTEGER PRIMARY KEY,
+    time REAL,
+    host TEXT,
+    image TEXT,
+    image_digest TEXT,
+    interface TEXT,
+    tool TEXT,
+    params TEXT,
+    input_bytes INTEGER,
+    work REAL,
+    num_threads INTEGER,
+    wall_s REAL,
+    cpu_s REAL,
+    peak_rss_mb REAL,
+    output_bytes INTEGER,
+    returncode INTEGER)""",
+           "CREATE INDEX IF NOT EXISTS runs_interface "
+           "ON runs (interface, params)",
+           """
+CREATE TABLE IF NOT EXISTS images (
+    path TEXT,
+    size INTEGER,
+    mtime REAL,
+    digest TEXT,
+    PRIMARY KEY (path, size, mtime))"""]
+
+_FIELDS = ('time', 'host', 'image', 'image_digest', 'interface', 'tool',
+           'params', 'input_bytes', 'work', 'num_threads', 'wall_s',
+           'cpu_s', 'peak_rss_mb', 'output_bytes', 'returncode')
+
+# most recent runs a prediction is made from
+PREDICT_RUNS = 50
+
+
+class RunHistory(object):
+    """Runs recorded in an SQLite database.
+
+    Parameters
+    ----------
+    path : string
+        Database file, created if it does not exist. It may be shared by
+        the processes of a workflow and between hosts on a local disk,
+        SQLite locking is not reliable on most network file systems.
+    batch_size : int
+        Records queued before they are written, by the thread recording
+        the last one, without waiting for the next flush.
+    flush_interval : float
+        Seconds between writes of the queued records.
+    """
+
+    def __init__(self, path, batch_size=64, flush_interval=5.0):
+        self.path = os.path.abspath(path)
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self._pending = []
+        self._lock = threading.Lock()
+        self._write_lock = threading.Lock()
+        self._wake = threading.Event()
+        self._writer = None
+        self._created = False
+
+    def _connect(self):
+        db = sqlite3.connect(self.path, timeout=60, isolation_level=None)
+        if not self._created:
+            # processes starting together would otherwise race to create
+            # the tables
+            db.execute('BEGIN IMMEDIATE')
+            for statement in _SCHEMA:
+                db.execute(statement)
+            db.execute('COMMIT')
+            db.execute('PRAGMA journal_mode=WAL')
+            self._created = True
+        return db
+
+    def record(self, **fields):
+        """Queues a run, see _FIELDS for the recorded fields. params is a
+        dictionary of the key parameters of the run."""
+        fields.setdefault('time', time.time())
+        fields.setdefault('host', socket.gethostname())
+        fields['params'] = json.dumps(fields.get('params') or {},
+                                      sort_keys=True)
+        with self._lock:
+            self._pending.append(fields)
+            full = len(self._pending) >= self.batch_size
+            if self._writer is None:
+                self._writer = threading.Thread(target=self._write_loop)
+                self._writer.daemon = True
+                self._writer.start()
+        if full:
+            self.try_flush()
+
+    def _write_loop(self):
+        while True:
+            self._wake.wait(self.flush_interval)
+            self._wake.clear()
+            self.try_flush()
+
+    def try_flush(self):
+        """Flushes, logging rather than raising errors, recording runs
+        must never fail them"""
+        try:
+            self.flush()
+        except (sqlite3.Error, OSError) as err:
+            iflogger.warning('Could not write run history to %s: %s',
+                             self.path, err)
+
+    def flush(self):
+        """Writes the queued runs in one transaction"""
+        with self._write_lock:
+            with self._lock:
+                pending, self._pending = self._pending, []
+            if not pending:
+                return
+            digests = {}
+            with closing(self._connect()) as db:
+                # digests are resolved here, off the hot path and before
+                # the database is locked for writing
+                for fields in pending:
+                    image = fields.get('image')
+                    if image and not fields.get('image_digest'):
+                        if image not in digests:
+                            digests[image] = self._image_digest(db, image)
+                        fields['image_digest'] = digests[image]
+                db.execute('BEGIN IMMEDIATE')
+                try:
+                    db.executemany(
+                        'INSERT INTO runs (%s) VALUES (%s)' % (
+                            ', '.join(_FIELDS),
+                            ', '.join('?' * len(_FIELDS))),
+                        [tuple(fields.get(name) for name in _FIELDS)
+                         for fields in pending])
+                except Exception:
+                    db.execute('ROLLBACK')
+                    raise
+                db.execute('COMMIT')
+
+    def _image_digest(self, db, image):
+        """Returns the digest of an image, hashing each version of an
+        image only once for every process sharing the database"""
+        name, ext = os.path.splitext(os.path.basename(image))
+        # copies in an ImageCache are named after their digest
+        if ext in ('.img', '.sandbox') and len(name) == 40 \
+        and all(c in '0123456789abcdef' for c in name):
+            return name
+        if not os.path.isfile(image):
+            return None
+        path, size, mtime = stat_key(image)
+        row = db.execute('SELECT digest FROM images WHERE path = ? AND '
+                         'size = ? AND mtime = ?',
+                         (path, size, mtime)).fetchone()
+        if row is not None:
+            return row[0]
+        digest = file_digest(image)
+        db.execute('INSERT OR REPLACE INTO images VALUES (?, ?, ?, ?)',
+                   (path, size, mtime, digest))
+        return digest
+
+    def runs(self, interface, params=None, limit=PREDICT_RUNS):
+        """Returns the most recent runs of an interface as dictionaries,
+        only those with exactly params when given"""
+        self.flush()
+        query = 'SELECT %s FROM runs WHERE interface = ?' % ', '.join(
+            _FIELDS)
+        args = [interface]
+        if params is not None:
+            query += ' AND params = ?'
+            args.append(json.dumps(params, sort_keys=True))
+        query += ' ORDER BY time DESC LIMIT ?'
+        args.append(limit)
+        with closing(self._connect()) as db:
+            rows = db.execute(query, args).fetchall()
+        runs = [dict(zip(_FIELDS, row)) for row in rows]
+        for run in runs:
+            run['params'] = json.loads(run['params'])
+        return runs
+
+    def predict(self, task, num_threads=None):
+        """Predicts the cost of running task with num_threads threads,
+        by default the threads the task asks for.
+
+        Runs with the same key parameters are used when there are any,
+        otherwise every run of the interface (exact is then False). Wall
+        time, CPU time, memory and output size are scaled by the amount of
+        work of the task relative to the earlier runs, wall time also by
+        the number of threads. Returns None without earlier runs.
+        """
+        def usable(runs):
+            return [run for run in runs if run['work'] and run['wall_s']
+                    and not run['returncode']]
+
+        interface = type(task).__name__
+        exact = True
+        runs = usable(self.runs(interface, task._history_params()))
+        if not runs:
+            exact = False
+            runs = usable(self.runs(interface))
+        if not runs:
+            return None
+        work = task._estimate_work()
+        threads = num_threads or task.num_threads
+
+        def scaled(name, per_thread=False):
+            values = [run[name] / run['work'] *
+                      ((run['num_threads'] or 1) if per_thread else 1)
+                      for run in runs if run[name] is not None]
+            if not values:
+                return None
+            value = median(values) * work
+            return value / threads if per_thread else value
+
+        return {'runs': len(runs),
+                'exact': exact,
+                'work': work,
+                'num_threads': threads,
+                'wall_s': scaled('wall_s', per_thread=True),
+                'cpu_s': scaled('cpu_s'),
+                'peak_rss_mb': scaled('peak_rss_mb'),
+                'output_bytes': scaled('output_bytes')}
+
+    def rates(self):
+        """Returns the core seconds (wall time of the tool times its
+        threads) and bytes written per unit of work of every interface,
+        as pipeline.utils.planning.history_rates"""
+        self.flush()
+        with closing(self._connect()) as db:
+            rows = db.execute(
+                'SELECT interface, COUNT(*), SUM(work), '
+                'SUM(wall_s * COALESCE(num_threads, 1)), '
+                'SUM(output_bytes) FROM runs WHERE work > 0 '
+                'AND wall_s IS NOT NULL '
+                'AND COALESCE(returncode, 0) = 0 '
+                'GROUP BY interface').fetchall()
+        return dict((interface, {'runs': count,
+                                 'work_seconds': seconds / work,
+                                 'work_output_bytes': (out or 0) / work})
+                    for interface, count, work, seconds, out in rows)
+
+    def summary(self):
+        """Returns the number of runs and mean cost of every tool"""
+        self.flush()
+        with closing(self._connect()) as db:
+            return db.execute(
+                'SELECT interface, tool, COUNT(*), AVG(wall_s), AVG(cpu_s), '
+                'MAX(peak_rss_mb), AVG(output_bytes) FROM runs '
+                'WHERE COALESCE(returncode, 0) = 0 '
+                'GROUP BY interface, tool ORDER BY interface').fetchall()
+
+
+_histories = {}
+
+
+def get_history(path):
+    """Returns the history for path shared by this process. Queued runs
+    are written when the process exits."""
+    key = (os.getpid(), os.path.abspath(path))
+    if key not in _histories:
+        batch_size = 64
+        # pool workers (MultiProc) are terminated without running exit
+        # handlers, their runs are written as they are recorded
+        if multiprocessing.current_process().name != 'MainProcess':
+            batch_size = 1
+        history = RunHistory(path, batch_size=batch_size)
+        atexit.register(history.try_flush)
+        util.Finalize(history, history.try_flush, exitpriority=10)
+        _histories[key] = history
+    return _histories[key]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.
+                                     RawDescriptionHelpFormatter)
+    parser.add_argument('database')
+    args = parser.parse_args()
+    sys.stdout.write('%-30s %-34s %6s %10s %10s %9s %9s\n' % (
+        'interface', 'tool', 'runs', 'wall_s', 'cpu_s', 'rss_mb', 'out_mb'))
+    for interface, tool, count, wall, cpu, rss, out in \
+            RunHistory(args.database).summary():
+        sys.stdout.write('%-30s %-34s %6d %10.1f %10.1f %9.1f %9.1f\n' % (
+            interface, tool, count, wall or 0.0, cpu or 0.0, rss or 0.0,
+            (out or 0.0) / (1 << 20)))
+
+
+if __name__ == '__main__':
+    main()
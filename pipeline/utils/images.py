@@ -0,0 +1,272 @@
+"""
+A node local cache of container images.
+
+Images living on archival or network storage are copied once per host into
+the cache directory, and optionally unpacked into a sandbox directory with
+singularity build. Tasks then start their containers from the local copy.
+Entries are named after the image digest, computed from the source while
+copying, and evicted least recently used first once the cache grows
+beyond its size limit.
+
+Images used by a workflow can be copied before it runs:
+$ python -m pipeline.utils.images --cache-dir /local/images \\
+      pipeline.workflows.2tensor:wf
+"""
+
+import os
+import sys
+import json
+import fcntl
+import shutil
+import argparse
+import tempfile
+import importlib
+import subprocess
+from contextlib import contextmanager
+
+from nipype import logging
+
+from .cache import stat_key, tree_size, file_digest
+from .staging import copy_file
+
+iflogger = logging.getLogger('interface')
+
+
+class ImageCache(object):
+    """Local copies of container images.
+
+    The cache directory holds <digest>.img copies, <digest>.sandbox
+    directories and an index.json mapping the path, size and modification
+    time of each source image to its digest, so sources are only read
+    again when they change. The modification time of a copy is its last
+    use. Images are copied and unpacked without holding the index lock,
+    into temporary paths renamed into place. Tasks hold a shared lock on
+    <digest>.lock from get until release, and eviction skips the images
+    it cannot lock.
+
+    Parameters
+    ----------
+    cache_dir : string
+        Node local directory holding the images.
+    max_size_gb : float
+        Least recently used images are removed once the cache grows
+        beyond this size.
+    """
+
+    def __init__(self, cache_dir, max_size_gb=20.0):
+        self.cache_dir = os.path.abspath(cache_dir)
+        self.max_size = int(max_size_gb * (1 << 30))
+        if not os.path.isdir(self.cache_dir):
+            os.makedirs(self.cache_dir)
+        self._index_file = os.path.join(self.cache_dir, 'index.json')
+        # open lock files of the images in use, by returned path
+        self._locks = {}
+
+    @contextmanager
+    def _locked_index(self):
+        with open(self._index_file + '.lock', 'w') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                index = {}
+                if os.path.exists(self._index_file):
+                    with open(self._index_file) as f:
+                        index = json.load(f)
+                yield index
+                with open(self._index_file, 'w') as f:
+                    json.dump(index, f, indent=1, sort_keys=True)
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+    def _image_path(self, digest):
+        return os.path.join(self.cache_dir, digest + '.img')
+
+    def _lock_path(self, digest):
+        return os.path.join(self.cache_dir, digest + '.lock')
+
+    def _verified(self, entry):
+        """Checks a local copy has not changed since it was made, hashing
+        it again only when its size or modification time differ"""
+        path = self._image_path(entry['digest'])
+        if not os.path.exists(path):
+            return False
+        stat = os.stat(path)
+        if [stat.st_size, stat.st_mtime] == entry['local']:
+            return True
+        return file_digest(path) == entry['digest']
+
+    def get(self, image, sandbox=False):
+        """Returns the local copy of image, copying it first if needed.
+        With sandbox the image is also unpacked and the sandbox directory
+        returned. The copy is kept until the path is given to release."""
+        image = os.path.abspath(image)
+        key = '%s:%d:%f' % stat_key(image)
+        copied = None
+        while True:
+            with self._locked_index() as index:
+                entry = index.get(key)
+                if entry is None and copied is not None:
+                    entry = {'source': image, 'digest': copied}
+                    usable = os.path.exists(self._image_path(copied))
+                else:
+                    usable = entry is not None and self._verified(entry)
+                if usable:
+                    # taken under the index lock, which eviction holds too
+                    lock = open(self._lock_path(entry['digest']), 'a')
+                    fcntl.flock(lock, fcntl.LOCK_SH)
+                    path = self._image_path(entry['digest'])
+                    # mark as used, the copy keeps the modification time
+                    # it was given by copystat until now
+                    os.utime(path, None)
+                    stat = os.stat(path)
+                    entry['local'] = [stat.st_size, stat.st_mtime]
+                    index[key] = entry
+                    self._evict(index)
+                    break
+            # copied without the index lock, other images stay available
+            copied = self._copy(image)
+        try:
+            if sandbox:
+                path = self._sandbox(entry['digest'])
+        except Exception:
+            lock.close()
+            raise
+        self._locks.setdefault(path, []).append(lock)
+        return path
+
+    def release(self, path):
+        """Marks an image returned by get as no longer used"""
+        locks = self._locks[path]
+        locks.pop().close()
+        if not locks:
+            del self._locks[path]
+
+    def _copy(self, image):
+        fd, tmp = tempfile.mkstemp(dir=self.cache_dir, suffix='.part')
+        os.close(fd)
+        try:
+            digest = copy_file(image, tmp)
+            os.rename(tmp, self._image_path(digest))
+        except Exception:
+            os.remove(tmp)
+            raise
+        iflogger.info('Cached image %s as %s', image,
+                      self._image_path(digest))
+        return digest
+
+    def _sandbox(self, digest):
+        path = os.path.join(self.cache_dir, digest + '.sandbox')
+        if not os.path.isdir(path):
+            tmp = tempfile.mkdtemp(dir=self.cache_dir, suffix='.part')
+            try:
+                subprocess.check_call(['singularity', 'build', '--force',
+                                       '--sandbox', tmp,
+                                       self._image_path(digest)])
+                os.rename(tmp, path)
+            except OSError:
+                # another task unpacked the same image first
+                if not os.path.isdir(path):
+                    raise
+            finally:
+                shutil.rmtree(tmp, ignore_errors=True)
+        os.utime(path, None)
+        return path
+
+    def _evict(self, index):
+        """Removes least recently used images until the cache fits,
+        skipping those locked by a task. Called with the index locked."""
+        entries = []
+        total = 0
+        for name in os.listdir(self.cache_dir):
+            digest, ext = os.path.splitext(name)
+            if ext not in ('.img', '.sandbox'):
+                continue
+            path = os.path.join(self.cache_dir, name)
+            size = tree_size(path)
+            entries.append((os.path.getmtime(path), size, digest, path))
+            total += size
+        removed = set()
+        for used, size, digest, path in sorted(entries):
+            if total <= self.max_size:
+                break
+            with open(self._lock_path(digest), 'a') as lock:
+                try:
+                    fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except (IOError, OSError):
+                    # in use
+                    continue
+                if os.path.isdir(path):
+                    shutil.rmtree(path, ignore_errors=True)
+                else:
+                    os.remove(path)
+            removed.add(digest)
+            total -= size
+        for digest in removed:
+            if not os.path.exists(self._image_path(digest)) \
+            and not os.path.exists(os.path.join(self.cache_dir,
+                                                digest + '.sandbox')):
+                os.remove(self._lock_path(digest))
+        for key, entry in list(index.items()):
+            if entry['digest'] in removed \
+            and not os.path.exists(self._image_path(entry['digest'])):
+                del index[key]
+
+
+def workflow_images(workflow):
+    """Returns (image, image_cache_dir, sandbox) for every container task
+    of a workflow"""
+    images = set()
+    for node in workflow._get_all_nodes():
+        inputs = node.inputs
+        names = inputs.trait_names()
+        if 'container' not in names or 'image_cache_dir' not in names:
+            continue
+        image = inputs.container
+        if not isinstance(image, str):
+            continue
+        cache_dir = inputs.image_cache_dir
+        images.add((image,
+                    cache_dir if isinstance(cache_dir, str) else None,
+                    bool(inputs.image_sandbox)))
+    return sorted(images, key=lambda item: (item[0], item[1] or ''))
+
+
+def _load(target):
+    """Imports package.module:attribute"""
+    module, attribute = target.split(':', 1)
+    return getattr(importlib.import_module(module), attribute)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.
+                                     RawDescriptionHelpFormatter)
+    parser.add_argument('targets', nargs='+',
+                        help=('Image files or workflows given as '
+                              'package.module:attribute'))
+    parser.add_argument('--cache-dir',
+                        help=('Cache directory, by default the '
+                              'image_cache_dir of each workflow node.'))
+    parser.add_argument('--max-size-gb', type=float, default=20.0)
+    parser.add_argument('--sandbox', action='store_true',
+                        help='Also unpack the images into sandboxes.')
+    args = parser.parse_args()
+
+    images = []
+    for target in args.targets:
+        if ':' in target and not os.path.exists(target):
+            images.extend(workflow_images(_load(target)))
+        else:
+            images.append((target, None, args.sandbox))
+    for image, cache_dir, sandbox in images:
+        cache_dir = args.cache_dir or cache_dir
+        if cache_dir is None:
+            sys.stderr.write('No cache directory for %s\n' % image)
+            continue
+        cache = ImageCache(cache_dir, args.max_size_gb)
+        path = cache.get(image, sandbox=sandbox or args.sandbox)
+        cache.release(path)
+        sys.stdout.write('%s -> %s\n' % (image, path))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,163 @@
+"""
+A pool of persistent singularity instances.
+
+Starting a container with `singularity run` mounts the image and sets up the
+namespaces every time. When many short tasks share the same image and bind
+set it is cheaper to start the image once with `singularity instance start`
+and run every command inside it with `singularity exec instance://<name>`.
+
+Instances are system wide (per user) so the pool state lives on disk, which
+lets nipype worker processes share the same instances.
+Example:
+>>> pool = InstancePool()
+>>> with pool:
+...     wf.run(plugin='MultiProc')
+"""
+
+import os
+import time
+import json
+import fcntl
+import atexit
+import hashlib
+import tempfile
+import subprocess
+from contextlib import contextmanager
+
+from nipype import logging
+
+iflogger = logging.getLogger('interface')
+
+DEFAULT_IDLE_TIMEOUT = 600
+
+
+def instance_name(image, binds):
+    """Returns a stable singularity instance name for an image and bind set"""
+    key = '\n'.join([os.path.abspath(image)] + sorted(binds or []))
+    digest = hashlib.sha1(key.encode('utf-8')).hexdigest()[:12]
+    return 'nipype_%s' % digest
+
+
+class InstancePool(object):
+    """Keeps singularity instances alive between tasks.
+
+    The state file maps instance names to the image and binds they were
+    started with, the number of tasks currently using them and the time
+    they were last released. All access is serialised with a file lock.
+
+    Parameters
+    ----------
+    state_dir : string
+        Directory used to hold the pool state, defaults to a per user
+        directory in the system temp dir.
+    idle_timeout : int
+        Instances unused for longer than this (in seconds) are stopped
+        the next time the pool is touched.
+    """
+
+    def __init__(self, state_dir=None, idle_timeout=DEFAULT_IDLE_TIMEOUT):
+        if state_dir is None:
+            state_dir = os.path.join(tempfile.gettempdir(),
+                                     'nipype_singularity_%d' % os.getuid())
+        if not os.path.isdir(state_dir):
+            os.makedirs(state_dir)
+        self.state_dir = state_dir
+        self.idle_timeout = idle_timeout
+        self._state_file = os.path.join(state_dir, 'instances.json')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.shutdown()
+
+    @contextmanager
+    def _locked_state(self):
+        with open(self._state_file + '.lock', 'w') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                state = {}
+                if os.path.exists(self._state_file):
+                    with open(self._state_file) as f:
+                        state = json.load(f)
+                yield state
+                with open(self._state_file, 'w') as f:
+                    json.dump(state, f)
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+    def acquire(self, image, binds=None):
+        """Returns the name of a running instance of image with binds,
+        starting one if needed. Every acquire must be matched by a release.
+        """
+        name = instance_name(image, binds)
+        with self._locked_state() as state:
+            self._evict(state, keep=name)
+            if name not in state or not self._is_running(name):
+                self._start(name, image, binds)
+                state[name] = {'image': image,
+                               'binds': list(binds or []),
+                               'refs': 0}
+            state[name]['refs'] += 1
+            state[name]['last_used'] = time.time()
+        return name
+
+    def release(self, name):
+        """Marks one user of the instance as finished"""
+        with self._locked_state() as state:
+            if name in state:
+                state[name]['refs'] = max(0, state[name]['refs'] - 1)
+                state[name]['last_used'] = time.time()
+
+    def evict_idle(self):
+        """Stops instances that have been idle for longer than idle_timeout"""
+        with self._locked_state() as state:
+            self._evict(state)
+
+    def shutdown(self):
+        """Stops every instance started by the pool"""
+        with self._locked_state() as state:
+            for name in list(state):
+                self._stop(name)
+                del state[name]
+
+    def _evict(self, state, keep=None):
+        now = time.time()
+        for name, info in list(state.items()):
+            if name == keep or info['refs'] > 0:
+                continue
+            if now - info.get('last_used', 0) > self.idle_timeout:
+                self._stop(name)
+                del state[name]
+
+    def _is_running(self, name):
+        proc = subprocess.Popen(['singularity', 'instance', 'list', name],
+                                stdout=subprocess.PIPE,
+                                stderr=subprocess.PIPE)
+        out, _ = proc.communicate()
+        return name in out.decode('utf-8', 'replace')
+
+    def _start(self, name, image, binds):
+        iflogger.info('Starting singularity instance %s for %s', name, image)
+        cmd = ['singularity', 'instance', 'start']
+        for bind in binds or []:
+            cmd.extend(['-B', bind])
+        cmd.extend([image, name])
+        subprocess.check_call(cmd)
+
+    def _stop(self, name):
+        iflogger.info('Stopping singularity instance %s', name)
+        subprocess.call(['singularity', 'instance', 'stop', name])
+
+
+_default_pool = None
+
+
+def get_pool():
+    """Returns the process wide instance pool.
+    Idle instances are cleaned up when the interpreter exits."""
+    global _default_pool
+    if _default_pool is None:
+        _default_pool = InstancePool()
+        atexit.register(_default_pool.evict_idle)
+    return _default_pool
@@ -0,0 +1,177 @@
+"""
+Streaming capture of container output.
+
+Output is read line by line as the container writes it. Every line goes
+to a rotating log file, only a bounded tail is kept in memory, and lines
+matching known progress markers are turned into timestamped events that
+are passed to a callback and appended to a JSON lines file.
+"""
+
+import os
+import re
+import json
+import time
+import logging
+import threading
+import subprocess
+from collections import deque
+from datetime import datetime
+from logging.handlers import RotatingFileHandler
+
+
+class ProgressEvent(dict):
+    """A progress or timing event.
+
+    Keys: time (ISO timestamp), elapsed (seconds since start), event
+    (marker name, or 'start'/'end'), stream and values (named groups of
+    the marker pattern).
+    """
+
+
+class LogStreamer(object):
+    """Runs a shell command, streaming its output.
+
+    Parameters
+    ----------
+    log_file : string
+        Log file, rotated to log_file.1, log_file.2, ... at max_bytes.
+    max_bytes : int
+        Size at which the log file is rotated.
+    tail_lines : int
+        Number of lines kept in memory.
+    markers : list of (name, pattern)
+        Regular expressions identifying progress lines. Named groups are
+        reported in the event values.
+    callback : callable
+        Called with every ProgressEvent.
+    progress_file : string
+        JSON lines file receiving every ProgressEvent.
+    sampler : ProcessSampler
+        Started with the pid of the command and stopped when it exits.
+
+    The start, first output and exit times of the last run are kept in
+    started, first_output and exited.
+    """
+
+    def __init__(self, log_file, max_bytes=100 << 20, tail_lines=200,
+                 markers=None, callback=None, progress_file=None,
+                 backups=3, sampler=None):
+        self.tail_lines = tail_lines
+        self.markers = [(name, re.compile(pattern))
+                        for name, pattern in markers or []]
+        self.callback = callback
+        self.progress_file = progress_file
+        self.sampler = sampler
+        self.started = None
+        self.first_output = None
+        self.exited = None
+        self._tail = deque(maxlen=tail_lines)
+        self._lock = threading.Lock()
+        self._start = None
+        self._progress = None
+        # written to directly, a named logger per run would never be freed
+        self._handler = RotatingFileHandler(log_file, maxBytes=max_bytes,
+                                            backupCount=backups)
+        self._handler.setFormatter(logging.Formatter('%(message)s'))
+
+    def tail(self, stream=None):
+        """Returns the last lines of output, optionally of one stream"""
+        with self._lock:
+            return [line for name, line in self._tail
+                    if stream is None or name == stream]
+
+    def _emit(self, event, stream=None, values=None):
+        now = time.time()
+        record = ProgressEvent(time=datetime.fromtimestamp(now).isoformat(),
+                               elapsed=round(now - self._start, 3),
+                               event=event,
+                               stream=stream,
+                               values=values or {})
+        if self._progress is not None:
+            self._progress.write(json.dumps(record) + '\n')
+            self._progress.flush()
+        if self.callback is not None:
+            self.callback(record)
+
+    def feed(self, name, raw):
+        """Handles one line of output of stream name"""
+        line = raw.decode('utf-8', 'replace').rstrip('\r\n')
+        with self._lock:
+            if self.first_output is None:
+                self.first_output = time.time()
+            self._tail.append((name, line))
+            self._handler.handle(logging.makeLogRecord({
+                'msg': '%s [%s] %s',
+                'args': (datetime.now().isoformat(), name, line)}))
+            for marker, pattern in self.markers:
+                match = pattern.search(line)
+                if match:
+                    self._emit(marker, name, match.groupdict())
+
+    def _read(self, name, pipe):
+        for raw in iter(pipe.readline, b''):
+            self.feed(name, raw)
+        pipe.close()
+
+    def begin(self, cmdline):
+        """Marks the start of a command, before it is started"""
+        self._start = self.started = time.time()
+        self.first_output = self.exited = None
+        if self.progress_file:
+            self._progress = open(self.progress_file, 'a')
+        with self._lock:
+            self._emit('start', values={'cmdline': cmdline})
+
+    def attach(self, pid):
+        """Starts sampling the started process"""
+        if self.sampler is not None:
+            self.sampler.start(pid)
+
+    def exit(self, returncode, usage=None):
+        """Marks the exit of the command, once it has been waited for,
+        with its resource usage if known"""
+        self.exited = time.time()
+        if self.sampler is not None:
+            self.sampler.stop(usage)
+
+    def finish(self, returncode):
+        """Marks the end of the command, once all output has been fed"""
+        with self._lock:
+            self._emit('end', values={'returncode': returncode})
+
+    def close(self):
+        self._handler.close()
+        if self._progress is not None:
+            self._progress.close()
+            self._progress = None
+
+    def run(self, cmdline, cwd=None, env=None):
+        """Runs cmdline through the shell, returns its exit code"""
+        try:
+            self.begin(cmdline)
+            proc = subprocess.Popen(cmdline, shell=True, cwd=cwd, env=env,
+                                    stdout=subprocess.PIPE,
+                                    stderr=subprocess.PIPE)
+            readers = [threading.Thread(target=self._read,
+                                        args=(name, pipe))
+                       for name, pipe in (('stdout', proc.stdout),
+                                          ('stderr', proc.stderr))]
+            for reader in readers:
+                reader.daemon = True
+                reader.start()
+            self.attach(proc.pid)
+            # waited for here to get the resource use of this command
+            # alone, not of all the children of the process
+            _, status, usage = os.wait4(proc.pid, 0)
+            if os.WIFSIGNALED(status):
+                returncode = -os.WTERMSIG(status)
+            else:
+                returncode = os.WEXITSTATUS(status)
+            proc.returncode = returncode
+            self.exit(returncode, usage)
+            for reader in readers:
+                reader.join()
+            self.finish(returncode)
+            return returncode
+        finally:
+            self.close()
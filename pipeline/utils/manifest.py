@@ -0,0 +1,131 @@
+"""
+Fingerprints of directory outputs.
+
+nipype hashes a directory input by its path only, so a node reading the
+output directory of another one is not rerun when that directory changes.
+A manifest of the relative path, size, mtime and content hash of every
+file is written next to each directory output of a SingularityTask
+(<directory>.manifest.json, which nipype keeps as it starts with the
+directory path). The fingerprint of a directory is computed from its
+manifest without writing one: files whose size and mtime are unchanged
+are not read again, so checking an unchanged output directory costs one
+stat per file. Directories without a manifest (inputs from outside the
+workflow) are read in full once per process. The fingerprint is added to
+the hash of the path, a directory that moves still reruns its readers.
+
+Content hashes use xxhash when it is installed and blake2b otherwise.
+Example:
+>>> manifest = write_manifest('subject_ClusterFromAtlas/_outlier_removed')
+>>> fingerprint('subject_ClusterFromAtlas/_outlier_removed')
+'3b1f...'
+"""
+
+import os
+import json
+import hashlib
+import tempfile
+
+try:
+    import xxhash
+except ImportError:
+    xxhash = None
+
+MANIFEST_SUFFIX = '.manifest.json'
+
+# manifests built by fingerprint in this process, by directory
+_built = {}
+
+_BLOCK_SIZE = 1 << 20
+
+if xxhash is not None:
+    HASH_NAME = 'xxh64'
+else:
+    HASH_NAME = 'blake2b'
+
+
+def _new_hash():
+    if xxhash is not None:
+        return xxhash.xxh64()
+    return hashlib.blake2b(digest_size=16)
+
+
+def content_hash(path):
+    """Returns the fast content hash of a file"""
+    digest = _new_hash()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(_BLOCK_SIZE), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def manifest_path(directory):
+    return directory.rstrip(os.sep) + MANIFEST_SUFFIX
+
+
+def load_manifest(directory):
+    """Returns the manifest stored for directory, None when there is none
+    or it was made with another hash"""
+    try:
+        with open(manifest_path(directory)) as f:
+            manifest = json.load(f)
+    except (IOError, OSError, ValueError):
+        return None
+    if manifest.get('hash') != HASH_NAME:
+        return None
+    return manifest
+
+
+def _save(directory, manifest):
+    """Replaces the manifest atomically, tasks fingerprinting the same
+    directory at once never read a partial one"""
+    path = manifest_path(directory)
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)),
+                               prefix='.manifest')
+    try:
+        with os.fdopen(fd, 'w') as f:
+            json.dump(manifest, f)
+        os.rename(tmp, path)
+    except Exception:
+        os.remove(tmp)
+        raise
+
+
+def build_manifest(directory, previous=None):
+    """Returns the manifest of directory. Hashes of files with the size
+    and mtime recorded in previous are reused."""
+    known = (previous or {}).get('files', {})
+    files = {}
+    for root, dirs, names in os.walk(directory):
+        dirs.sort()
+        for name in sorted(names):
+            path = os.path.join(root, name)
+            rel = os.path.relpath(path, directory)
+            stat = os.stat(path)
+            entry = known.get(rel)
+            if entry is not None and entry[0] == stat.st_size \
+            and entry[1] == stat.st_mtime:
+                files[rel] = entry
+                continue
+            files[rel] = [stat.st_size, stat.st_mtime, content_hash(path)]
+    return {'hash': HASH_NAME, 'files': files}
+
+
+def write_manifest(directory):
+    """Writes the manifest of directory next to it and returns it"""
+    manifest = build_manifest(directory, load_manifest(directory))
+    _save(directory, manifest)
+    return manifest
+
+
+def fingerprint(directory):
+    """Returns a digest of the relative paths and contents of the files
+    below directory. The stored manifest is used but never written, the
+    directory may belong to another node or be read only."""
+    key = os.path.abspath(directory)
+    previous = load_manifest(directory) or _built.get(key)
+    manifest = build_manifest(directory, previous)
+    _built[key] = manifest
+    digest = hashlib.md5()
+    for rel, (_, _, hashval) in sorted(manifest['files'].items()):
+        digest.update(('%s\0%s\n' % (rel, hashval)).encode('utf-8'))
+    return digest.hexdigest()
@@ -0,0 +1,87 @@
+"""
+Translation of paths between the host and a container.
+
+Mounts are given as singularity bind strings, 'host[:container[:opts]]'.
+Paths are matched on whole path components, so /data does not match
+/database, and the longest (most deeply nested) mount wins.
+"""
+
+import posixpath
+
+_compiled = {}
+
+
+class _Trie(object):
+    """Maps path component sequences to the path they are mounted at"""
+
+    def __init__(self):
+        self.root = {}
+
+    def add(self, parts, target):
+        node = self.root
+        for part in parts:
+            node = node.setdefault(part, {})
+        node[None] = target
+
+    def translate(self, path):
+        trailing = path.endswith('/') and len(path) > 1
+        parts = _split(path)
+        node = self.root
+        match = node.get(None)
+        depth = 0
+        for i, part in enumerate(parts):
+            node = node.get(part)
+            if node is None:
+                break
+            if None in node:
+                match = node[None]
+                depth = i + 1
+        if match is None:
+            return path
+        result = posixpath.join(match, *parts[depth:])
+        if trailing and not result.endswith('/'):
+            result += '/'
+        return result
+
+
+def _split(path):
+    return [p for p in posixpath.normpath(path).split('/') if p]
+
+
+class MountTable(object):
+    """Bidirectional host <-> container path mapping for a set of mounts"""
+
+    def __init__(self, mounts):
+        self.mounts = tuple(mounts or ())
+        self._to_container = _Trie()
+        self._to_host = _Trie()
+        for mount in self.mounts:
+            fields = mount.split(':')
+            host = fields[0]
+            container = fields[1] if len(fields) > 1 and fields[1] else host
+            self._to_container.add(_split(host), posixpath.normpath(container))
+            self._to_host.add(_split(container), posixpath.normpath(host))
+
+    def to_container(self, path):
+        """Returns the container path of a host path. Paths outside all
+        mounts, or relative paths, are returned unchanged."""
+        if not posixpath.isabs(path):
+            return path
+        return self._to_container.translate(path)
+
+    def to_host(self, path):
+        """Returns the host path of a container path. Paths outside all
+        mounts, or relative paths, are returned unchanged."""
+        if not posixpath.isabs(path):
+            return path
+        return self._to_host.translate(path)
+
+
+def compile_mounts(mounts):
+    """Returns a MountTable, tables are shared between tasks using the same
+    mounts so they are only built once"""
+    key = tuple(mounts or ())
+    table = _compiled.get(key)
+    if table is None:
+        table = _compiled[key] = MountTable(key)
+    return table
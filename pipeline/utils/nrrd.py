@@ -0,0 +1,251 @@
+"""
+Minimal reader and writer for NRRD images.
+
+Only the features written by DTIPrep and Slicer are supported: attached or
+detached headers with raw or gzip encoded data. header_info summarises the
+geometry and diffusion gradients of a file from its header alone, and
+caches the summary until the file changes.
+"""
+
+import os
+import re
+import gzip
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+_TYPES = {'signed char': 'i1', 'int8': 'i1', 'int8_t': 'i1',
+          'uchar': 'u1', 'unsigned char': 'u1', 'uint8': 'u1',
+          'uint8_t': 'u1',
+          'short': 'i2', 'short int': 'i2', 'signed short': 'i2',
+          'signed short int': 'i2', 'int16': 'i2', 'int16_t': 'i2',
+          'ushort': 'u2', 'unsigned short': 'u2',
+          'unsigned short int': 'u2', 'uint16': 'u2', 'uint16_t': 'u2',
+          'int': 'i4', 'signed int': 'i4', 'int32': 'i4', 'int32_t': 'i4',
+          'uint': 'u4', 'unsigned int': 'u4', 'uint32': 'u4',
+          'uint32_t': 'u4',
+          'longlong': 'i8', 'long long': 'i8', 'long long int': 'i8',
+          'signed long long': 'i8', 'signed long long int': 'i8',
+          'int64': 'i8', 'int64_t': 'i8',
+          'ulonglong': 'u8', 'unsigned long long': 'u8',
+          'unsigned long long int': 'u8', 'uint64': 'u8', 'uint64_t': 'u8',
+          'float': 'f4', 'double': 'f8'}
+
+# header fields describing the data layout, not copied between files
+_LAYOUT_FIELDS = ('type', 'encoding', 'endian', 'data file', 'datafile',
+                  'line skip', 'byte skip')
+
+# axis kinds of the image grid
+_SPATIAL_KINDS = ('space', 'domain')
+
+_GRADIENT_KEY = re.compile(r'^DWMRI_gradient_\d+$')
+
+# header summaries, keyed on path and valid for one size and mtime
+_infos = {}
+_infos_lock = threading.Lock()
+
+
+def read_header(path):
+    """Reads the header of a NRRD file.
+
+    Returns
+    -------
+    header : OrderedDict
+        Field names (lower case) mapped to their raw string values,
+        key/value pairs are stored under the 'keyvalue' key.
+    offset : int
+        Byte offset of the data when the header is attached.
+    """
+    header = OrderedDict()
+    keyvalue = OrderedDict()
+    with open(path, 'rb') as f:
+        magic = f.readline()
+        if not magic.startswith(b'NRRD'):
+            raise ValueError('%s is not a NRRD file' % path)
+        while True:
+            line = f.readline()
+            if not line:
+                break
+            line = line.decode('latin-1').rstrip('\r\n')
+            if not line:
+                break
+            if line.startswith('#'):
+                continue
+            if ':=' in line:
+                key, value = line.split(':=', 1)
+                keyvalue[key] = value
+            elif ': ' in line:
+                key, value = line.split(': ', 1)
+                header[key.strip().lower()] = value.strip()
+        offset = f.tell()
+    header['keyvalue'] = keyvalue
+    return header, offset
+
+
+def header_shape(header):
+    """Returns the axis sizes in the order they are listed in the header"""
+    return tuple(int(s) for s in header['sizes'].split())
+
+
+def header_dtype(header):
+    """Returns the numpy dtype of the data described by header"""
+    try:
+        code = _TYPES[header['type'].lower()]
+    except KeyError:
+        raise ValueError('Unsupported NRRD type %s' % header['type'])
+    if code[1] != '1':
+        if header.get('endian', 'little') == 'big':
+            code = '>' + code
+        else:
+            code = '<' + code
+    return np.dtype(code)
+
+
+def _parse_vector(value):
+    """Parses a '(x,y,z)' vector, None for 'none'"""
+    value = value.strip()
+    if value == 'none':
+        return None
+    return tuple(float(v) for v in value.strip('()').split(','))
+
+
+def _spatial_axes(header, sizes):
+    """Returns the indices of the image grid axes"""
+    kinds = header.get('kinds', '').split()
+    if len(kinds) == len(sizes):
+        return [axis for axis, kind in enumerate(kinds)
+                if kind in _SPATIAL_KINDS]
+    directions = header.get('space directions', '').split()
+    if len(directions) == len(sizes):
+        return [axis for axis, direction in enumerate(directions)
+                if direction != 'none']
+    # the three largest axes, in header order
+    return sorted(sorted(range(len(sizes)),
+                         key=lambda axis: -sizes[axis])[:3])
+
+
+def _spacing(header, axes):
+    """Returns the voxel size along axes, None when the header has none"""
+    directions = header.get('space directions', '').split()
+    if directions:
+        vectors = [_parse_vector(v) for v in directions]
+        vectors = [v for v in vectors if v is not None]
+        if len(vectors) == len(axes):
+            return tuple(float(np.sqrt(np.dot(v, v))) for v in vectors)
+    spacings = header.get('spacings', '').split()
+    if spacings:
+        values = [float(spacings[axis]) for axis in axes
+                  if axis < len(spacings)]
+        if len(values) == len(axes) and not np.any(np.isnan(values)):
+            return tuple(values)
+    return None
+
+
+def _info(path):
+    header, offset = read_header(path)
+    sizes = header_shape(header)
+    axes = _spatial_axes(header, sizes)
+    keyvalue = header['keyvalue']
+    b_value = keyvalue.get('DWMRI_b-value')
+    data_file = header.get('data file', header.get('datafile'))
+    if data_file is not None:
+        data_file = os.path.join(os.path.dirname(path), data_file)
+    return {'header': header,
+            'offset': offset,
+            'data_file': data_file,
+            'shape': sizes,
+            'spatial_axes': axes,
+            'spatial_shape': tuple(sizes[axis] for axis in axes),
+            'list_axes': [axis for axis in range(len(sizes))
+                          if axis not in axes],
+            'spacing': _spacing(header, axes),
+            'gradients': sum(1 for key in keyvalue
+                             if _GRADIENT_KEY.match(key)),
+            'b_value': None if b_value is None else float(b_value)}
+
+
+def header_info(path):
+    """Summarises the header of a NRRD file, without reading the data.
+
+    Returns a dictionary, shared by all callers and not to be modified,
+    with the parsed 'header' and its data 'offset', the detached
+    'data_file' (or None), the axis sizes ('shape'), the indices of the
+    grid and other axes ('spatial_axes', 'list_axes'), the grid size
+    ('spatial_shape') and voxel size ('spacing', or None), the number of
+    DWMRI gradients ('gradients') and the 'b_value' (or None).
+
+    Summaries are cached by path until the size or mtime of the file
+    changes.
+    """
+    stat = os.stat(path)
+    key = (stat.st_size, stat.st_mtime)
+    with _infos_lock:
+        cached = _infos.get(path)
+        if cached is not None and cached[0] == key:
+            return cached[1]
+    info = _info(path)
+    with _infos_lock:
+        _infos[path] = (key, info)
+    return info
+
+
+def read(path):
+    """Reads a NRRD file.
+
+    Returns the data, indexed in header axis order, and the header.
+    """
+    header, offset = read_header(path)
+    data_path = header.get('data file', header.get('datafile'))
+    if data_path is not None:
+        data_path = os.path.join(os.path.dirname(path), data_path)
+        offset = 0
+    else:
+        data_path = path
+    encoding = header.get('encoding', 'raw').lower()
+    with open(data_path, 'rb') as f:
+        f.seek(offset)
+        if encoding in ('gzip', 'gz'):
+            raw = gzip.GzipFile(fileobj=f).read()
+        elif encoding == 'raw':
+            raw = f.read()
+        else:
+            raise ValueError('Unsupported NRRD encoding %s' % encoding)
+    shape = header_shape(header)
+    dtype = header_dtype(header)
+    count = int(np.prod(shape))
+    data = np.frombuffer(raw, dtype=dtype, count=count)
+    # nrrd lists the fastest axis first
+    return data.reshape(shape, order='F'), header
+
+
+def write(path, data, header=None):
+    """Writes data as a gzip encoded NRRD file.
+    Spatial fields and key/value pairs are copied from header."""
+    data = np.asarray(data)
+    out = OrderedDict()
+    out['type'] = {'i': 'int', 'u': 'uint', 'f': 'float'}[data.dtype.kind]
+    if data.dtype.kind == 'f' and data.dtype.itemsize == 8:
+        out['type'] = 'double'
+    elif data.dtype.kind in 'iu':
+        out['type'] = '%s%d' % (out['type'], data.dtype.itemsize * 8)
+    out['dimension'] = str(data.ndim)
+    out['sizes'] = ' '.join(str(s) for s in data.shape)
+    keyvalue = OrderedDict()
+    if header is not None:
+        for key, value in header.items():
+            if key == 'keyvalue':
+                keyvalue = value
+            elif key not in _LAYOUT_FIELDS and key not in out:
+                out[key] = value
+    out['endian'] = 'little'
+    out['encoding'] = 'gzip'
+
+    lines = ['NRRD0004']
+    lines.extend('%s: %s' % (key, value) for key, value in out.items())
+    lines.extend('%s:=%s' % (key, value) for key, value in keyvalue.items())
+    with open(path, 'wb') as f:
+        f.write(('\n'.join(lines) + '\n\n').encode('latin-1'))
+        little = data.astype(data.dtype.newbyteorder('<'), copy=False)
+        with gzip.GzipFile(fileobj=f, mode='wb') as gz:
+            gz.write(little.tobytes(order='F'))
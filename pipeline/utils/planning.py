@@ -0,0 +1,351 @@
+"""
+Dry runs estimating the cost of a workflow before it is run.
+
+The expanded graph of the workflow is walked without running any
+container: the command line of every SingularityTask is rendered, its
+outputs are resolved with _list_outputs and passed on to the nodes
+downstream, and its runtime and output size are estimated from the amount
+of work of the task (see SingularityTask._estimate_work, the DWI
+dimensions, seedsPerVoxel and numTensor for UKF). Work is converted to
+core seconds and bytes with the rates measured in the profiles of earlier
+runs when given (profiled working directories or a run history
+database), or with the defaults of the task otherwise. MapNodes are
+planned as the sum of their subnodes, one per item of the iterfield. Other
+nodes (SelectFiles, ...) have their outputs listed but are assumed free.
+
+$ python -m pipeline.utils.planning pipeline.workflows.2tensor:wf \\
+      --history old_working_dir/2tensor -o plan.json
+"""
+
+import os
+import sys
+import json
+import shutil
+import argparse
+import tempfile
+from copy import deepcopy
+from contextlib import contextmanager
+
+import networkx as nx
+from traits.trait_errors import TraitError
+from nipype import config
+from nipype.pipeline.engine import MapNode
+from nipype.pipeline.engine.utils import (generate_expanded_graph,
+                                          evaluate_connect_function,
+                                          merge_dict)
+from nipype.interfaces.base import isdefined
+from nipype.utils.filemanip import filename_to_list
+from nipype.utils.misc import flatten
+
+from .profiling import collect
+from .images import _load
+from .history import RunHistory
+from ..workflows.nodes import Node
+
+
+def history_rates(workflow_dirs):
+    """Returns the core seconds and bytes written per unit of work of
+    every interface profiled under workflow_dirs. Core seconds are the
+    wall time of the tool times its threads, as RunHistory.rates."""
+    totals = {}
+    for workflow_dir in workflow_dirs:
+        for record in collect(workflow_dir):
+            # restored from the cache or profiled before wall_s was kept
+            if not record.get('work') or record.get('wall_s') is None \
+            or record.get('output_bytes') is None:
+                continue
+            entry = totals.setdefault(record['interface'],
+                                      {'runs': 0, 'work': 0.0,
+                                       'core_seconds': 0.0, 'bytes': 0.0})
+            entry['runs'] += 1
+            entry['work'] += record['work']
+            entry['core_seconds'] += (record['wall_s'] *
+                                      (record['num_threads'] or 1))
+            entry['bytes'] += record['output_bytes']
+    return dict((name, {'runs': entry['runs'],
+                        'work_seconds': entry['core_seconds'] / entry['work'],
+                        'work_output_bytes': entry['bytes'] / entry['work']})
+                for name, entry in totals.items())
+
+
+@contextmanager
+def _scratch_cwd():
+    """Changes to an empty directory, outputs resolved relative to the
+    working directory end up below it"""
+    cwd = os.getcwd()
+    scratch = tempfile.mkdtemp()
+    os.chdir(scratch)
+    try:
+        yield scratch
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(scratch, ignore_errors=True)
+
+
+def _relocate(value, src, dst):
+    """Moves the paths below src in value, or a command line, to dst"""
+    if isinstance(value, str):
+        return value.replace(src, dst)
+    if isinstance(value, (list, tuple)):
+        return type(value)(_relocate(v, src, dst) for v in value)
+    if isinstance(value, dict):
+        return dict((k, _relocate(v, src, dst)) for k, v in value.items())
+    return value
+
+
+def _assume(node, name, value):
+    """Sets an input to the expected output of another node. Outputs that
+    do not exist yet fail the exists checks, they are stored unchecked."""
+    try:
+        node.set_input(name, value)
+    except TraitError:
+        inputs = node.inputs
+        if isinstance(node, MapNode) and name not in node.iterfield:
+            inputs = node._interface.inputs
+        inputs.__dict__[name] = deepcopy(value)
+
+
+def _output_paths(outputs):
+    paths = []
+    for value in outputs.values():
+        if isinstance(value, str):
+            paths.append(value)
+        elif isinstance(value, (list, tuple)):
+            paths.extend(v for v in value if isinstance(v, str))
+    return paths
+
+
+def _map_subnodes(node):
+    """Returns the subnodes of a MapNode as MapNode._make_nodes would make
+    them. Inputs stored unchecked by _assume are passed on unchecked, the
+    subnodes of _make_nodes would validate them again."""
+    values = dict((field, getattr(node.inputs, field))
+                  for field in node.iterfield)
+    for field, value in values.items():
+        if not isdefined(value):
+            raise ValueError('iterfield %s is not known' % field)
+        value = filename_to_list(value)
+        values[field] = flatten(value) if node.nested else value
+    inputs = node._interface.inputs.get()
+    subnodes = []
+    for i in range(len(values[node.iterfield[0]])):
+        subnode = Node(deepcopy(node._interface),
+                       name='_%s%d' % (node.name, i),
+                       n_procs=getattr(node, '_n_procs', None))
+        for name, value in inputs.items():
+            if isdefined(value):
+                _assume(subnode, name, value)
+        for field in node.iterfield:
+            _assume(subnode, field, values[field][i])
+        subnode.config = node.config
+        subnode.base_dir = os.path.join(node.output_dir(), 'mapflow')
+        subnodes.append(subnode)
+    return subnodes
+
+
+def _plan_map_node(node, sizes, rates):
+    """Returns the estimate of a MapNode, the sum of its subnodes, and the
+    lists of their expected outputs"""
+    entry = {'interface': type(node._interface).__name__,
+             'seconds': 0.0, 'core_hours': 0.0, 'output_bytes': 0.0}
+    try:
+        subnodes = _map_subnodes(node)
+    except (ValueError, TypeError, TraitError) as err:
+        entry['error'] = str(err)
+        return entry, {}
+    outputs = {}
+    subentries = []
+    for subnode in subnodes:
+        subentry, suboutputs = _plan_node(subnode, sizes, rates)
+        if 'error' in subentry:
+            entry['error'] = '%s: %s' % (subnode.name, subentry['error'])
+            return entry, {}
+        subentries.append(subentry)
+        for name, value in suboutputs.items():
+            outputs.setdefault(name, []).append(value)
+    entry['subnodes'] = len(subentries)
+    entry['outputs'] = outputs
+    if not subentries or 'work' not in subentries[0]:
+        return entry, outputs
+    seconds = [subentry['seconds'] for subentry in subentries]
+    # subnodes run one after another when serial, at once otherwise
+    entry.update({'source': subentries[0]['source'],
+                  'work': sum(e['work'] for e in subentries),
+                  'num_threads': max(e['num_threads'] for e in subentries),
+                  'memory_gb': max(e['memory_gb'] for e in subentries),
+                  'seconds': sum(seconds) if node._serial else max(seconds),
+                  'core_hours': sum(e['core_hours'] for e in subentries),
+                  'output_bytes': sum(e['output_bytes']
+                                      for e in subentries)})
+    return entry, outputs
+
+
+def _plan_node(node, sizes, rates):
+    """Returns the estimate for one node and its expected outputs"""
+    if isinstance(node, MapNode):
+        return _plan_map_node(node, sizes, rates)
+    interface = node._interface
+    entry = {'interface': type(interface).__name__,
+             'seconds': 0.0, 'core_hours': 0.0, 'output_bytes': 0.0}
+    outdir = node.output_dir()
+    container = hasattr(interface, '_estimate_work')
+    try:
+        with _scratch_cwd() as scratch:
+            if container:
+                entry['cmdline'] = _relocate(interface.cmdline, scratch,
+                                             outdir)
+            outputs = _relocate(interface._list_outputs() or {}, scratch,
+                                outdir)
+    except (ValueError, TypeError, TraitError, IOError, OSError) as err:
+        entry['error'] = str(err)
+        return entry, {}
+    outputs = dict((name, value) for name, value in outputs.items()
+                   if isdefined(value))
+    entry['outputs'] = outputs
+    if not container:
+        return entry, outputs
+
+    work = interface._estimate_work(sizes)
+    threads = max(interface.num_threads, 1)
+    rate = rates.get(entry['interface'])
+    if rate is None:
+        rate = {'work_seconds': interface.default_work_seconds,
+                'work_output_bytes': interface.default_work_output_bytes}
+        entry['source'] = 'default'
+    else:
+        entry['source'] = 'history'
+    core_seconds = work * rate['work_seconds']
+    entry.update({'work': work,
+                  'num_threads': threads,
+                  'memory_gb': interface.estimated_memory_gb,
+                  'seconds': core_seconds / threads,
+                  'core_hours': core_seconds / 3600.0,
+                  'output_bytes': work * rate['work_output_bytes']})
+    paths = _output_paths(outputs)
+    for path in paths:
+        sizes[path] = entry['output_bytes'] / len(paths)
+    return entry, outputs
+
+
+def _critical_path(graph, seconds):
+    """Returns the nodes of the longest running chain and its runtime"""
+    finish = {}
+    previous = {}
+    for node in nx.topological_sort(graph):
+        start = 0.0
+        for upstream in graph.predecessors(node):
+            if finish[upstream] > start:
+                start = finish[upstream]
+                previous[node] = upstream
+        finish[node] = start + seconds[node]
+    if not finish:
+        return [], 0.0
+    node = max(finish, key=finish.get)
+    total = finish[node]
+    path = [node]
+    while path[-1] in previous:
+        path.append(previous[path[-1]])
+    return path[::-1], total
+
+
+def plan(workflow, rates=None):
+    """Estimates the cost of every node of workflow without running it.
+
+    Parameters
+    ----------
+    workflow : Workflow
+    rates : dict
+        Interface names mapped to their measured rates, see history_rates.
+
+    Returns a dictionary with the per node estimates, their totals and the
+    critical path.
+    """
+    rates = rates or {}
+    flatgraph = workflow._create_flat_graph()
+    workflow_config = merge_dict(deepcopy(config._sections),
+                                 workflow.config)
+    workflow._set_needed_outputs(flatgraph)
+    graph = generate_expanded_graph(deepcopy(flatgraph))
+    base_dir = os.path.abspath(workflow.base_dir or os.getcwd())
+    for node in graph.nodes():
+        node.config = merge_dict(deepcopy(workflow_config), node.config)
+        node.base_dir = base_dir
+
+    entries = {}
+    expected = {}
+    sizes = {}
+    for node in nx.topological_sort(graph):
+        for upstream in graph.predecessors(node):
+            outputs = expected[upstream]
+            for source, field in graph[upstream][node]['connect']:
+                name = source[0] if isinstance(source, tuple) else source
+                if name not in outputs:
+                    continue
+                value = outputs[name]
+                if isinstance(source, tuple):
+                    value = evaluate_connect_function(source[1], source[2],
+                                                      value)
+                _assume(node, field, value)
+        entries[node], expected[node] = _plan_node(node, sizes, rates)
+        entries[node]['node'] = os.path.relpath(node.output_dir(), base_dir)
+
+    path, seconds = _critical_path(
+        graph, dict((node, entry['seconds'])
+                    for node, entry in entries.items()))
+    nodes = [entries[node] for node in nx.topological_sort(graph)]
+    return {'workflow_dir': os.path.join(base_dir, workflow.name),
+            'nodes': nodes,
+            'total': {'nodes': len(nodes),
+                      'core_hours': sum(e['core_hours'] for e in nodes),
+                      'output_bytes': sum(e['output_bytes'] for e in nodes),
+                      'unplanned': sum(1 for e in nodes if 'error' in e)},
+            'critical_path': {'nodes': [entries[n]['node'] for n in path],
+                              'seconds': seconds}}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.
+                                     RawDescriptionHelpFormatter)
+    parser.add_argument('workflow',
+                        help='Workflow given as package.module:attribute')
+    parser.add_argument('--history', nargs='*', default=[],
+                        help=('Working directories of earlier runs with '
+                              'the profile input set.'))
+    parser.add_argument('--history-db',
+                        help='Run history database, see history_db.')
+    parser.add_argument('-o', '--output', help='Write the plan as JSON')
+    args = parser.parse_args()
+    rates = history_rates(args.history)
+    if args.history_db:
+        rates.update(RunHistory(args.history_db).rates())
+    report = plan(_load(args.workflow), rates)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+
+    sys.stdout.write('%-60s %8s %10s %10s %8s\n' % ('node', 'threads',
+                                                   'hours', 'core_hours',
+                                                   'out_gb'))
+    for entry in report['nodes']:
+        if 'error' in entry:
+            sys.stdout.write('%-60s %s\n' % (entry['node'], entry['error']))
+            continue
+        if 'work' not in entry:
+            continue
+        sys.stdout.write('%-60s %8d %10.2f %10.2f %8.2f\n' % (
+            entry['node'], entry['num_threads'], entry['seconds'] / 3600.0,
+            entry['core_hours'], entry['output_bytes'] / (1 << 30)))
+    total = report['total']
+    critical = report['critical_path']
+    sys.stdout.write('total: %.2f core hours, %.2f GB written, '
+                     '%d nodes not planned\n' % (
+                         total['core_hours'],
+                         total['output_bytes'] / (1 << 30),
+                         total['unplanned']))
+    sys.stdout.write('critical path: %.2f hours through %s\n' % (
+        critical['seconds'] / 3600.0, ' -> '.join(critical['nodes'])))
+
+
+if __name__ == '__main__':
+    main()
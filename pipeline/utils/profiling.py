@@ -0,0 +1,276 @@
+"""
+Per phase timing and resource use of container runs.
+
+SingularityTask records the time spent validating inputs, rendering the
+command line, setting up (cache lookup, staging, instances), starting the
+container (until its first line of output), running the tool, collecting
+outputs and tearing down. With the profile input set these are stored in
+runtime.profile together with the peak RSS and CPU time of the container
+process tree, and end up in the node result files.
+
+A report over all nodes of a workflow:
+$ python -m pipeline.utils.profiling working_dir/2tensor -o profile.json
+"""
+
+import os
+import sys
+import json
+import time
+import argparse
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+
+PHASES = ['validate', 'render', 'setup', 'startup', 'tool', 'outputs',
+          'teardown']
+
+_PAGE_MB = os.sysconf('SC_PAGE_SIZE') / float(1 << 20)
+_TICKS = float(os.sysconf('SC_CLK_TCK'))
+
+
+class Profile(object):
+    """Phase timings of one run.
+
+    Time spent in a phase nested in another is only counted for the inner
+    phase, so the phases add up to the wall time of the run.
+    """
+
+    def __init__(self):
+        self.phases = OrderedDict()
+        # process start, first output and exit times
+        self.spawned = None
+        self.first_output = None
+        self.exited = None
+        self.peak_rss_mb = None
+        self.cpu_s = None
+        # amount of work, threads and output size of the run, see
+        # SingularityTask._estimate_work
+        self.work = None
+        self.num_threads = None
+        self.output_bytes = None
+        self._stack = []
+
+    def add(self, name, seconds):
+        self.phases[name] = self.phases.get(name, 0.0) + max(seconds, 0.0)
+
+    @contextmanager
+    def phase(self, name):
+        start = time.time()
+        self._stack.append(0.0)
+        try:
+            yield
+        finally:
+            nested = self._stack.pop()
+            elapsed = time.time() - start
+            self.add(name, elapsed - nested)
+            if self._stack:
+                self._stack[-1] += elapsed
+
+    @property
+    def wall_s(self):
+        """Seconds the tool ran, None unless it was started"""
+        if self.spawned is None or self.exited is None:
+            return None
+        return self.exited - self.spawned
+
+    def as_dict(self):
+        return {'phases': dict((name, round(seconds, 6))
+                               for name, seconds in self.phases.items()),
+                'wall_s': self.wall_s,
+                'peak_rss_mb': self.peak_rss_mb,
+                'cpu_s': self.cpu_s,
+                'work': self.work,
+                'num_threads': self.num_threads,
+                'output_bytes': self.output_bytes}
+
+
+def _read_stat(pid):
+    """Returns (ppid, cpu seconds, cpu seconds of reaped children, rss MB)
+    of a process"""
+    with open('/proc/%d/stat' % pid) as f:
+        # the command name may contain spaces, fields follow the last ')'
+        fields = f.read().rsplit(')', 1)[1].split()
+    return (int(fields[1]),
+            (int(fields[11]) + int(fields[12])) / _TICKS,
+            (int(fields[13]) + int(fields[14])) / _TICKS,
+            int(fields[21]) * _PAGE_MB)
+
+
+def _children(pid):
+    """Returns the pids of the children of a process, started by any of
+    its threads"""
+    children = []
+    for tid in os.listdir('/proc/%d/task' % pid):
+        with open('/proc/%d/task/%s/children' % (pid, tid)) as f:
+            children.extend(int(child) for child in f.read().split())
+    return children
+
+
+# kernels without CONFIG_PROC_CHILDREN only list children by a full scan
+_HAS_CHILDREN = os.path.exists('/proc/%d/task/%d/children' % (os.getpid(),
+                                                               os.getpid()))
+
+
+class ProcessSampler(object):
+    """Samples the memory and CPU use of a process and its descendants
+    from /proc until stopped.
+
+    Only the process tree is read, so containers sampled at once do not
+    count each other. The CPU time of a process includes its reaped
+    children, and the rusage of the process itself, when given to stop,
+    replaces the sampled CPU time which misses the last interval.
+    """
+
+    def __init__(self, interval=0.5):
+        self.interval = interval
+        self.peak_rss_mb = 0.0
+        self.cpu_s = 0.0
+        self._pid = None
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self, pid):
+        self._pid = pid
+        self._thread = threading.Thread(target=self._loop)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self, usage=None):
+        """Stops sampling, call once the process has been waited for,
+        with its resource usage from os.wait4 if known"""
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+        if usage is not None:
+            self.cpu_s = max(self.cpu_s, usage.ru_utime + usage.ru_stime)
+
+    def _loop(self):
+        while not self._stop.is_set():
+            self.sample()
+            self._stop.wait(self.interval)
+
+    def _scan_tree(self):
+        """Returns the stats of the process tree"""
+        stats = {}
+        tree = [self._pid]
+        while tree:
+            pid = tree.pop()
+            try:
+                stats[pid] = _read_stat(pid)
+                tree.extend(_children(pid))
+            except (IOError, OSError, IndexError, ValueError):
+                # exited while reading
+                continue
+        return stats
+
+    def _scan_all(self):
+        """Returns the stats of the process tree, listing all processes"""
+        stats = {}
+        for entry in os.listdir('/proc'):
+            if not entry.isdigit():
+                continue
+            try:
+                stats[int(entry)] = _read_stat(int(entry))
+            except (IOError, OSError, IndexError, ValueError):
+                # exited while listing
+                continue
+        children = {}
+        for pid, (ppid, _, _, _) in stats.items():
+            children.setdefault(ppid, []).append(pid)
+        tree = {}
+        pids = [self._pid]
+        while pids:
+            pid = pids.pop()
+            if pid in stats:
+                tree[pid] = stats[pid]
+                pids.extend(children.get(pid, []))
+        return tree
+
+    def sample(self):
+        stats = self._scan_tree() if _HAS_CHILDREN else self._scan_all()
+        if not stats:
+            return
+        # a process is counted by its parent once reaped, not before
+        self.cpu_s = max(self.cpu_s, sum(cpu + reaped for _, cpu, reaped, _
+                                         in stats.values()))
+        self.peak_rss_mb = max(self.peak_rss_mb,
+                               sum(rss for _, _, _, rss in stats.values()))
+
+
+def collect(workflow_dir):
+    """Returns the profile of every node run under workflow_dir"""
+    from nipype.utils.filemanip import loadpkl
+
+    records = []
+    for root, _, files in sorted(os.walk(workflow_dir)):
+        for name in files:
+            if not (name.startswith('result_') and name.endswith('.pklz')):
+                continue
+            result = loadpkl(os.path.join(root, name))
+            profile = getattr(getattr(result, 'runtime', None),
+                              'profile', None)
+            if profile is None:
+                continue
+            record = {'node': os.path.relpath(root, workflow_dir),
+                      'interface': result.interface.__name__,
+                      'duration_s': result.runtime.duration}
+            record.update(profile)
+            records.append(record)
+    return records
+
+
+def summarize(records):
+    """Aggregates node profiles per interface"""
+    summary = {}
+    for record in records:
+        entry = summary.setdefault(record['interface'],
+                                   {'nodes': 0, 'phases': {},
+                                    'cpu_s': 0.0, 'peak_rss_mb': 0.0})
+        entry['nodes'] += 1
+        for phase, seconds in record['phases'].items():
+            entry['phases'][phase] = entry['phases'].get(phase, 0.0) + seconds
+        entry['cpu_s'] += record['cpu_s'] or 0.0
+        entry['peak_rss_mb'] = max(entry['peak_rss_mb'],
+                                   record['peak_rss_mb'] or 0.0)
+    for entry in summary.values():
+        total = sum(entry['phases'].values())
+        # share of the time not spent in the tool itself
+        entry['overhead'] = (1 - entry['phases'].get('tool', 0.0) / total
+                             if total else 0.0)
+        entry['mean_phases'] = dict((phase, seconds / entry['nodes'])
+                                    for phase, seconds
+                                    in entry['phases'].items())
+    return summary
+
+
+def write_report(workflow_dir, out_file):
+    """Writes the node profiles and their summary as JSON"""
+    records = collect(workflow_dir)
+    report = {'workflow_dir': os.path.abspath(workflow_dir),
+              'nodes': records,
+              'summary': summarize(records)}
+    with open(out_file, 'w') as f:
+        json.dump(report, f, indent=2, sort_keys=True)
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('workflow_dir')
+    parser.add_argument('-o', '--output', default='profile.json')
+    args = parser.parse_args()
+    report = write_report(args.workflow_dir, args.output)
+    sys.stdout.write('%-34s %5s ' % ('interface', 'nodes') +
+                     ' '.join('%9s' % phase for phase in PHASES) +
+                     ' %9s %9s\n' % ('rss_mb', 'overhead'))
+    for interface, entry in sorted(report['summary'].items()):
+        sys.stdout.write('%-34s %5d ' % (interface, entry['nodes']) +
+                         ' '.join('%9.2f' % entry['mean_phases'].get(phase,
+                                                                     0.0)
+                                  for phase in PHASES) +
+                         ' %9.1f %8.0f%%\n' % (entry['peak_rss_mb'],
+                                               100 * entry['overhead']))
+
+
+if __name__ == '__main__':
+    main()
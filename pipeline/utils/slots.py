@@ -0,0 +1,73 @@
+"""
+Limits on the number of containers of a group running at once.
+
+A group is a directory of slot lock files, a container holds an exclusive
+lock on one of them while it runs. The locks are released by the kernel
+when the holding process dies, so slots are never leaked. They are shared
+by every thread and process of a host, and by hosts that see the directory
+on a file system with working flock.
+Example:
+>>> slots = Slots('/scratch/slots/ukf', 2)
+>>> with slots.hold():
+...     run_ukf()
+"""
+
+import os
+import time
+import fcntl
+from contextlib import contextmanager
+
+# seconds between attempts to take a slot
+POLL_INTERVAL = 1.0
+
+
+class Slots(object):
+    """At most limit holders of the group in path at a time.
+
+    Parameters
+    ----------
+    path : string
+        Directory of the slot lock files, created if it does not exist.
+    limit : int
+        Number of slots.
+    """
+
+    def __init__(self, path, limit):
+        if not os.path.isdir(path):
+            os.makedirs(path, exist_ok=True)
+        self.path = path
+        self.limit = max(limit, 1)
+
+    def try_acquire(self):
+        """Takes a free slot, returns its lock file or None when every slot
+        is taken"""
+        for index in range(self.limit):
+            lock = open(os.path.join(self.path, 'slot%03d.lock' % index),
+                        'w')
+            try:
+                fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except (IOError, OSError):
+                lock.close()
+                continue
+            return lock
+        return None
+
+    def acquire(self, poll_interval=POLL_INTERVAL):
+        """Waits for a free slot, returns its lock file"""
+        while True:
+            lock = self.try_acquire()
+            if lock is not None:
+                return lock
+            time.sleep(poll_interval)
+
+    def release(self, lock):
+        fcntl.flock(lock, fcntl.LOCK_UN)
+        lock.close()
+
+    @contextmanager
+    def hold(self, poll_interval=POLL_INTERVAL):
+        lock = self.acquire(poll_interval)
+        try:
+            yield
+        finally:
+            self.release(lock)
@@ -0,0 +1,266 @@
+"""
+Staging of container inputs and outputs through node local scratch.
+
+Inputs are copied once per host into scratch_dir/inputs, keyed on their
+path, size and modification time, so later tasks using the same file reuse
+the local copy. Copies run in a thread pool, and can be started ahead of
+time with Stager.prefetch so they overlap with whatever the host is
+computing at the time. Staged inputs are evicted least recently used first
+once they grow beyond their size limit, those in use by a task of any
+process on the host are kept.
+"""
+
+import os
+import fcntl
+import shutil
+import hashlib
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from nipype import logging
+
+iflogger = logging.getLogger('interface')
+
+_BLOCK_SIZE = 1 << 20
+
+
+def copy_file(src, dst):
+    """Copies src to dst. Returns the sha1 digest of the file, as read
+    from src while copying."""
+    sha = hashlib.sha1()
+    with open(src, 'rb') as fin, open(dst, 'wb') as fout:
+        for block in iter(lambda: fin.read(_BLOCK_SIZE), b''):
+            sha.update(block)
+            fout.write(block)
+    shutil.copystat(src, dst)
+    return sha.hexdigest()
+
+
+def _copy(src, dst):
+    """Copies src to dst, returns the size of the file"""
+    shutil.copyfile(src, dst)
+    shutil.copystat(src, dst)
+    return os.path.getsize(dst)
+
+
+class Stager(object):
+    """Copies files and directories between shared storage and scratch.
+
+    Parameters
+    ----------
+    scratch_dir : string
+        Node local directory holding staged inputs and task work
+        directories.
+    workers : int
+        Number of files copied in parallel.
+    max_size_gb : float
+        Least recently used inputs are evicted once the staged inputs grow
+        beyond this size.
+
+    Each staged input has its own directory, holding the copy, a .size
+    file whose modification time is the last use, and a .lock file that
+    tasks using the copy hold a shared lock on.
+    """
+
+    def __init__(self, scratch_dir, workers=4, max_size_gb=50.0):
+        self.scratch_dir = os.path.abspath(scratch_dir)
+        self.workers = workers
+        self.max_size = int(max_size_gb * (1 << 30))
+        self._pool = ThreadPoolExecutor(max_workers=workers)
+        self._pending = {}
+        self._pending_lock = threading.Lock()
+        # open lock files of the copies in use, by scratch path
+        self._locks = {}
+        self._locks_lock = threading.Lock()
+
+    def _input_path(self, path):
+        st = os.stat(path)
+        key = '%s:%d:%f' % (os.path.realpath(path), st.st_size, st.st_mtime)
+        digest = hashlib.sha1(key.encode('utf-8')).hexdigest()
+        return os.path.join(self.scratch_dir, 'inputs', digest,
+                            os.path.basename(path.rstrip('/')))
+
+    def prefetch(self, path):
+        """Starts staging path in the background, returns a future
+        resolving to the scratch path"""
+        dst = self._input_path(path)
+        with self._pending_lock:
+            future = self._pending.get(dst)
+            if future is None:
+                future = self._pool.submit(self._stage_in, path, dst)
+                self._pending[dst] = future
+        return future
+
+    def stage_in(self, paths):
+        """Stages a list of files or directories into scratch.
+        Returns a dictionary of original path to scratch path, the copies
+        are kept until given back to release."""
+        futures = dict((path, self.prefetch(path)) for path in paths)
+        staged = {}
+        try:
+            for path, future in futures.items():
+                dst = future.result()
+                with self._pending_lock:
+                    if self._pending.get(dst) is future:
+                        del self._pending[dst]
+                lock = self._lock(dst)
+                with self._locks_lock:
+                    self._locks.setdefault(dst, []).append(lock)
+                staged[path] = dst
+                if not os.path.exists(dst):
+                    # evicted since it was prefetched
+                    self._stage_in(path, dst)
+        except Exception:
+            self.release(staged)
+            raise
+        return staged
+
+    def release(self, staged):
+        """Marks the copies returned by stage_in as no longer used, and
+        evicts inputs beyond the size limit"""
+        for dst in staged.values():
+            try:
+                os.utime(self._size_file(dst), None)
+            except OSError:
+                pass
+            with self._locks_lock:
+                lock = self._locks[dst].pop()
+                if not self._locks[dst]:
+                    del self._locks[dst]
+            lock.close()
+        self.evict()
+
+    @staticmethod
+    def _size_file(dst):
+        return os.path.join(os.path.dirname(dst), '.size')
+
+    @staticmethod
+    def _lock(dst):
+        """Returns the lock file of the copy at dst, locked shared"""
+        parent = os.path.dirname(dst)
+        path = os.path.join(parent, '.lock')
+        while True:
+            if not os.path.isdir(parent):
+                try:
+                    os.makedirs(parent)
+                except OSError:
+                    if not os.path.isdir(parent):
+                        raise
+            lock = open(path, 'a')
+            fcntl.flock(lock, fcntl.LOCK_SH)
+            # the copy may have been evicted with its lock file while
+            # waiting for the lock
+            try:
+                if os.path.samestat(os.fstat(lock.fileno()), os.stat(path)):
+                    return lock
+            except OSError:
+                pass
+            lock.close()
+
+    def evict(self):
+        """Removes least recently used inputs until the staged inputs
+        fit, skipping those locked by a task"""
+        root = os.path.join(self.scratch_dir, 'inputs')
+        if not os.path.isdir(root):
+            return
+        entries = []
+        total = 0
+        for digest in os.listdir(root):
+            entry = os.path.join(root, digest)
+            size_file = os.path.join(entry, '.size')
+            try:
+                with open(size_file) as f:
+                    size = int(f.read())
+                used = os.path.getmtime(size_file)
+            except (IOError, OSError, ValueError):
+                # still being staged
+                continue
+            entries.append((used, size, entry))
+            total += size
+        for used, size, entry in sorted(entries):
+            if total <= self.max_size:
+                break
+            try:
+                lock = open(os.path.join(entry, '.lock'), 'a')
+            except (IOError, OSError):
+                continue
+            with lock:
+                try:
+                    fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except (IOError, OSError):
+                    continue
+                shutil.rmtree(entry, ignore_errors=True)
+            iflogger.debug('Evicted staged input %s', entry)
+            total -= size
+
+    def _stage_in(self, src, dst):
+        if os.path.exists(dst):
+            return dst
+        parent = os.path.dirname(dst)
+        if not os.path.isdir(parent):
+            os.makedirs(parent)
+        tmp = tempfile.mkdtemp(dir=parent, prefix='.tmp')
+        try:
+            staged = os.path.join(tmp, os.path.basename(dst))
+            with ThreadPoolExecutor(max_workers=self.workers) as pool:
+                size = self._copy_tree(src, staged, pool)
+            try:
+                os.rename(staged, dst)
+            except OSError:
+                # another task staged the same input first
+                if not os.path.exists(dst):
+                    raise
+            else:
+                with open(os.path.join(tmp, '.size'), 'w') as f:
+                    f.write('%d' % size)
+                os.rename(os.path.join(tmp, '.size'), self._size_file(dst))
+        finally:
+            shutil.rmtree(tmp, ignore_errors=True)
+        iflogger.debug('Staged %s to %s', src, dst)
+        return dst
+
+    def _copy_tree(self, src, dst, pool):
+        """Copies a file or directory tree, files are copied in parallel.
+        Every directory is created, empty ones too. Returns the size of
+        the files."""
+        if not os.path.isdir(src):
+            return pool.submit(_copy, src, dst).result()
+        jobs = []
+        for root, _, names in os.walk(src):
+            target = os.path.normpath(
+                os.path.join(dst, os.path.relpath(root, src)))
+            if not os.path.isdir(target):
+                os.makedirs(target)
+            for name in names:
+                jobs.append(pool.submit(_copy, os.path.join(root, name),
+                                        os.path.join(target, name)))
+        return sum(job.result() for job in jobs)
+
+    def make_workdir(self):
+        """Returns a new, empty working directory on scratch"""
+        parent = os.path.join(self.scratch_dir, 'work')
+        if not os.path.isdir(parent):
+            os.makedirs(parent)
+        return tempfile.mkdtemp(dir=parent)
+
+    def stage_out(self, workdir, dst):
+        """Copies everything written to workdir back to dst in parallel
+        and removes workdir"""
+        with ThreadPoolExecutor(max_workers=self.workers) as pool:
+            for name in os.listdir(workdir):
+                self._copy_tree(os.path.join(workdir, name),
+                                os.path.join(dst, name), pool)
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+_stagers = {}
+
+
+def get_stager(scratch_dir, workers=4, max_size_gb=50.0):
+    """Returns the stager for scratch_dir shared by this process"""
+    key = os.path.abspath(scratch_dir)
+    if key not in _stagers:
+        _stagers[key] = Stager(key, workers, max_size_gb)
+    _stagers[key].max_size = int(max_size_gb * (1 << 30))
+    return _stagers[key]
@@ -0,0 +1,36 @@
+import os
+
+from ..cache import ResultCache
+
+
+def test_restored_outputs_do_not_share_the_entry(tmpdir):
+    cache = ResultCache(str(tmpdir.join('cache')))
+    out = tmpdir.join('node', 'tracts.vtk')
+    out.write('fibers', ensure=True)
+    cache.store('a' * 40, {'tracts': str(out)})
+    # a tool rewriting its output in place
+    with open(str(out), 'r+') as f:
+        f.write('FIBERS')
+    restored = tmpdir.join('other', 'tracts.vtk')
+    assert cache.restore('a' * 40, {'tracts': str(restored)})
+    assert restored.read() == 'fibers'
+    with open(str(restored), 'r+') as f:
+        f.write('FIBERS')
+    assert cache.restore('a' * 40, {'tracts': str(out)})
+    assert out.read() == 'fibers'
+
+
+def test_entries_being_restored_are_kept(tmpdir):
+    cache = ResultCache(str(tmpdir.join('cache')))
+    out = tmpdir.join('node', 'tracts.vtk')
+    out.write('fibers', ensure=True)
+    cache.store('a' * 40, {'tracts': str(out)})
+    entry = cache._entry('a' * 40)
+    cache.max_size = 0
+    lock = cache._lock(entry)
+    cache.evict()
+    assert os.path.exists(entry)
+    lock.close()
+    cache.evict()
+    assert not os.path.exists(entry)
+    assert not cache.restore('a' * 40, {'tracts': str(out)})
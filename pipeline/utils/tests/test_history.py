@@ -0,0 +1,11 @@
+from ..history import RunHistory
+
+
+def test_failed_runs_are_not_predicted_from(tmpdir):
+    history = RunHistory(str(tmpdir.join('runs.db')))
+    history.record(interface='Task', work=2.0, wall_s=10.0, returncode=0)
+    history.record(interface='Task', work=2.0, wall_s=1.0, returncode=1)
+    assert [run['returncode'] for run in history.runs('Task')] == [1, 0]
+    assert history.rates()['Task']['runs'] == 1
+    assert history.rates()['Task']['work_seconds'] == 5.0
+
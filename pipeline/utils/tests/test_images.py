@@ -0,0 +1,38 @@
+import os
+
+from ..images import ImageCache
+
+
+def _image(tmpdir, name, size=1 << 10):
+    path = tmpdir.join(name)
+    path.write(name.encode() * (size // len(name)), mode='wb')
+    return str(path)
+
+
+def test_images_in_use_are_kept(tmpdir):
+    cache = ImageCache(str(tmpdir.join('cache')),
+                       max_size_gb=1.5 / (1 << 20))
+    first = cache.get(_image(tmpdir, 'first.img'))
+    second = cache.get(_image(tmpdir, 'second.img'))
+    # both in use, the cache is left over its size
+    assert os.path.exists(first) and os.path.exists(second)
+    cache.release(first)
+    cache.release(cache.get(_image(tmpdir, 'second.img')))
+    assert not os.path.exists(first)
+    assert not os.path.exists(first[:-len('.img')] + '.lock')
+    assert os.path.exists(second)
+    cache.release(second)
+
+
+def test_evicted_image_is_copied_again(tmpdir):
+    cache = ImageCache(str(tmpdir.join('cache')), max_size_gb=0.0)
+    image = _image(tmpdir, 'first.img')
+    path = cache.get(image)
+    cache.release(path)
+    cache.release(cache.get(_image(tmpdir, 'second.img')))
+    assert not os.path.exists(path)
+    again = cache.get(image)
+    assert again == path
+    with open(again, 'rb') as f:
+        assert f.read() == open(image, 'rb').read()
+    cache.release(again)
@@ -0,0 +1,18 @@
+import logging
+
+from ..logs import LogStreamer
+
+
+def test_log_is_rotated_without_loggers(tmpdir):
+    log = tmpdir.join('container.log')
+    loggers = set(logging.Logger.manager.loggerDict)
+    streamer = LogStreamer(str(log), max_bytes=1 << 10, tail_lines=5,
+                           backups=2)
+    cmdline = 'for i in $(seq 100); do echo line $i; done'
+    assert streamer.run(cmdline) == 0
+    assert set(logging.Logger.manager.loggerDict) == loggers
+    assert log.size() <= 1 << 10
+    assert tmpdir.join('container.log.2').check()
+    assert not tmpdir.join('container.log.3').check()
+    assert log.read().splitlines()[-1].endswith('[stdout] line 100')
+    assert streamer.tail() == ['line %d' % i for i in range(96, 101)]
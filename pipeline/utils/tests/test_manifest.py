@@ -0,0 +1,25 @@
+import os
+
+from ..manifest import (fingerprint, write_manifest, load_manifest,
+                        manifest_path)
+
+
+def test_fingerprint_does_not_write(tmpdir):
+    data = tmpdir.mkdir('data')
+    data.join('a.vtk').write('a')
+    before = fingerprint(str(data))
+    assert not os.path.exists(manifest_path(str(data)))
+    data.join('a.vtk').write('b')
+    os.utime(str(data.join('a.vtk')), (0, 0))
+    assert fingerprint(str(data)) != before
+
+
+def test_fingerprint_follows_written_manifest(tmpdir):
+    data = tmpdir.mkdir('data')
+    data.mkdir('sub').join('a.vtk').write('a')
+    manifest = write_manifest(str(data))
+    before = fingerprint(str(data))
+    data.join('sub', 'b.vtk').write('b')
+    assert fingerprint(str(data)) != before
+    # the stored manifest is left as the task wrote it
+    assert load_manifest(str(data)) == manifest
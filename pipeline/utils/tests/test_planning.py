@@ -0,0 +1,40 @@
+from .. import planning
+from ..history import RunHistory
+from ..planning import plan, history_rates
+from ...workflows.sharded_ukf import create_sharded_ukf
+
+
+def test_map_nodes_are_planned_per_subnode(tmpdir):
+    for name in ('dwi.nrrd', 'mask.nrrd', 'ukf.simg'):
+        tmpdir.join(name).write('x')
+    ukf = create_sharded_ukf(3, container=str(tmpdir.join('ukf.simg')),
+                             numThreads=2)
+    ukf.base_dir = str(tmpdir.join('work'))
+    ukf.inputs.inputnode.dwiFile = str(tmpdir.join('dwi.nrrd'))
+    ukf.inputs.inputnode.maskFile = str(tmpdir.join('mask.nrrd'))
+    report = plan(ukf)
+    tract = [entry for entry in report['nodes']
+             if entry['node'] == 'sharded_ukf/tractography'][0]
+    assert 'error' not in tract
+    assert tract['subnodes'] == 3
+    assert tract['num_threads'] == 2
+    assert len(tract['outputs']['tracts']) == 3
+    assert tract['core_hours'] > 0
+    assert report['critical_path']['nodes'] == ['sharded_ukf/tractography']
+    assert report['total']['unplanned'] == 0
+
+
+def test_history_rates_match_run_history(tmpdir, monkeypatch):
+    records = [{'interface': 'Task', 'work': 2.0, 'num_threads': 4,
+                'wall_s': 10.0, 'duration_s': 30.0, 'output_bytes': 8},
+               {'interface': 'Task', 'work': 2.0, 'num_threads': 4,
+                'wall_s': None, 'duration_s': 1.0, 'output_bytes': 8}]
+    monkeypatch.setattr(planning, 'collect', lambda workflow_dir: records)
+    history = RunHistory(str(tmpdir.join('runs.db')))
+    for record in records:
+        history.record(interface='Task', work=record['work'],
+                       num_threads=record['num_threads'],
+                       wall_s=record['wall_s'],
+                       output_bytes=record['output_bytes'], returncode=0)
+    assert history_rates(['work']) == history.rates()
+    assert history.rates()['Task']['work_seconds'] == 20.0
@@ -0,0 +1,41 @@
+import sys
+import threading
+
+from ..logs import LogStreamer
+from ..profiling import ProcessSampler
+
+BUSY = ('"import time\nend = time.time() + 1\nwhile time.time() < end: '
+        'pass"')
+
+
+def _run(tmpdir, name, code, results):
+    sampler = ProcessSampler(0.05)
+    streamer = LogStreamer(str(tmpdir.join(name + '.log')), sampler=sampler)
+    assert streamer.run('%s -c %s' % (sys.executable, code)) == 0
+    results[name] = sampler
+
+
+def test_concurrent_runs_are_accounted_apart(tmpdir):
+    results = {}
+    threads = [threading.Thread(target=_run, args=args)
+               for args in ((tmpdir, 'busy', BUSY, results),
+                            (tmpdir, 'idle', '"import time; time.sleep(1)"',
+                             results))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert results['busy'].cpu_s > 0.5
+    assert results['idle'].cpu_s < 0.3
+    assert results['idle'].peak_rss_mb > 0
+
+
+def test_sampled_tree(tmpdir):
+    # without the rusage of the command, as under the asyncio runner
+    sampler = ProcessSampler(0.05)
+    streamer = LogStreamer(str(tmpdir.join('tree.log')), sampler=sampler)
+    streamer.exit = lambda returncode, usage=None: \
+        LogStreamer.exit(streamer, returncode)
+    cmdline = '%s -c %s; sleep 0.3' % (sys.executable, BUSY)
+    assert streamer.run(cmdline) == 0
+    assert sampler.cpu_s > 0.5
@@ -0,0 +1,68 @@
+import os
+
+from ..staging import Stager
+
+
+def _inputs(tmpdir, count, size=1 << 10):
+    paths = []
+    for index in range(count):
+        path = tmpdir.join('input%d.nrrd' % index)
+        path.write(b'x' * size, mode='wb')
+        paths.append(str(path))
+    return paths
+
+
+def _staged(stager):
+    root = os.path.join(stager.scratch_dir, 'inputs')
+    return sorted(name for digest in os.listdir(root)
+                  for name in os.listdir(os.path.join(root, digest))
+                  if not name.startswith('.'))
+
+
+def test_least_recently_used_inputs_are_evicted(tmpdir):
+    stager = Stager(str(tmpdir.join('scratch')))
+    paths = _inputs(tmpdir, 3)
+    for path, used in zip(paths, (300, 100, 200)):
+        staged = stager.stage_in([path])
+        with open(staged[path], 'rb') as f:
+            assert f.read() == b'x' * (1 << 10)
+        stager.release(staged)
+        os.utime(stager._size_file(staged[path]), (used, used))
+    stager.max_size = 2.5 * (1 << 10)
+    stager.evict()
+    assert _staged(stager) == ['input0.nrrd', 'input2.nrrd']
+    # staged again and now the most recently used
+    stager.release(stager.stage_in([paths[1]]))
+    assert _staged(stager) == ['input0.nrrd', 'input1.nrrd']
+
+
+def test_inputs_in_use_are_kept(tmpdir):
+    stager = Stager(str(tmpdir.join('scratch')), max_size_gb=0.0)
+    paths = _inputs(tmpdir, 2)
+    first = stager.stage_in([paths[0]])
+    stager.release(stager.stage_in([paths[1]]))
+    assert _staged(stager) == ['input0.nrrd']
+    assert os.path.exists(first[paths[0]])
+    stager.release(first)
+    assert _staged(stager) == []
+    # staged again once evicted
+    staged = stager.stage_in([paths[0]])
+    assert os.path.exists(staged[paths[0]])
+    stager.release(staged)
+
+
+def test_empty_directories_are_staged(tmpdir):
+    stager = Stager(str(tmpdir.join('scratch')))
+    empty = tmpdir.join('empty').ensure(dir=True)
+    tree = tmpdir.join('tree')
+    tree.join('clusters', 'cluster_00001.vtp').ensure()
+    tree.join('outliers').ensure(dir=True)
+    staged = stager.stage_in([str(empty), str(tree)])
+    assert os.listdir(staged[str(empty)]) == []
+    assert sorted(os.listdir(staged[str(tree)])) == ['clusters', 'outliers']
+    stager.release(staged)
+
+    workdir = stager.make_workdir()
+    os.makedirs(os.path.join(workdir, 'out', 'empty'))
+    stager.stage_out(workdir, str(tmpdir.join('node')))
+    assert tmpdir.join('node', 'out', 'empty').check(dir=True)
@@ -0,0 +1,45 @@
+import os
+
+import numpy as np
+import pytest
+
+from .. import tractio
+from ...interfaces.tracts import cluster_stats
+
+DATA = os.path.join(os.path.dirname(__file__), 'data')
+
+# written by vtkXMLPolyDataWriter with SetDataModeToBinary, as
+# whitematteranalysis writes its clusters, with the default zlib
+# compressor and both header types, without compression and in ascii
+FILES = ['wma_binary_zlib_uint32.vtp', 'wma_binary_zlib.vtp',
+         'wma_binary_raw.vtp', 'wma_ascii.vtp']
+
+POINTS = np.arange(24, dtype='f4').reshape(8, 3) * 0.5
+LINES = [[0, 1, 2], [3, 4, 5, 6], [7]]
+
+
+@pytest.mark.parametrize('name', FILES)
+def test_load_inline_vtp(name):
+    tracts = tractio.load_tracts(os.path.join(DATA, name))
+    assert np.allclose(tracts.points, POINTS)
+    assert list(tracts.offsets) == [0, 3, 7, 8]
+    assert [list(tracts.connectivity[tracts.offsets[i]:
+                                     tracts.offsets[i + 1]])
+            for i in range(tracts.n_lines)] == LINES
+    kind, free_water = tracts.point_data['FreeWater']
+    assert kind == 'SCALARS'
+    assert np.allclose(free_water, np.linspace(0, 1, 8))
+    kind, tensors = tracts.point_data['tensor1']
+    assert kind == 'TENSORS'
+    assert np.allclose(tensors, np.arange(72).reshape(8, 9))
+    assert list(tracts.cell_data['cluster'][1]) == [1, 2, 3]
+
+
+@pytest.mark.parametrize('name', FILES)
+def test_cluster_stats_inline_vtp(name):
+    row = cluster_stats(os.path.join(DATA, name))
+    assert row['n_fibers'] == 3
+    assert row['n_points'] == 8
+    step = np.sqrt(3 * 1.5 ** 2)
+    assert np.isclose(row['length_max'], 3 * step)
+    assert np.isclose(row['FreeWater_mean'], 0.5)
@@ -0,0 +1,994 @@
+"""
+Reading, writing and merging of tractography stored as VTK polydata.
+
+Only the subset of the legacy VTK format used for tractography is handled:
+POLYDATA with POINTS, LINES and point/cell attributes, in ASCII or BINARY.
+
+Large files can be opened with open_tracts instead, which memory maps
+binary legacy .vtk and appended raw .vtp files so arrays are read from
+the page cache as they are used rather than copied into memory. .vtp
+files with inline ascii or base64 arrays, as written by
+whitematteranalysis (vtkXMLPolyDataWriter in binary mode), are read into
+memory with read_vtp.
+"""
+
+import re
+import json
+import mmap
+import zlib
+import base64
+from xml.etree import ElementTree
+from collections import OrderedDict
+
+import numpy as np
+
+try:
+    import lz4.block
+except ImportError:
+    lz4 = None
+
+_VTK_TYPES = {'bit': 'u1', 'unsigned_char': 'u1', 'char': 'i1',
+              'unsigned_short': 'u2', 'short': 'i2',
+              'unsigned_int': 'u4', 'int': 'i4',
+              'unsigned_long': 'u8', 'long': 'i8',
+              'vtktypeint64': 'i8', 'vtkidtype': 'i8',
+              'float': 'f4', 'double': 'f8'}
+
+_VTK_NAMES = {'u1': 'unsigned_char', 'i1': 'char',
+              'u2': 'unsigned_short', 'i2': 'short',
+              'u4': 'unsigned_int', 'i4': 'int',
+              'u8': 'unsigned_long', 'i8': 'long',
+              'f4': 'float', 'f8': 'double'}
+
+# number of components implied by each attribute kind
+_ATTRIBUTE_COMPONENTS = {'VECTORS': 3, 'NORMALS': 3, 'TENSORS': 9}
+
+
+class PolyData(object):
+    """Tractography held as flat numpy arrays.
+
+    Attributes
+    ----------
+    points : array (n_points, 3)
+    offsets : array (n_lines + 1,)
+        Line i uses connectivity[offsets[i]:offsets[i + 1]]
+    connectivity : array
+        Point indices of all lines, concatenated.
+    point_data, cell_data : OrderedDict
+        Array name mapped to (kind, array), where kind is the legacy
+        attribute keyword (SCALARS, VECTORS, TENSORS, FIELD, ...)
+    """
+
+    def __init__(self, points, offsets, connectivity,
+                 point_data=None, cell_data=None):
+        self.points = points
+        self.offsets = offsets
+        self.connectivity = connectivity
+        self.point_data = point_data or OrderedDict()
+        self.cell_data = cell_data or OrderedDict()
+
+    @property
+    def n_lines(self):
+        return len(self.offsets) - 1
+
+    def line(self, i):
+        """Returns the points of line i"""
+        ids = self.connectivity[self.offsets[i]:self.offsets[i + 1]]
+        return self.points[ids]
+
+
+class _Reader(object):
+    """Walks the sections of a legacy vtk file held in memory"""
+
+    def __init__(self, buf, copy=True):
+        self.buf = buf
+        self.pos = 0
+        self.binary = False
+        # return big endian views of buf rather than native copies
+        self.copy = copy
+
+    def line(self):
+        """Returns the next non empty line split into words"""
+        while self.pos < len(self.buf):
+            end = self.buf.find(b'\n', self.pos)
+            if end < 0:
+                end = len(self.buf)
+            text = self.buf[self.pos:end].decode('latin-1')
+            self.pos = end + 1
+            if text.strip():
+                return text.split()
+        return None
+
+    def array(self, vtk_type, count):
+        dtype = np.dtype(_VTK_TYPES[vtk_type.lower()])
+        if self.binary:
+            dtype = dtype.newbyteorder('>')
+            nbytes = dtype.itemsize * count
+            data = np.frombuffer(self.buf, dtype=dtype, count=count,
+                                 offset=self.pos)
+            self.pos += nbytes
+            if not self.copy:
+                return data
+            return data.astype(dtype.newbyteorder('='))
+        values = []
+        while len(values) < count:
+            words = self.line()
+            if words is None:
+                raise ValueError('Unexpected end of vtk file')
+            values.extend(words)
+        return np.array(values[:count], dtype=dtype)
+
+
+def _read_field(reader, narrays, data):
+    for _ in range(narrays):
+        name, ncomp, ntuples, vtk_type = reader.line()[:4]
+        ncomp, ntuples = int(ncomp), int(ntuples)
+        values = reader.array(vtk_type, ncomp * ntuples)
+        if ncomp > 1:
+            values = values.reshape(ntuples, ncomp)
+        data[name] = ('FIELD', values)
+
+
+def _read_attributes(reader, count, data):
+    """Reads attribute arrays until the next dataset section"""
+    while True:
+        start = reader.pos
+        words = reader.line()
+        if words is None:
+            return None
+        kind = words[0].upper()
+        if kind in ('POINT_DATA', 'CELL_DATA'):
+            return words
+        if kind == 'SCALARS':
+            name, vtk_type = words[1], words[2]
+            ncomp = int(words[3]) if len(words) > 3 else 1
+            lut = reader.line()
+            if lut[0].upper() != 'LOOKUP_TABLE':
+                raise ValueError('Expected LOOKUP_TABLE in vtk file')
+            values = reader.array(vtk_type, count * ncomp)
+            data[name] = (kind, values.reshape(count, ncomp).squeeze(1)
+                          if ncomp == 1 else values.reshape(count, ncomp))
+        elif kind in _ATTRIBUTE_COMPONENTS:
+            ncomp = _ATTRIBUTE_COMPONENTS[kind]
+            values = reader.array(words[2], count * ncomp)
+            data[words[1]] = (kind, values.reshape(count, ncomp))
+        elif kind == 'FIELD':
+            _read_field(reader, int(words[2]), data)
+        elif kind in ('METADATA', 'INFORMATION'):
+            # skip metadata blocks, they end with an empty line
+            end = reader.buf.find(b'\n\n', reader.pos)
+            reader.pos = len(reader.buf) if end < 0 else end + 2
+        else:
+            reader.pos = start
+            raise ValueError('Unsupported vtk attribute %s' % kind)
+
+
+def read_vtk(path):
+    """Reads a legacy vtk polydata file into a PolyData object"""
+    with open(path, 'rb') as f:
+        buf = f.read()
+    reader = _Reader(buf)
+    reader.line()  # version
+    reader.line()  # title
+    reader.binary = reader.line()[0].upper() == 'BINARY'
+    dataset = reader.line()
+    if dataset[1].upper() != 'POLYDATA':
+        raise ValueError('%s is not vtk polydata' % path)
+
+    points = np.zeros((0, 3), dtype='f4')
+    offsets = np.zeros(1, dtype='i8')
+    connectivity = np.zeros(0, dtype='i8')
+    point_data = OrderedDict()
+    cell_data = OrderedDict()
+    words = reader.line()
+    while words is not None:
+        section = words[0].upper()
+        if section == 'POINTS':
+            count = int(words[1])
+            points = reader.array(words[2], count * 3).reshape(count, 3)
+            words = reader.line()
+        elif section == 'LINES':
+            if len(words) < 3 or words[1].upper() == 'OFFSETS':
+                raise ValueError('Unsupported vtk LINES layout in %s' % path)
+            cells = reader.array('int', int(words[2])).astype('i8')
+            # each cell is stored as npts id0 id1 ..., find the npts entries
+            starts = np.empty(int(words[1]), dtype='i8')
+            i = 0
+            for line in range(len(starts)):
+                starts[line] = i
+                i += cells[i] + 1
+            mask = np.ones(len(cells), dtype=bool)
+            mask[starts] = False
+            offsets = np.concatenate([[0], np.cumsum(cells[starts])])
+            connectivity = cells[mask]
+            words = reader.line()
+        elif section == 'POINT_DATA':
+            words = _read_attributes(reader, int(words[1]), point_data)
+        elif section == 'CELL_DATA':
+            words = _read_attributes(reader, int(words[1]), cell_data)
+        elif section in ('VERTICES', 'POLYGONS', 'TRIANGLE_STRIPS'):
+            reader.array('int', int(words[2]))
+            words = reader.line()
+        elif section == 'FIELD':
+            # dataset level field data is not used for tracts
+            _read_field(reader, int(words[2]), OrderedDict())
+            words = reader.line()
+        else:
+            raise ValueError('Unsupported vtk section %s in %s'
+                             % (section, path))
+    return PolyData(points, offsets, connectivity, point_data, cell_data)
+
+
+def _write_array(f, values):
+    dtype = values.dtype.newbyteorder('>')
+    f.write(np.ascontiguousarray(values, dtype=dtype).tobytes())
+    f.write(b'\n')
+
+
+def _write_attributes(f, data, count):
+    fields = [(name, values) for name, (kind, values) in data.items()
+              if kind == 'FIELD']
+    for name, (kind, values) in data.items():
+        if kind == 'FIELD':
+            continue
+        vtk_type = _VTK_NAMES[values.dtype.str[1:]]
+        if kind == 'SCALARS':
+            ncomp = 1 if values.ndim == 1 else values.shape[1]
+            f.write(('SCALARS %s %s %d\nLOOKUP_TABLE default\n'
+                     % (name, vtk_type, ncomp)).encode('latin-1'))
+        else:
+            f.write(('%s %s %s\n' % (kind, name, vtk_type)).encode('latin-1'))
+        _write_array(f, values)
+    if fields:
+        f.write(('FIELD FieldData %d\n' % len(fields)).encode('latin-1'))
+        for name, values in fields:
+            ncomp = 1 if values.ndim == 1 else values.shape[1]
+            f.write(('%s %d %d %s\n' % (name, ncomp, len(values),
+                                        _VTK_NAMES[values.dtype.str[1:]])
+                     ).encode('latin-1'))
+            _write_array(f, values)
+
+
+def write_vtk(path, polydata, title='tractography'):
+    """Writes a PolyData object as a binary legacy vtk file"""
+    pd = polydata
+    counts = np.diff(pd.offsets)
+    cells = np.empty(len(counts) + len(pd.connectivity), dtype='i4')
+    # interleave the point count before the ids of each line
+    starts = pd.offsets[:-1] + np.arange(len(counts))
+    cells[starts] = counts
+    mask = np.ones(len(cells), dtype=bool)
+    mask[starts] = False
+    cells[mask] = pd.connectivity
+    with open(path, 'wb') as f:
+        f.write(('# vtk DataFile Version 3.0\n%s\nBINARY\n'
+                 'DATASET POLYDATA\n' % title).encode('latin-1'))
+        f.write(('POINTS %d %s\n' % (len(pd.points),
+                                     _VTK_NAMES[pd.points.dtype.str[1:]])
+                 ).encode('latin-1'))
+        _write_array(f, pd.points)
+        f.write(('LINES %d %d\n' % (len(counts), len(cells))
+                 ).encode('latin-1'))
+        _write_array(f, cells)
+        if pd.cell_data:
+            f.write(('CELL_DATA %d\n' % len(counts)).encode('latin-1'))
+            _write_attributes(f, pd.cell_data, len(counts))
+        if pd.point_data:
+            f.write(('POINT_DATA %d\n' % len(pd.points)).encode('latin-1'))
+            _write_attributes(f, pd.point_data, len(pd.points))
+
+
+def merge(polydatas):
+    """Concatenates the lines of several PolyData objects into one.
+    Only arrays present in every input are kept."""
+    polydatas = list(polydatas)
+    if not polydatas:
+        raise ValueError('Nothing to merge')
+    points = []
+    offsets = [np.zeros(1, dtype='i8')]
+    connectivity = []
+    n_points = 0
+    n_ids = 0
+    for pd in polydatas:
+        points.append(pd.points)
+        connectivity.append(pd.connectivity + n_points)
+        offsets.append(pd.offsets[1:] + n_ids)
+        n_points += len(pd.points)
+        n_ids += len(pd.connectivity)
+
+    def _merge_data(attr):
+        merged = OrderedDict()
+        first = getattr(polydatas[0], attr)
+        for name, (kind, _) in first.items():
+            if all(name in getattr(pd, attr) for pd in polydatas):
+                merged[name] = (kind, np.concatenate(
+                    [getattr(pd, attr)[name][1] for pd in polydatas]))
+        return merged
+
+    return PolyData(np.concatenate(points),
+                    np.concatenate(offsets),
+                    np.concatenate(connectivity),
+                    _merge_data('point_data'),
+                    _merge_data('cell_data'))
+
+
+def merge_files(in_files, out_file):
+    """Merges several legacy vtk tract files into out_file"""
+    write_vtk(out_file, merge(read_vtk(f) for f in in_files))
+    return out_file
+
+
+def _segment_sums(values, offsets):
+    """Sums values over each segment values[offsets[i]:offsets[i + 1]]"""
+    counts = np.diff(offsets)
+    sums = np.zeros(len(counts), dtype='f8')
+    nonempty = counts > 0
+    if nonempty.any():
+        # empty segments are dropped, the next start ends the previous one
+        sums[nonempty] = np.add.reduceat(values, offsets[:-1][nonempty])
+    return sums
+
+
+def _line_blocks(offsets, block_points):
+    """Yields (first, last) line ranges of about block_points points"""
+    bounds = np.searchsorted(offsets, np.arange(0, offsets[-1],
+                                                block_points))
+    bounds = np.unique(np.concatenate([bounds, [len(offsets) - 1]]))
+    for first, last in zip(bounds[:-1], bounds[1:]):
+        yield first, last
+
+
+def _block_lengths(tracts, offsets, first, last):
+    """Returns the lengths of lines first to last"""
+    ids = tracts.connectivity[offsets[first]:offsets[last]]
+    points = np.asarray(tracts.points[ids], dtype='f8')
+    local = offsets[first:last + 1] - offsets[first]
+    steps = np.zeros(len(points))
+    steps[1:] = np.sqrt((np.diff(points, axis=0) ** 2).sum(axis=1))
+    # the step into the first point of a line is not part of it
+    steps[local[:-1][local[:-1] < len(steps)]] = 0
+    return _segment_sums(steps, local)
+
+
+def fiber_lengths(tracts, block_points=1 << 20):
+    """Returns the length of every line of a PolyData or MappedTracts
+    object, in the units of its points. Lines are processed in blocks
+    so only block_points points are held in memory at once."""
+    offsets = np.asarray(tracts.offsets, dtype='i8')
+    lengths = np.zeros(len(offsets) - 1)
+    for first, last in _line_blocks(offsets, block_points):
+        lengths[first:last] = _block_lengths(tracts, offsets, first, last)
+    return lengths
+
+
+def sample_fibers(tracts, count, min_length=None, max_length=None,
+                  seed=None, block_points=1 << 20):
+    """Draws count lines uniformly, without replacement, from the lines
+    whose length is within the given bounds, in a single pass over the
+    lines. Every line gets a random key and the count lowest keys are
+    kept, so memory scales with count rather than the number of lines.
+    Returns the sorted indices of the drawn lines and the number of
+    lines within the bounds."""
+    rng = np.random.RandomState(seed)
+    offsets = np.asarray(tracts.offsets, dtype='i8')
+    keys = np.zeros(0)
+    lines = np.zeros(0, dtype='i8')
+    passed = 0
+    for first, last in _line_blocks(offsets, block_points):
+        lengths = _block_lengths(tracts, offsets, first, last)
+        keep = np.ones(len(lengths), dtype=bool)
+        if min_length is not None:
+            keep &= lengths >= min_length
+        if max_length is not None:
+            keep &= lengths <= max_length
+        candidates = np.arange(first, last)[keep]
+        passed += len(candidates)
+        keys = np.concatenate([keys, rng.random_sample(len(candidates))])
+        lines = np.concatenate([lines, candidates])
+        if len(keys) > count:
+            lowest = np.argpartition(keys, count - 1)[:count] if count \
+                else np.zeros(0, dtype='i8')
+            keys, lines = keys[lowest], lines[lowest]
+    return np.sort(lines), passed
+
+
+def select_lines(tracts, lines):
+    """Returns a PolyData object holding only the given lines, with their
+    points and point and cell arrays"""
+    offsets = np.asarray(tracts.offsets, dtype='i8')
+    lines = np.asarray(lines, dtype='i8')
+    counts = offsets[lines + 1] - offsets[lines]
+    new_offsets = np.zeros(len(lines) + 1, dtype='i8')
+    np.cumsum(counts, out=new_offsets[1:])
+    # position in the connectivity array of every kept point
+    positions = (np.repeat(offsets[lines] - new_offsets[:-1], counts) +
+                 np.arange(new_offsets[-1]))
+    ids = np.asarray(tracts.connectivity[positions])
+
+    def native(values):
+        return values.astype(values.dtype.newbyteorder('='))
+
+    point_data = OrderedDict((name, (kind, native(values[ids])))
+                             for name, (kind, values)
+                             in tracts.point_data.items())
+    cell_data = OrderedDict((name, (kind, native(values[lines])))
+                            for name, (kind, values)
+                            in tracts.cell_data.items())
+    return PolyData(native(tracts.points[ids]), new_offsets,
+                    np.arange(len(ids)), point_data, cell_data)
+
+
+def fit_affine(source, target):
+    """Returns the 4x4 affine matrix mapping the points source onto the
+    corresponding points target in the least squares sense, and the
+    largest distance left between a mapped point and its target"""
+    source = np.asarray(source, dtype='f8')
+    target = np.asarray(target, dtype='f8')
+    if source.shape != target.shape:
+        raise ValueError('%d points cannot be matched to %d points'
+                         % (len(source), len(target)))
+    homogeneous = np.hstack([source, np.ones((len(source), 1))])
+    coefficients, _, rank, _ = np.linalg.lstsq(homogeneous, target,
+                                               rcond=-1)
+    if rank < 4:
+        raise ValueError('The points do not determine an affine transform')
+    matrix = np.eye(4)
+    matrix[:3] = coefficients.T
+    residuals = np.sqrt(((homogeneous.dot(coefficients) - target) ** 2)
+                        .sum(axis=1))
+    return matrix, float(residuals.max()) if len(residuals) else 0.0
+
+
+def transform_tracts(tracts, matrix, block_points=1 << 20):
+    """Returns a PolyData object with the points of tracts mapped by the
+    4x4 affine matrix. Lines and point and cell arrays are unchanged,
+    as vtkTransformPolyDataFilter leaves them without active vectors."""
+    points = tracts.points
+    dtype = points.dtype.newbyteorder('=')
+    moved = np.empty((len(points), 3), dtype=dtype)
+    for start in range(0, len(points), block_points):
+        block = np.asarray(points[start:start + block_points], dtype='f8')
+        moved[start:start + block_points] = (block.dot(matrix[:3, :3].T) +
+                                             matrix[:3, 3])
+    return PolyData(moved, np.asarray(tracts.offsets),
+                    np.asarray(tracts.connectivity),
+                    tracts.point_data, tracts.cell_data)
+
+
+def fiber_sums(tracts, name, block_points=1 << 20):
+    """Returns the sum of the scalar point array name over every line"""
+    offsets = np.asarray(tracts.offsets, dtype='i8')
+    values = tracts.point_data[name][1]
+    if values.ndim != 1:
+        raise ValueError('%s is not a scalar point array' % name)
+    sums = np.zeros(len(offsets) - 1)
+    for first, last in _line_blocks(offsets, block_points):
+        ids = tracts.connectivity[offsets[first]:offsets[last]]
+        local = offsets[first:last + 1] - offsets[first]
+        sums[first:last] = _segment_sums(np.asarray(values[ids],
+                                                    dtype='f8'), local)
+    return sums
+
+
+def fiber_means(tracts, name, block_points=1 << 20):
+    """Returns the mean of the scalar point array name along every line,
+    nan for lines without points"""
+    counts = np.diff(tracts.offsets)
+    sums = fiber_sums(tracts, name, block_points)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return sums / counts
+
+
+_VTP_TYPES = {'Int8': 'i1', 'UInt8': 'u1', 'Int16': 'i2', 'UInt16': 'u2',
+              'Int32': 'i4', 'UInt32': 'u4', 'Int64': 'i8', 'UInt64': 'u8',
+              'Float32': 'f4', 'Float64': 'f8'}
+
+_VTP_NAMES = dict((dtype, name) for name, dtype in _VTP_TYPES.items())
+
+# attribute kind reported for vtp arrays with this many components
+_VTP_KINDS = {1: 'SCALARS', 3: 'VECTORS', 9: 'TENSORS'}
+
+# vtk compressor class, compress(data, level), decompress(data, size)
+_COMPRESSORS = {
+    'zlib': ('vtkZLibDataCompressor',
+             lambda data, level: zlib.compress(data, level),
+             lambda data, size: zlib.decompress(data))}
+if lz4 is not None:
+    _COMPRESSORS['lz4'] = (
+        'vtkLZ4DataCompressor',
+        lambda data, level: lz4.block.compress(data, store_size=False),
+        lambda data, size: lz4.block.decompress(data,
+                                                uncompressed_size=size))
+_DECOMPRESSORS = dict((vtk_class, decompress) for vtk_class, _, decompress
+                      in _COMPRESSORS.values())
+
+
+class MappedTracts(object):
+    """Tractography backed by a memory mapped file, see open_tracts.
+
+    points, offsets and the point and cell arrays are views of the file
+    (offsets, the only array built on opening, has one entry per line).
+    Legacy .vtk files are big endian and the views keep that byte order.
+    Arrays of compressed .vtp files are inflated the first time they are
+    used. connectivity is only built when asked for, line_ids and fibers
+    give the points of one line at a time.
+
+    Can be passed to merge and write_vtk like a PolyData object.
+    """
+
+    def __init__(self, points, offsets, point_data, cell_data,
+                 connectivity=None, cells=None, buf=None):
+        self.points = points
+        self.offsets = offsets
+        self.point_data = point_data
+        self.cell_data = cell_data
+        self._connectivity = connectivity
+        # legacy cells, the ids of each line preceded by its point count
+        self._cells = cells
+        self._buf = buf
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        """Drops the arrays, the file is unmapped once no views of it
+        remain"""
+        self.points = self.offsets = None
+        self.point_data = self.cell_data = None
+        self._connectivity = self._cells = None
+        self._buf = None
+
+    @property
+    def n_lines(self):
+        return len(self.offsets) - 1
+
+    @property
+    def n_points(self):
+        return len(self.points)
+
+    @property
+    def connectivity(self):
+        if self._connectivity is None:
+            # drop the point count before each line
+            starts = self.offsets[:-1] + np.arange(self.n_lines)
+            mask = np.ones(len(self._cells), dtype=bool)
+            mask[starts] = False
+            self._connectivity = self._cells[mask]
+        return self._connectivity
+
+    def line_ids(self, i):
+        """Returns the point ids of line i"""
+        if self._connectivity is None and self._cells is not None:
+            start = self.offsets[i] + i + 1
+            return self._cells[start:start + self.offsets[i + 1] -
+                               self.offsets[i]]
+        return self.connectivity[self.offsets[i]:self.offsets[i + 1]]
+
+    def line(self, i):
+        """Returns the points of line i"""
+        return self.points[self.line_ids(i)]
+
+    def fibers(self, name=None):
+        """Yields the points of each line, or the values of point array
+        name along each line"""
+        values = self.points if name is None else self.point_data[name][1]
+        for i in range(self.n_lines):
+            yield values[self.line_ids(i)]
+
+    def __iter__(self):
+        return self.fibers()
+
+    def __len__(self):
+        return self.n_lines
+
+    def lengths(self):
+        """Returns the number of points of each line"""
+        return np.diff(self.offsets)
+
+
+def _line_offsets(cells, n_lines):
+    """Finds the offsets of the lines in a legacy cell array"""
+    offsets = np.zeros(n_lines + 1, dtype='i8')
+    i = 0
+    for line in range(n_lines):
+        count = int(cells[i])
+        offsets[line + 1] = offsets[line] + count
+        i += count + 1
+    return offsets
+
+
+def _open_legacy(path, buf):
+    reader = _Reader(buf, copy=False)
+    reader.line()  # version
+    reader.line()  # title
+    if reader.line()[0].upper() != 'BINARY':
+        raise ValueError('%s is ASCII, use read_vtk' % path)
+    reader.binary = True
+    if reader.line()[1].upper() != 'POLYDATA':
+        raise ValueError('%s is not vtk polydata' % path)
+
+    points = np.zeros((0, 3), dtype='f4')
+    offsets = np.zeros(1, dtype='i8')
+    connectivity = None
+    cells = np.zeros(0, dtype='i4')
+    point_data = OrderedDict()
+    cell_data = OrderedDict()
+    words = reader.line()
+    while words is not None:
+        section = words[0].upper()
+        if section == 'POINTS':
+            count = int(words[1])
+            points = reader.array(words[2], count * 3).reshape(count, 3)
+            words = reader.line()
+        elif section == 'LINES':
+            if len(words) == 3 and words[1].upper() != 'OFFSETS':
+                cells = reader.array('int', int(words[2]))
+                offsets = _line_offsets(cells, int(words[1]))
+            else:
+                # vtk 5.1 layout, LINES n_offsets n_ids followed by
+                # OFFSETS and CONNECTIVITY arrays
+                n_offsets, n_ids = int(words[1]), int(words[2])
+                offsets = reader.array(reader.line()[1], n_offsets)
+                connectivity = reader.array(reader.line()[1], n_ids)
+            words = reader.line()
+        elif section == 'POINT_DATA':
+            words = _read_attributes(reader, int(words[1]), point_data)
+        elif section == 'CELL_DATA':
+            words = _read_attributes(reader, int(words[1]), cell_data)
+        elif section in ('VERTICES', 'POLYGONS', 'TRIANGLE_STRIPS'):
+            reader.array('int', int(words[2]))
+            words = reader.line()
+        elif section == 'FIELD':
+            _read_field(reader, int(words[2]), OrderedDict())
+            words = reader.line()
+        else:
+            raise ValueError('Unsupported vtk section %s in %s'
+                             % (section, path))
+    return MappedTracts(points, offsets, point_data, cell_data,
+                        connectivity=connectivity, cells=cells, buf=buf)
+
+
+class _LazyArray(object):
+    """A compressed vtp array, inflated on first use"""
+
+    def __init__(self, load):
+        self._load = load
+        self._array = None
+
+    def __array__(self, dtype=None):
+        if self._array is None:
+            self._array = self._load()
+        return self._array if dtype is None else self._array.astype(dtype)
+
+
+class _LazyData(OrderedDict):
+    """Array name mapped to (kind, array), inflating arrays on access"""
+
+    def __getitem__(self, name):
+        kind, values = OrderedDict.__getitem__(self, name)
+        if isinstance(values, _LazyArray):
+            values = np.asarray(values)
+            OrderedDict.__setitem__(self, name, (kind, values))
+        return kind, values
+
+    def items(self):
+        return [(name, self[name]) for name in self]
+
+
+def _appended_array(buf, start, attrs, header_type, byte_order, compressor):
+    """Returns a function reading one appended raw data array"""
+    decompress = _DECOMPRESSORS.get(compressor)
+    header = np.dtype(_VTP_TYPES[header_type]).newbyteorder(byte_order)
+    dtype = np.dtype(_VTP_TYPES[attrs['type']]).newbyteorder(byte_order)
+    ncomp = int(attrs.get('NumberOfComponents', 1))
+    offset = start + int(attrs['offset'])
+
+    def shaped(values):
+        return values.reshape(-1, ncomp) if ncomp > 1 else values
+
+    if compressor is None:
+        nbytes = int(np.frombuffer(buf, header, 1, offset)[0])
+        values = np.frombuffer(buf, dtype, nbytes // dtype.itemsize,
+                               offset + header.itemsize)
+        return lambda: shaped(values)
+
+    def inflate():
+        nblocks, block_size, last_size = np.frombuffer(
+            buf, header, 3, offset).astype('i8')
+        sizes = np.frombuffer(buf, header, nblocks, offset +
+                              3 * header.itemsize).astype('i8')
+        pos = offset + (3 + nblocks) * header.itemsize
+        chunks = []
+        for block, size in enumerate(sizes):
+            raw_size = last_size if block == nblocks - 1 and last_size \
+                else block_size
+            chunks.append(decompress(buf[pos:pos + size], int(raw_size)))
+            pos += size
+        return shaped(np.frombuffer(b''.join(chunks), dtype))
+    return inflate
+
+
+def _open_vtp(path, buf):
+    end = buf.find(b'<AppendedData')
+    if end < 0:
+        raise ValueError('%s has no appended data to map' % path)
+    head = buf[:end].decode('latin-1')
+    tag = buf[end:buf.find(b'>', end) + 1].decode('latin-1')
+    if 'encoding="raw"' not in tag:
+        raise ValueError('%s appended data is not raw encoded' % path)
+    start = buf.find(b'_', end) + 1
+
+    attrs = dict(re.findall(r'(\w+)="([^"]*)"',
+                            re.search(r'<VTKFile[^>]*>', head).group(0)))
+    byte_order = '<' if attrs.get('byte_order',
+                                  'LittleEndian') == 'LittleEndian' else '>'
+    header_type = attrs.get('header_type', 'UInt32')
+    compressor = attrs.get('compressor')
+    if compressor is not None and compressor not in _DECOMPRESSORS:
+        raise ValueError('Unsupported vtp compressor %s' % compressor)
+
+    arrays = {}
+    sections = []
+    for closing, name, body in re.findall(r'<(/?)(\w+)([^>]*)>', head):
+        if name == 'DataArray':
+            if closing:
+                continue
+            array_attrs = dict(re.findall(r'(\w+)="([^"]*)"', body))
+            if array_attrs.get('format') != 'appended':
+                raise ValueError('%s has inline arrays, only appended data '
+                                 'can be mapped' % path)
+            load = _appended_array(buf, start, array_attrs, header_type,
+                                   byte_order, compressor)
+            arrays.setdefault(sections[-1], []).append(
+                (array_attrs.get('Name'),
+                 int(array_attrs.get('NumberOfComponents', 1)), load))
+        elif closing:
+            sections.pop()
+        elif not body.rstrip().endswith('/'):
+            sections.append(name)
+
+    def data(section):
+        data = _LazyData()
+        for name, ncomp, load in arrays.get(section, []):
+            kind = _VTP_KINDS.get(ncomp, 'FIELD')
+            values = load() if compressor is None else _LazyArray(load)
+            OrderedDict.__setitem__(data, name, (kind, values))
+        return data
+
+    points = arrays['Points'][0][2]()
+    lines = dict((name, load) for name, _, load in arrays.get('Lines', []))
+    if lines:
+        ends = lines['offsets']()
+        offsets = np.zeros(len(ends) + 1, dtype='i8')
+        offsets[1:] = ends
+        connectivity = lines['connectivity']()
+    else:
+        offsets = np.zeros(1, dtype='i8')
+        connectivity = np.zeros(0, dtype='i8')
+    return MappedTracts(points, offsets, data('PointData'), data('CellData'),
+                        connectivity=connectivity, buf=buf)
+
+
+def open_tracts(path):
+    """Memory maps a binary legacy .vtk or an appended raw .vtp file.
+    Returns a MappedTracts object."""
+    with open(path, 'rb') as f:
+        buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    if buf[:64].lstrip().startswith(b'<'):
+        return _open_vtp(path, buf)
+    return _open_legacy(path, buf)
+
+
+def _encode_array(values, compress, level, block_size):
+    """Returns the appended data block of one array"""
+    raw = np.ascontiguousarray(values, dtype=values.dtype.newbyteorder('<'))
+    raw = raw.tobytes()
+    if compress is None:
+        return np.array([len(raw)], dtype='<u8').tobytes() + raw
+    blocks = [compress(raw[i:i + block_size], level)
+              for i in range(0, len(raw), block_size)]
+    header = [len(blocks), block_size, len(raw) % block_size]
+    return np.array(header + [len(b) for b in blocks],
+                    dtype='<u8').tobytes() + b''.join(blocks)
+
+
+def write_vtp(path, polydata, compressor='zlib', level=6,
+              block_size=1 << 15):
+    """Writes a PolyData or MappedTracts object as a vtk xml polydata file
+    with appended raw data, compressed with zlib, lz4 (needs the lz4
+    package) or not at all (compressor=None)"""
+    pd = polydata
+    vtk_class, compress = None, None
+    if compressor is not None:
+        if compressor not in _COMPRESSORS:
+            raise ValueError('Unsupported compressor %s' % compressor)
+        vtk_class, compress, _ = _COMPRESSORS[compressor]
+
+    # 32 bit ids when they fit, as vtk writes them
+    index = 'i4' if pd.offsets[-1] < 2 ** 31 else 'i8'
+    offsets = np.asarray(pd.offsets, dtype=index)
+    sections = [('Points', [(None, np.asarray(pd.points))]),
+                ('Lines', [('connectivity',
+                            np.asarray(pd.connectivity, dtype=index)),
+                           ('offsets', offsets[1:])]),
+                ('PointData', [(name, np.asarray(values)) for name, (_, values)
+                               in pd.point_data.items()]),
+                ('CellData', [(name, np.asarray(values)) for name, (_, values)
+                              in pd.cell_data.items()])]
+    xml = ['<?xml version="1.0"?>',
+           '<VTKFile type="PolyData" version="1.0" byte_order="LittleEndian"'
+           ' header_type="UInt64"%s>' % (' compressor="%s"' % vtk_class
+                                         if vtk_class else ''),
+           '  <PolyData>',
+           '    <Piece NumberOfPoints="%d" NumberOfVerts="0" '
+           'NumberOfLines="%d" NumberOfStrips="0" NumberOfPolys="0">'
+           % (len(pd.points), len(offsets) - 1)]
+    blocks = []
+    position = 0
+    for section, arrays in sections:
+        if not arrays:
+            continue
+        xml.append('      <%s>' % section)
+        for name, values in arrays:
+            ncomp = 1 if values.ndim == 1 else values.shape[1]
+            block = _encode_array(values, compress, level, block_size)
+            xml.append('        <DataArray type="%s"%s '
+                       'NumberOfComponents="%d" format="appended" '
+                       'offset="%d"/>'
+                       % (_VTP_NAMES[values.dtype.str[1:]],
+                          ' Name="%s"' % name if name else '',
+                          ncomp, position))
+            blocks.append(block)
+            position += len(block)
+        xml.append('      </%s>' % section)
+    xml.extend(['    </Piece>', '  </PolyData>',
+                '  <AppendedData encoding="raw">'])
+    with open(path, 'wb') as f:
+        f.write(('\n'.join(xml) + '\n   _').encode('latin-1'))
+        for block in blocks:
+            f.write(block)
+        f.write(b'\n  </AppendedData>\n</VTKFile>\n')
+
+
+def write_npz(path, polydata):
+    """Writes a PolyData or MappedTracts object as a compressed numpy
+    archive"""
+    pd = polydata
+    points = np.asarray(pd.points)
+    arrays = {'points': points.astype(points.dtype.newbyteorder('=')),
+              'offsets': np.asarray(pd.offsets, dtype='i8'),
+              'connectivity': np.asarray(pd.connectivity, dtype='i8')}
+    kinds = {}
+    for prefix, data in (('point', pd.point_data), ('cell', pd.cell_data)):
+        for name, (kind, values) in data.items():
+            key = '%s_data/%s' % (prefix, name)
+            arrays[key] = np.asarray(
+                values, dtype=values.dtype.newbyteorder('='))
+            kinds[key] = kind
+    arrays['kinds'] = np.array(json.dumps(kinds))
+    with open(path, 'wb') as f:
+        np.savez_compressed(f, **arrays)
+
+
+def read_npz(path):
+    """Reads a numpy archive written by write_npz into a PolyData object"""
+    with np.load(path) as archive:
+        kinds = json.loads(str(archive['kinds']))
+        point_data = OrderedDict()
+        cell_data = OrderedDict()
+        for key in sorted(kinds):
+            prefix, name = key.split('/', 1)
+            data = point_data if prefix == 'point_data' else cell_data
+            data[name] = (kinds[key], archive[key])
+        return PolyData(archive['points'], archive['offsets'],
+                        archive['connectivity'], point_data, cell_data)
+
+
+def _base64_length(nbytes):
+    return (nbytes + 2) // 3 * 4
+
+
+def _decode_binary(text, header_type, byte_order, compressor):
+    """Returns the bytes of a base64 encoded inline vtp array"""
+    text = ''.join(text.split())
+    header = np.dtype(_VTP_TYPES[header_type]).newbyteorder(byte_order)
+    split = _base64_length(header.itemsize)
+    if compressor is None:
+        if text[split - 1:split] == '=':
+            # the size and the data encoded separately
+            nbytes = int(np.frombuffer(base64.b64decode(text[:split]),
+                                       header, 1)[0])
+            return base64.b64decode(text[split:])[:nbytes]
+        raw = base64.b64decode(text)
+        nbytes = int(np.frombuffer(raw, header, 1)[0])
+        return raw[header.itemsize:header.itemsize + nbytes]
+    # the block sizes are encoded on their own, then the blocks
+    decompress = _DECOMPRESSORS[compressor]
+    nblocks = int(np.frombuffer(base64.b64decode(text[:split]),
+                                header, 1)[0])
+    split = _base64_length((3 + nblocks) * header.itemsize)
+    sizes = np.frombuffer(base64.b64decode(text[:split]), header,
+                          3 + nblocks).astype('i8')
+    block_size, last_size = sizes[1], sizes[2]
+    body = base64.b64decode(text[split:])
+    chunks = []
+    pos = 0
+    for block, size in enumerate(sizes[3:]):
+        raw_size = last_size if block == nblocks - 1 and last_size \
+            else block_size
+        chunks.append(decompress(body[pos:pos + size], int(raw_size)))
+        pos += size
+    return b''.join(chunks)
+
+
+def read_vtp(path):
+    """Reads a vtk xml polydata file with inline ascii or base64 binary
+    arrays into a PolyData object"""
+    root = ElementTree.parse(path).getroot()
+    if root.get('type') != 'PolyData':
+        raise ValueError('%s is not vtk polydata' % path)
+    byte_order = '<' if root.get('byte_order',
+                                 'LittleEndian') == 'LittleEndian' else '>'
+    header_type = root.get('header_type', 'UInt32')
+    compressor = root.get('compressor')
+    if compressor is not None and compressor not in _DECOMPRESSORS:
+        raise ValueError('Unsupported vtp compressor %s' % compressor)
+    piece = root.find('PolyData/Piece')
+    if piece is None:
+        raise ValueError('%s has no polydata piece' % path)
+
+    def read_array(element):
+        dtype = np.dtype(_VTP_TYPES[element.get('type')])
+        ncomp = int(element.get('NumberOfComponents', 1))
+        fmt = element.get('format')
+        if fmt == 'ascii':
+            values = np.array((element.text or '').split(), dtype=dtype)
+        elif fmt == 'binary':
+            values = np.frombuffer(
+                _decode_binary(element.text or '', header_type, byte_order,
+                               compressor),
+                dtype.newbyteorder(byte_order))
+        else:
+            raise ValueError('%s has %s arrays, only inline ascii and '
+                             'binary ones are read' % (path, fmt))
+        return values.reshape(-1, ncomp) if ncomp > 1 else values
+
+    def data(section):
+        data = OrderedDict()
+        element = piece.find(section)
+        for array in [] if element is None else element.findall('DataArray'):
+            values = read_array(array)
+            ncomp = 1 if values.ndim == 1 else values.shape[1]
+            data[array.get('Name')] = (_VTP_KINDS.get(ncomp, 'FIELD'),
+                                       values)
+        return data
+
+    points = np.zeros((0, 3), dtype='f4')
+    element = piece.find('Points/DataArray')
+    if element is not None:
+        points = read_array(element)
+    lines = dict((array.get('Name'), read_array(array))
+                 for array in piece.findall('Lines/DataArray'))
+    offsets = np.zeros(len(lines.get('offsets', [])) + 1, dtype='i8')
+    offsets[1:] = lines.get('offsets', [])
+    connectivity = lines.get('connectivity', np.zeros(0, dtype='i8'))
+    return PolyData(points, offsets, connectivity, data('PointData'),
+                    data('CellData'))
+
+
+def load_tracts(path):
+    """Memory maps path when possible, ASCII legacy files, .vtp files with
+    inline arrays and numpy archives are read into memory"""
+    if path.endswith('.npz'):
+        return read_npz(path)
+    try:
+        return open_tracts(path)
+    except ValueError:
+        if path.endswith('.vtk'):
+            return read_vtk(path)
+        if path.endswith('.vtp'):
+            return read_vtp(path)
+        raise
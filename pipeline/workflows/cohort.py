@@ -0,0 +1,263 @@
+"""
+The 2tensor pipeline over a cohort of subjects.
+
+UKF tractography, registration to the atlas, clustering, outlier removal
+and the split by hemisphere run for every subject, selected with
+iterables over subject_id. The number of containers of each stage running
+at once is capped across all worker processes of the host, so a workflow
+of the whole study can be run with one MultiProc (or asyncio) plugin
+without starting more UKF runs than fit in memory. Subjects whose final
+outputs already exist in the working directory are left out. With an
+index_file the subjects and their files come from a cohort index
+(pipeline.utils.cohort) updated once when the workflow is built, instead
+of globbing the templates for every subject. On a single large host,
+PipelinedPlugin with STAGES overlaps the UKF run of a subject with the
+registration and clustering of the previous ones.
+Example:
+>>> wf = create_cohort_workflow(None, '/scratch/twright/data',
+...                             ukf_container, wm_container, maps,
+...                             max_ukf=2, max_wma=8,
+...                             index_file='/scratch/twright/cohort.json')
+>>> wf.run(plugin='MultiProc')
+"""
+
+import os
+import glob
+from copy import deepcopy
+
+from ..interfaces import ukftractography as ukf
+from ..interfaces import whitematteranalysis as wma
+from ..interfaces import tracts
+
+from ..interfaces.cohort import CohortFiles
+
+from nipype import SelectFiles, Workflow
+from nipype import config as nipype_config
+from nipype.interfaces.utility import IdentityInterface
+from nipype.pipeline.engine.utils import _get_valid_pathstr, merge_dict
+from nipype.utils.filemanip import loadpkl
+
+from ..utils.cache import flatten_outputs
+from ..utils.cohort import CohortIndex
+from .nodes import Node
+
+TEMPLATES = {'dwi': ('dtiprep/{subject_id}/{subject_id}_0[1,2]_'
+                     'DTI60-1000_20_Ax-DTI-60plus5_QCed.nrrd'),
+             'mask': ('dtiprep/{subject_id}/{subject_id}_0[1,2]_'
+                      'DTI60-1000_20_Ax-DTI-60plus5_QCed_B0_threshold_'
+                      'masked.nrrd')}
+
+UKF_INPUTS = {'recordFreeWater': True,
+              'freeWater': True,
+              'numTensor': 2,
+              'seedsPerVoxel': 5}
+
+ATLAS_DIR = '/opt/atlases'
+ATLAS_MRML = os.path.join(ATLAS_DIR,
+                          'clustered_tracts_display_100_percent_aem.mrml')
+
+# fiber length bounds (in mm) of the registration, the wma defaults
+REGISTER_LENGTHS = (20, 260)
+
+# the node whose outputs mark a subject as done
+FINAL_NODE = 'ClusterByHemisphere'
+
+# stages of the chain for PipelinedPlugin: one UKF run at a time, at most
+# two tract files waiting for registration and two registered ones waiting
+# for clustering
+STAGES = [{'name': 'ukf', 'nodes': ['tractography'], 'workers': 1},
+          {'name': 'register',
+           'nodes': ['SampleFibers', 'RegisterToAtlas', 'ApplyRegistration'],
+           'workers': 2, 'queue': 2},
+          {'name': 'cluster',
+           'nodes': ['ClusterFromAtlas', 'RemoveOutliers', FINAL_NODE],
+           'workers': 4, 'queue': 2}]
+
+
+def discover_subjects(base_directory, template):
+    """Returns the subject ids for which template, relative to
+    base_directory, matches a file. The subject id must be a directory name
+    or the start of one, e.g. dtiprep/{subject_id}/... or sub-{subject_id}/...
+    """
+    head = template.split('{subject_id}')[0]
+    parent, prefix = os.path.split(os.path.join(base_directory, head))
+    if not os.path.isdir(parent):
+        return []
+    subjects = []
+    for name in sorted(os.listdir(parent)):
+        if not name.startswith(prefix) or name == prefix:
+            continue
+        subject = name[len(prefix):]
+        if glob.glob(os.path.join(base_directory,
+                                  template.format(subject_id=subject))):
+            subjects.append(subject)
+    return subjects
+
+
+def subject_dir(workflow_dir, subject, node=FINAL_NODE, config=None):
+    """Returns the directory node runs in for subject in workflow_dir, as
+    nipype names it. config is the workflow config, by default the nipype
+    one, whose parameterize_dirs decides whether long names are hashed."""
+    probe = Node(IdentityInterface(fields=['subject_id']), name=node,
+                 base_dir=os.path.dirname(workflow_dir))
+    probe._hierarchy = os.path.basename(workflow_dir)
+    # the parameterization generate_expanded_graph gives the iterable
+    probe.parameterization = ['_%s_%s' % (_get_valid_pathstr('subject_id'),
+                                          _get_valid_pathstr(subject))]
+    probe.config = merge_dict(deepcopy(nipype_config._sections),
+                              config or {})
+    return probe.output_dir()
+
+
+def subject_done(workflow_dir, subject, node=FINAL_NODE, config=None):
+    """Tells whether node has run for subject in workflow_dir and all its
+    outputs still exist"""
+    node_dir = subject_dir(workflow_dir, subject, node, config)
+    result_file = os.path.join(node_dir, 'result_%s.pklz' % node)
+    if not os.path.exists(result_file):
+        return False
+    try:
+        result = loadpkl(result_file)
+    except Exception:
+        return False
+    if result is None or result.outputs is None:
+        return False
+    paths = [path for values in flatten_outputs(result.outputs.get()).values()
+             for path in values if path]
+    return bool(paths) and all(os.path.exists(path) for path in paths)
+
+
+def create_cohort_workflow(subjects, base_directory, ukf_container,
+                           wm_container, maps=None, name='2tensor',
+                           base_dir='working_dir', templates=None,
+                           max_ukf=None, max_wma=None, slots_dir=None,
+                           skip_done=True, ukf_inputs=None,
+                           atlas_dir=ATLAS_DIR, atlas_mrml=ATLAS_MRML,
+                           index_file=None, sample_fibers=None):
+    """Returns the 2tensor workflow iterating over subjects.
+
+    Parameters
+    ----------
+    subjects : list of strings
+        Subject ids, discovered from the dwi template when None.
+    base_directory : string
+        Directory the SelectFiles templates are relative to.
+    ukf_container, wm_container : string
+        The UKFTractography and whitematteranalysis images.
+    maps : list of strings
+        map_dirs_list of every task.
+    name, base_dir : string
+        Name and working directory of the workflow.
+    templates : dict
+        SelectFiles templates with 'dwi' and 'mask' entries, TEMPLATES by
+        default.
+    max_ukf, max_wma : int
+        Maximum number of UKF and whitematteranalysis containers running
+        at once on a host, unlimited when None.
+    slots_dir : string
+        Directory of the concurrency slots, below the working directory by
+        default. Nodes on other hosts share the caps when it is on a file
+        system supporting flock.
+    skip_done : bool
+        Leave out subjects whose final outputs exist in the working
+        directory.
+    ukf_inputs : dict
+        Inputs of UKFTractographyTask, UKF_INPUTS by default.
+    atlas_dir, atlas_mrml : string
+        Atlas directory and MRML file inside the whitematteranalysis image,
+        no MRML file is copied when atlas_mrml is None.
+    index_file : string
+        Cohort index the subjects and their files are taken from, it is
+        created or updated here. The templates are globbed when None.
+    sample_fibers : int
+        Register a sample of this many fibers, drawn on the host, rather
+        than the whole tractography, which is then registered with the
+        affine transform found for the sample and clustered whole. Needs
+        the affine registration mode.
+    """
+    templates = templates or TEMPLATES
+    if index_file is not None:
+        index = CohortIndex(index_file, base_directory, templates)
+        index.update()
+        if subjects is None:
+            subjects = index.subjects()
+    elif subjects is None:
+        subjects = discover_subjects(base_directory, templates['dwi'])
+    workflow_dir = os.path.join(os.path.abspath(base_dir), name)
+    if skip_done:
+        subjects = [subject for subject in subjects
+                    if not subject_done(workflow_dir, subject)]
+    if slots_dir is None:
+        slots_dir = os.path.join(workflow_dir, '_slots')
+
+    common = {'map_dirs_list': maps or []}
+
+    def limit(max_running, group):
+        if max_running is None:
+            return {}
+        return {'slots_dir': slots_dir,
+                'slot_group': group,
+                'max_running': max_running}
+
+    ukf_common = dict(common, container=ukf_container,
+                      **limit(max_ukf, 'ukf'))
+    ukf_common.update(UKF_INPUTS if ukf_inputs is None else ukf_inputs)
+    wm_common = dict(common, container=wm_container,
+                     **limit(max_wma, 'wma'))
+
+    tract = Node(ukf.UKFTractographyTask(**ukf_common),
+                 name="tractography")
+    register = Node(wma.WmRegisterToAtlasNewTask(
+                        inputAtlas=os.path.join(atlas_dir, 'atlas.vtp'),
+                        **wm_common),
+                    name="RegisterToAtlas")
+    cluster = Node(wma.WmClusterFromAtlasTask(atlasDirectory=atlas_dir,
+                                              fiberLength=20,
+                                              **wm_common),
+                   name="ClusterFromAtlas")
+    outliers = Node(wma.WmClusterRemoveOutliersTask(atlasDirectory=atlas_dir,
+                                                    clusterOutlierStd=4,
+                                                    **wm_common),
+                    name="RemoveOutliers")
+    splits = Node(wma.WmClusterByHemisphereTask(**wm_common),
+                  name=FINAL_NODE)
+    if atlas_mrml is not None:
+        splits.inputs.atlasMRML = atlas_mrml
+
+    if index_file is not None:
+        sf = Node(CohortFiles(templates, base_directory=base_directory,
+                              index_file=index.path),
+                  name="selectFiles")
+    else:
+        sf = Node(SelectFiles(templates, base_directory=base_directory),
+                  name="selectFiles")
+    sf.iterables = ('subject_id', subjects)
+
+    wf = Workflow(name=name, base_dir=base_dir)
+    wf.connect([(sf, tract, [("dwi", "dwiFile"),
+                             ("mask", "maskFile")])])
+    if sample_fibers is None:
+        wf.connect([(tract, register, [("tracts", "inputSubject")]),
+                    (register, cluster, [("outputFile", "inputFile")])])
+    else:
+        min_length, max_length = REGISTER_LENGTHS
+        register.inputs.mode = 'affine'
+        register.inputs.numberOfFibers = sample_fibers
+        register.inputs.fiberLength = min_length
+        register.inputs.fiberLengthMax = max_length
+        sample = Node(tracts.SampleFibersTask(number_of_fibers=sample_fibers,
+                                              fiber_length=min_length,
+                                              fiber_length_max=max_length),
+                      name="SampleFibers")
+        apply_reg = Node(tracts.ApplyRegistrationTask(),
+                         name="ApplyRegistration")
+        wf.connect([(tract, sample, [("tracts", "in_file")]),
+                    (tract, apply_reg, [("tracts", "in_file")]),
+                    (sample, register, [("out_file", "inputSubject")]),
+                    (sample, apply_reg, [("out_file", "sample_file")]),
+                    (register, apply_reg, [("outputFile",
+                                            "registered_file")]),
+                    (apply_reg, cluster, [("out_file", "inputFile")])])
+    wf.connect([(cluster, outliers, [("outputDirectory", "inputDirectory")]),
+                (outliers, splits, [("outputDirectory", "inputDirectory")])])
+    return wf
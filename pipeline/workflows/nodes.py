@@ -0,0 +1,56 @@
+"""
+Nodes that leave the threads of a task to its own estimate.
+
+nipype sets the num_threads of every interface to the n_procs of its node,
+1 unless given, so a task estimating its threads from its inputs (numThreads,
+jobNumber, ...) would always be scheduled on one core. These nodes only set
+num_threads when n_procs is passed explicitly, otherwise the interface
+keeps its estimated_num_threads. Map nodes do the same for every subnode.
+Example:
+>>> tract = Node(ukf.UKFTractographyTask(numThreads=8), name='tractography')
+>>> tract.interface.num_threads
+8
+>>> serial = Node(ukf.UKFTractographyTask(numThreads=8), name='serial',
+...               n_procs=1)
+>>> serial.interface.num_threads
+1
+"""
+
+from nipype.pipeline import engine as pe
+
+
+def set_n_procs(interface, n_procs):
+    """Sets the threads of interface to n_procs, or back to its estimate
+    when n_procs is None and the interface estimates them"""
+    if n_procs is not None:
+        interface.num_threads = n_procs
+    elif hasattr(interface, 'estimated_num_threads'):
+        interface.num_threads = None
+
+
+class Node(pe.Node):
+    """Node whose interface keeps its estimated threads unless n_procs
+    is given"""
+
+    def __init__(self, interface, name, n_procs=None, **kwargs):
+        super(Node, self).__init__(interface, name, n_procs=n_procs or 1,
+                                   **kwargs)
+        self._n_procs = n_procs
+        set_n_procs(self._interface, n_procs)
+
+
+class MapNode(pe.MapNode):
+    """MapNode whose subnodes keep their estimated threads unless n_procs
+    is given"""
+
+    def __init__(self, interface, iterfield, name, n_procs=None, **kwargs):
+        super(MapNode, self).__init__(interface, iterfield, name,
+                                      n_procs=n_procs or 1, **kwargs)
+        self._n_procs = n_procs
+        set_n_procs(self._interface, n_procs)
+
+    def _make_nodes(self, cwd=None):
+        # the subnodes are plain nipype nodes, set to a single thread
+        for i, node in super(MapNode, self)._make_nodes(cwd):
+            set_n_procs(node._interface, self._n_procs)
+            yield i, node
@@ -0,0 +1,65 @@
+"""
+UKF tractography split into seed shards that run as separate nodes.
+
+Each shard tracks from a disjoint subset of the seed voxels, so the shards
+can be spread over all cores of several cluster nodes. The shard tracts
+are merged back into a single file.
+Example:
+>>> ukf = create_sharded_ukf(8, container=ukf_container,
+...                          map_dirs_list=maps,
+...                          numTensor=2,
+...                          seedsPerVoxel=5)
+>>> wf.connect(sf, 'dwi', ukf, 'inputnode.dwiFile')
+>>> wf.connect(sf, 'mask', ukf, 'inputnode.maskFile')
+>>> wf.connect(ukf, 'outputnode.tracts', register, 'inputSubject')
+
+The seed shards are written to the workflow working directory which must
+be visible inside the container, so map_dirs_list should include it.
+"""
+
+from ..interfaces import ukftractography as ukf
+from ..interfaces import tracts
+from .nodes import Node, MapNode
+
+from nipype import Workflow
+from nipype.interfaces.utility import IdentityInterface
+
+
+def create_sharded_ukf(num_shards, name='sharded_ukf', **ukf_inputs):
+    """Returns a workflow running UKFTractographyTask in num_shards pieces.
+
+    Parameters
+    ----------
+    num_shards : int
+        Number of disjoint seed sets (and UKF containers) to use.
+    name : string
+        Name of the workflow.
+    ukf_inputs :
+        Inputs passed to every UKFTractographyTask.
+
+    Inputs: inputnode.dwiFile, inputnode.maskFile, inputnode.seedsFile
+    (optional, the mask is split when not given)
+    Outputs: outputnode.tracts
+    """
+    inputnode = Node(IdentityInterface(fields=['dwiFile',
+                                               'maskFile',
+                                               'seedsFile']),
+                     name='inputnode')
+    split = Node(ukf.SplitSeedsTask(numShards=num_shards),
+                 name='split_seeds')
+    tract = MapNode(ukf.UKFTractographyTask(**ukf_inputs),
+                    iterfield=['seedsFile'],
+                    name='tractography')
+    merge = Node(tracts.MergeTractsTask(), name='merge_tracts')
+    outputnode = Node(IdentityInterface(fields=['tracts']),
+                      name='outputnode')
+
+    wf = Workflow(name=name)
+    wf.connect([(inputnode, split, [('maskFile', 'maskFile'),
+                                    ('seedsFile', 'seedsFile')]),
+                (inputnode, tract, [('dwiFile', 'dwiFile'),
+                                    ('maskFile', 'maskFile')]),
+                (split, tract, [('seedFiles', 'seedsFile')]),
+                (tract, merge, [('tracts', 'in_files')]),
+                (merge, outputnode, [('tracts', 'tracts')])])
+    return wf
@@ -0,0 +1,34 @@
+import os
+
+import pytest
+from nipype import Node, Workflow
+from nipype.interfaces.utility import Function, IdentityInterface
+
+from ..cohort import subject_dir
+
+SUBJECTS = ['SYN01', 'SYN01_BEN_0000_01_with_a_long_session_name']
+
+
+def _echo(subject_id):
+    return subject_id
+
+
+@pytest.mark.parametrize('parameterize_dirs', [True, False])
+def test_subject_dir_matches_nipype(tmpdir, parameterize_dirs):
+    wf = Workflow(name='2tensor', base_dir=str(tmpdir))
+    wf.config['execution'] = {'parameterize_dirs': parameterize_dirs,
+                              'crashdump_dir': str(tmpdir)}
+    source = Node(IdentityInterface(fields=['subject_id']), name='source')
+    source.iterables = ('subject_id', SUBJECTS)
+    final = Node(Function(input_names=['subject_id'],
+                          output_names=['subject_id'],
+                          function=_echo),
+                 name='final')
+    wf.connect(source, 'subject_id', final, 'subject_id')
+    wf.run()
+    workflow_dir = str(tmpdir.join('2tensor'))
+    dirs = set(os.listdir(workflow_dir))
+    for subject in SUBJECTS:
+        node_dir = subject_dir(workflow_dir, subject, 'final', wf.config)
+        assert os.path.basename(os.path.dirname(node_dir)) in dirs
+        assert os.path.exists(os.path.join(node_dir, 'result_final.pklz'))